@@ -17,96 +17,119 @@ Open:
   http://127.0.0.1:8000/docs   (Swagger UI)
 
 Note:
-- You can change LLM_MODEL and EMBED_MODEL in this file.
+- LLM_MODEL and EMBED_MODEL are set in core.py.
 """
 
-import io
+import asyncio
 import json
-import os
-import time
+from contextlib import asynccontextmanager
 from typing import List, Optional, Any, Dict
 
 from fastapi import FastAPI, UploadFile, File, Form
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
 
-from pypdf import PdfReader
-from docx import Document as DocxDocument
+# Models, retrieval and storage are configured and implemented in `core.py`;
+# heavy dependencies (Chroma, Ollama clients, PDF/DOCX parsers) load on first use.
+from core import (
+    aask_with_agents_stream,
+    abuild_context,
+    ainvoke_llm,
+    answer_cache,
+    append_chat,
+    ask_with_tools_detailed,
+    astream_llm,
+    cancel_job,
+    create_note,
+    generate_mindmap,
+    get_chats,
+    get_job,
+    get_note,
+    get_summary_node,
+    index_files,
+    is_ready,
+    list_jobs,
+    list_notes,
+    parse_json_loose,
+    parse_stats,
+    rename_note,
+    reranker,
+    resources,
+    start_job_workers,
+    start_warm_up,
+    submit_index_job,
+    submit_job,
+    summary_status,
+    warmup_status,
+)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Re-queue jobs interrupted by a restart, start the job workers and warm up
+    the models in the background (see GET /ready)."""
+    await asyncio.to_thread(start_job_workers)
+    start_warm_up()
+    yield
 
-from langchain_core.documents import Document
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_chroma import Chroma
-from langchain_ollama import ChatOllama, OllamaEmbeddings
 
+# Initialize FastAPI app
+app = FastAPI(title="StudyRAG Local API", lifespan=lifespan)
 
-# ----------------------------
-# Config (LOCAL)
-# ----------------------------
-OLLAMA_BASE_URL = "http://127.0.0.1:11434"
-LLM_MODEL = "llama3.2:1b"
-# Use the exact tag shown by `ollama list` for the embeddings model
-# (e.g. `nomic-embed-text:latest`) to avoid "model not found" errors.
-EMBED_MODEL = "nomic-embed-text:latest"
 
-# FastAPI endpoints removed. This module now delegates to `core.py`.
-# Keep a compatibility shim so other scripts can still import helpers
-from core import *  # noqa: F401,F403
+# How often /quiz and /flashcards check on the job doing the work
+JOB_WAIT_POLL_S = 0.25
 
-# Note: FastAPI server was intentionally removed in favor of the
-# Streamlit UI (`streamlit_app.py`). If you need the API back, see
-# version history or recreate endpoints using the helpers in `core.py`.
 
-# Initialize FastAPI app
-app = FastAPI(title="StudyRAG Local API")
+class AskReq(BaseModel):
+    question: str
+    note_id: Optional[str] = None
 
-# Initialize LLM
-llm = ChatOllama(model=LLM_MODEL, base_url=OLLAMA_BASE_URL)
 
+class GenReq(BaseModel):
+    topic: Optional[str] = None
+    n: Optional[int] = None
+    note_id: Optional[str] = None
 
-@app.post("/upload")
-async def upload_files(files: List[UploadFile] = File(...), note_id: Optional[str] = Form(None)):
-    """Upload and process documents for RAG."""
-    try:
-        raw_docs = []
-        for f in files:
-            content = await f.read()
-            text = ""
-            
-            if f.filename.lower().endswith(".pdf"):
-                pdf = PdfReader(io.BytesIO(content))
-                text = "\n".join(page.extract_text() or "" for page in pdf.pages)
-            elif f.filename.lower().endswith(".docx"):
-                doc = DocxDocument(io.BytesIO(content))
-                text = "\n".join(p.text for p in doc.paragraphs)
-            elif f.filename.lower().endswith(".txt"):
-                text = content.decode("utf-8", errors="ignore")
-            
-            if text.strip():
-                raw_docs.append(Document(page_content=text, metadata={"source": f.filename}))
-        
-        if not raw_docs:
-            return JSONResponse(
-                {"ok": False, "message": "No extractable text. If PDF is scanned, you need OCR."},
-                status_code=400,
-            )
 
-        splitter = RecursiveCharacterTextSplitter(chunk_size=900, chunk_overlap=150)
-        splits = splitter.split_documents(raw_docs)
+class JobReq(BaseModel):
+    kind: str
+    params: Dict[str, Any] = {}
 
-        vs = ensure_vectorstore()
-        vs.add_documents(splits)
 
-        return {"ok": True, "docs": len(raw_docs), "chunks": len(splits)}
-    except Exception as e:
-        return JSONResponse({"ok": False, "error": f"{type(e).__name__}: {e}"}, status_code=500)
+class NoteCreateReq(BaseModel):
+    title: str
 
 
+class NoteRenameReq(BaseModel):
+    title: str
 
-@app.post("/chat")
-def chat(req: AskReq):
+
+async def sse_events(tokens, on_complete=None):
+    """Wrap an async token iterator as Server-Sent Events.
+
+    Each token is sent as `data: {"token": ...}`; the stream ends with a
+    `done` event carrying the full text, or an `error` event.
+    """
+    parts = []
     try:
-        ctx = build_context(req.question, note_id=req.note_id)
-        prompt = f"""
+        async for token in tokens:
+            parts.append(token)
+            yield f"data: {json.dumps({'token': token})}\n\n"
+        text = "".join(parts)
+        if on_complete:
+            await on_complete(text)
+        yield f"event: done\ndata: {json.dumps({'text': text})}\n\n"
+    except Exception as e:
+        yield f"event: error\ndata: {json.dumps({'error': f'{type(e).__name__}: {e}'})}\n\n"
+
+
+async def single_token(text: str):
+    yield text
+
+
+def chat_prompt(question: str, ctx: str) -> str:
+    return f"""
 You are a study assistant.
 Answer ONLY using the context. If not in context, say "I don't know".
 Add citations like [1], [2].
@@ -115,121 +138,259 @@ CONTEXT:
 {ctx}
 
 QUESTION:
-{req.question}
+{question}
 """
-        out = llm.invoke(prompt).content
-        if req.note_id:
-            state = load_state()
-            state["chats"].setdefault(req.note_id, [])
-            state["chats"][req.note_id].append(
-                {"question": req.question, "answer": out, "ts": int(time.time())}
+
+
+def summary_prompt(ctx: str) -> str:
+    return (
+        "Create a student-friendly summary with bullets + key definitions + 5 review questions.\n\n"
+        f"CONTEXT:\n{ctx}"
+    )
+
+
+def record_chat(note_id: Optional[str], question: str, answer: str) -> None:
+    if note_id:
+        append_chat(note_id, question, answer)
+
+
+async def arecord_chat(note_id: Optional[str], question: str, answer: str) -> None:
+    await asyncio.to_thread(record_chat, note_id, question, answer)
+
+
+@app.post("/upload")
+async def upload_files(files: List[UploadFile] = File(...), note_id: Optional[str] = Form(None)):
+    """Upload and process documents for RAG."""
+    try:
+        pairs = [(f.filename, await f.read()) for f in files]
+        res = await asyncio.to_thread(index_files, pairs, note_id)
+        if not res.get("ok"):
+            return JSONResponse(
+                {"ok": False, "message": "No extractable text. If PDF is scanned, you need OCR."},
+                status_code=400,
             )
-            save_state(state)
+        return res
+    except Exception as e:
+        return JSONResponse({"ok": False, "error": f"{type(e).__name__}: {e}"}, status_code=500)
+
+
+
+@app.post("/chat")
+async def chat(req: AskReq):
+    try:
+        out = await answer_cache.alookup(req.question, req.note_id, "chat")
+        if out is None:
+            ctx = await abuild_context(req.question, note_id=req.note_id)
+            out = await ainvoke_llm(chat_prompt(req.question, ctx))
+            await answer_cache.astore(req.question, req.note_id, "chat", out)
+        await arecord_chat(req.note_id, req.question, out)
         return {"answer": out}
     except Exception as e:
         return JSONResponse({"error": f"{type(e).__name__}: {e}"}, status_code=500)
 
 
+@app.post("/chat/stream")
+async def chat_stream(req: AskReq):
+    """Same as /chat, streamed token by token as Server-Sent Events."""
+    try:
+        cached = await answer_cache.alookup(req.question, req.note_id, "chat")
+        if cached is not None:
+            events = sse_events(
+                single_token(cached), on_complete=lambda text: arecord_chat(req.note_id, req.question, text)
+            )
+            return StreamingResponse(events, media_type="text/event-stream")
+        ctx = await abuild_context(req.question, note_id=req.note_id)
+    except Exception as e:
+        return JSONResponse({"error": f"{type(e).__name__}: {e}"}, status_code=500)
+
+    async def on_complete(text: str) -> None:
+        await answer_cache.astore(req.question, req.note_id, "chat", text)
+        await arecord_chat(req.note_id, req.question, text)
+
+    events = sse_events(astream_llm(chat_prompt(req.question, ctx)), on_complete=on_complete)
+    return StreamingResponse(events, media_type="text/event-stream")
+
+
+@app.post("/chat/tools")
+def chat_tools(req: AskReq):
+    """Tool-enabled answer; includes the routing decision and per-step timings."""
+    try:
+        return ask_with_tools_detailed(req.question, note_id=req.note_id)
+    except Exception as e:
+        return JSONResponse({"error": f"{type(e).__name__}: {e}"}, status_code=500)
+
+
 @app.post("/summary")
-def summary(req: GenReq):
+async def summary(req: GenReq):
     try:
+        if not req.topic:
+            cached = await asyncio.to_thread(get_summary_node, req.note_id, "note")
+            if cached:
+                return {"summary": cached, "precomputed": True}
         topic = req.topic or "main topics"
-        ctx = build_context(topic, note_id=req.note_id)
-        prompt = (
-            "Create a student-friendly summary with bullets + key definitions + 5 review questions.\n\n"
-            f"CONTEXT:\n{ctx}"
-        )
-        out = llm.invoke(prompt).content
+        ctx = await abuild_context(topic, note_id=req.note_id)
+        out = await ainvoke_llm(summary_prompt(ctx))
         return {"summary": out}
     except Exception as e:
         return JSONResponse({"error": f"{type(e).__name__}: {e}"}, status_code=500)
 
 
-@app.post("/flashcards")
-def flashcards(req: GenReq):
+@app.post("/summary/stream")
+async def summary_stream(req: GenReq):
+    """Same as /summary, streamed token by token as Server-Sent Events."""
     try:
-        topic = req.topic or "key concepts"
-        n = int(req.n or 12)
-        ctx = build_context(topic, note_id=req.note_id)
-
-        prompt = f"""
-Return ONLY valid JSON (no markdown).
-Schema:
-{{
-  "flashcards": [{{"front":"...","back":"..."}}]
-}}
-Generate exactly {n} flashcards grounded in the context.
+        cached = None if req.topic else await asyncio.to_thread(get_summary_node, req.note_id, "note")
+        if cached:
+            return StreamingResponse(sse_events(single_token(cached)), media_type="text/event-stream")
+        ctx = await abuild_context(req.topic or "main topics", note_id=req.note_id)
+    except Exception as e:
+        return JSONResponse({"error": f"{type(e).__name__}: {e}"}, status_code=500)
+    return StreamingResponse(sse_events(astream_llm(summary_prompt(ctx))), media_type="text/event-stream")
 
-CONTEXT:
-{ctx}
-"""
-        out = llm.invoke(prompt).content
+
+@app.post("/agents/stream")
+async def agents_stream(req: AskReq):
+    """Researcher -> Teacher answer; the Teacher's explanation is streamed as SSE."""
+    try:
+        result = await aask_with_agents_stream(req.question, note_id=req.note_id)
+    except Exception as e:
+        return JSONResponse({"error": f"{type(e).__name__}: {e}"}, status_code=500)
+    return StreamingResponse(sse_events(result["answer_stream"]), media_type="text/event-stream")
+
+
+@app.post("/mindmap")
+async def mindmap(req: GenReq):
+    """Mind map JSON; without a topic it is the one precomputed at upload time."""
+    try:
+        out = await asyncio.to_thread(generate_mindmap, req.topic or "", req.note_id)
         return parse_json_loose(out)
     except Exception as e:
         return JSONResponse({"error": f"{type(e).__name__}: {e}"}, status_code=500)
 
 
-@app.post("/quiz")
-def quiz(req: GenReq):
+@app.get("/summary/status")
+def summary_build_status():
+    """Background summary-tree build state per note ("" = uploads without a note)."""
+    return summary_status()
+
+
+async def run_job(kind: str, params: Dict[str, Any]):
+    """Queue a job and wait for it, so synchronous generation shares the job
+    workers' concurrency limit instead of holding a thread per request."""
+    job_id = await asyncio.to_thread(submit_job, kind, params)
+    while True:
+        job = await asyncio.to_thread(get_job, job_id)
+        if job["status"] == "done":
+            return job["result"]
+        if job["status"] in ("error", "cancelled"):
+            return JSONResponse({"error": job["error"] or f"Job {job['status']}"}, status_code=500)
+        await asyncio.sleep(JOB_WAIT_POLL_S)
+
+
+@app.post("/flashcards")
+async def flashcards(req: GenReq):
     try:
-        topic = req.topic or "key topics"
-        n = int(req.n or 10)
-        ctx = build_context(topic, note_id=req.note_id)
-
-        prompt = f"""
-Return ONLY valid JSON (no markdown).
-Schema:
-{{
-  "quiz": [
-    {{
-      "type": "mcq",
-      "question": "...",
-      "choices": ["A","B","C","D"],
-      "answer_index": 0,
-      "explanation": "..."
-    }}
-  ]
-}}
-Generate exactly {n} questions grounded in the context.
+        return await run_job("flashcards", {"topic": req.topic or "", "n": int(req.n or 12), "note_id": req.note_id})
+    except Exception as e:
+        return JSONResponse({"error": f"{type(e).__name__}: {e}"}, status_code=500)
 
-CONTEXT:
-{ctx}
-"""
-        out = llm.invoke(prompt).content
-        return parse_json_loose(out)
+
+@app.post("/quiz")
+async def quiz(req: GenReq):
+    try:
+        return await run_job("quiz", {"topic": req.topic or "", "n": int(req.n or 10), "note_id": req.note_id})
     except Exception as e:
         return JSONResponse({"error": f"{type(e).__name__}: {e}"}, status_code=500)
 
 
+@app.post("/jobs")
+def post_job(req: JobReq):
+    """Queue a quiz / flashcards / summary / mindmap job; poll GET /jobs/{id}."""
+    try:
+        return {"id": submit_job(req.kind, req.params)}
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+
+@app.post("/jobs/upload")
+async def post_upload_job(files: List[UploadFile] = File(...), note_id: Optional[str] = Form(None)):
+    """Queue documents for indexing; progress is reported on the job."""
+    pairs = [(f.filename, await f.read()) for f in files]
+    return {"id": await asyncio.to_thread(submit_index_job, pairs, note_id)}
+
+
+@app.get("/jobs")
+def get_jobs(limit: int = 20):
+    return {"jobs": list_jobs(min(max(limit, 1), 200))}
+
+
+@app.get("/jobs/{job_id}")
+def job_status(job_id: str):
+    job = get_job(job_id)
+    if job is None:
+        return JSONResponse({"error": "Not found"}, status_code=404)
+    return job
+
+
+@app.post("/jobs/{job_id}/cancel")
+def post_cancel_job(job_id: str):
+    if not cancel_job(job_id):
+        return JSONResponse({"error": "Not found or already finished"}, status_code=404)
+    return get_job(job_id)
+
+
+@app.get("/ready")
+def ready():
+    """200 once the startup warm-up finished (models loaded, indexes open), else 503."""
+    return JSONResponse(warmup_status, status_code=200 if is_ready() else 503)
+
+
+@app.get("/cache/stats")
+def cache_stats():
+    """Hit/miss/eviction counters of the semantic answer cache."""
+    return answer_cache.stats
+
+
+@app.get("/rerank/stats")
+def rerank_stats():
+    """Reranked / skipped / truncated counters and the last rerank's latency."""
+    return reranker.stats
+
+
+@app.get("/resources/stats")
+def resource_stats():
+    """Shared LLM / embedding / vectorstore handles, active leases and retired handles still draining."""
+    return resources.stats()
+
+
+@app.get("/generation/stats")
+def generation_stats():
+    """Per generator: LLM generations, retries, parse failures, invalid items, wasted generations."""
+    return parse_stats
+
+
 @app.get("/notes")
-def list_notes():
-    state = load_state()
-    notes = [{"id": k, "title": v["title"]} for k, v in state["notes"].items()]
+def get_notes():
+    notes = [{"id": k, "title": v["title"]} for k, v in list_notes().items()]
     return {"notes": notes}
 
 
 @app.post("/notes")
-def create_note(req: NoteCreateReq):
-    state = load_state()
-    note_id = new_id("note")
-    state["notes"][note_id] = {"title": req.title}
-    save_state(state)
+def post_note(req: NoteCreateReq):
+    note_id = create_note(req.title)
     return {"id": note_id, "title": req.title}
 
 
 @app.patch("/notes/{note_id}")
-def rename_note(note_id: str, req: NoteRenameReq):
-    state = load_state()
-    if note_id not in state["notes"]:
+def patch_note(note_id: str, req: NoteRenameReq):
+    if not rename_note(note_id, req.title):
         return JSONResponse({"error": "Not found"}, status_code=404)
-    state["notes"][note_id]["title"] = req.title
-    save_state(state)
     return {"id": note_id, "title": req.title}
 
 
 @app.get("/notes/{note_id}/chats")
-def get_chats(note_id: str):
-    state = load_state()
-    if note_id not in state["notes"]:
+def note_chats(note_id: str, limit: int = 50, before: Optional[int] = None):
+    """Paginated chat history; pass `next_before` back as `before` for older turns."""
+    if get_note(note_id) is None:
         return JSONResponse({"error": "Not found"}, status_code=404)
-    return {"chats": state["chats"].get(note_id, [])}
\ No newline at end of file
+    return get_chats(note_id, limit=min(max(limit, 1), 500), before=before)
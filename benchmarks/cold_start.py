@@ -0,0 +1,92 @@
+"""
+Cold-start benchmark: time to the first answer after a restart, with and
+without the startup warm-up.
+
+For every run both models are unloaded from Ollama (keep_alive=0), then a fresh
+Python process imports core, runs warm_up() ("warm" mode only) and answers one
+question (retrieval + LLM). Reported per mode: import, warm-up and first-answer
+milliseconds. In "warm" mode the warm-up normally runs while the app starts,
+so first-answer is what a student waits for; in "cold" mode it pays for loading
+everything. Each run asks a slightly different question so the embedding cache
+cannot hide the embedding model load.
+
+Run from the repo root (Ollama running, documents uploaded):
+  python benchmarks/cold_start.py [--runs 3] [--question "What is photosynthesis?"]
+"""
+
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import core  # noqa: E402
+
+MODES = ["cold", "warm"]
+
+CHILD = r"""
+import json, sys, time
+started = time.perf_counter()
+import core
+imported = time.perf_counter()
+if sys.argv[1] == "warm":
+    core.warm_up()
+warmed = time.perf_counter()
+question = sys.argv[2]
+ctx = core.build_context(question)
+core.get_llm().invoke(f"Answer in one sentence from the context.\n\n{ctx}\n\nQUESTION: {question}")
+done = time.perf_counter()
+print(json.dumps({
+    "import_ms": (imported - started) * 1000,
+    "warmup_ms": (warmed - imported) * 1000,
+    "first_answer_ms": (done - warmed) * 1000,
+    "warmup": core.warmup_status,
+}))
+"""
+
+
+def unload_models():
+    for model in {core.LLM_MODEL, core.EMBED_MODEL}:
+        try:
+            core.get_ollama_http().post("/api/generate", json={"model": model, "keep_alive": 0})
+        except Exception as e:
+            print(f"could not unload {model}: {type(e).__name__}: {e}", file=sys.stderr)
+
+
+def run_once(mode, question):
+    unload_models()
+    out = subprocess.run(
+        [sys.executable, "-c", CHILD, mode, question], cwd=ROOT, capture_output=True, text=True, check=True
+    )
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def run(runs, question):
+    print(f"{'mode':<8}{'import ms':>11}{'warm-up ms':>12}{'first answer ms':>17}")
+    for mode in MODES:
+        results = [run_once(mode, f"{question} ({mode} {i})") for i in range(runs)]
+        print(
+            f"{mode:<8}"
+            f"{statistics.mean(r['import_ms'] for r in results):>11.0f}"
+            f"{statistics.mean(r['warmup_ms'] for r in results):>12.0f}"
+            f"{statistics.mean(r['first_answer_ms'] for r in results):>17.0f}"
+        )
+        if mode == "warm":
+            print(f"\nlast warm-up steps (ms): {results[-1]['warmup']['steps']}")
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    runs, question = 3, "What are the main topics?"
+    if "--runs" in args:
+        i = args.index("--runs")
+        runs = int(args[i + 1])
+        del args[i:i + 2]
+    if "--question" in args:
+        i = args.index("--question")
+        question = args[i + 1]
+        del args[i:i + 2]
+    run(runs, question)
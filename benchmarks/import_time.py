@@ -0,0 +1,88 @@
+"""
+Import-time report: how long `import core` / `import app` take in a fresh
+interpreter, which top-level packages account for it, and whether any of the
+deliberately lazy heavy dependencies got imported eagerly again.
+
+Uses `python -X importtime`; every module is measured in a new process and the
+median of --runs is reported. With --budget-ms the script exits non-zero when a
+module goes over budget or a lazy dependency is imported, so it can guard
+against startup regressions.
+
+Run from the repo root:
+  python benchmarks/import_time.py [core app streamlit_app] [--runs 5] [--top 15] [--budget-ms 800]
+"""
+
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Loaded on first use inside core; none should appear at import time
+LAZY = ["pypdf", "docx", "langchain_text_splitters", "langchain_chroma", "chromadb", "langchain_ollama", "numpy"]
+
+LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+def profile(module):
+    """(total ms, {package: cumulative ms}) for one fresh import of `module`.
+
+    Cumulative times nest (a package's time includes what it imports), so
+    they do not add up to the total.
+    """
+    out = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT, capture_output=True, text=True, check=True,
+    )
+    # Children are printed before their parent, one indent level deeper
+    total, packages, pending = 0.0, {}, []
+    for line in out.stderr.splitlines():
+        m = LINE.match(line)
+        if not m:
+            continue
+        cumulative_ms = int(m.group(2)) / 1000
+        depth = (len(m.group(3)) - 1) // 2
+        name = m.group(4)
+        package = name.split(".")[0]
+        children = [c for c in pending if c[0] > depth]
+        pending = [c for c in pending if c[0] <= depth]
+        # Charge a package where it is first entered from another package
+        for _, child_name, child_ms in children:
+            child_package = child_name.split(".")[0]
+            if child_package != package:
+                packages[child_package] = packages.get(child_package, 0.0) + child_ms
+        pending.append((depth, name, cumulative_ms))
+        if name == module:
+            total = cumulative_ms
+    return total, packages
+
+
+def run(modules, runs, top, budget_ms):
+    failed = False
+    for module in modules:
+        profiles = [profile(module) for _ in range(runs)]
+        total = statistics.median(t for t, _ in profiles)
+        packages = profiles[-1][1]
+        over = budget_ms is not None and total > budget_ms
+        print(f"\n{module}: {total:.0f} ms (median of {runs}){'  OVER BUDGET' if over else ''}")
+        for name, ms in sorted(packages.items(), key=lambda p: p[1], reverse=True)[:top]:
+            print(f"  {name:<32}{ms:>9.1f} ms")
+        eager = [name for name in LAZY if name in packages]
+        if eager:
+            print(f"  imported eagerly (should be lazy): {', '.join(eager)}")
+        failed = failed or over or bool(eager)
+    return failed
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    options = {"--runs": 5, "--top": 15, "--budget-ms": None}
+    for flag in options:
+        if flag in args:
+            i = args.index(flag)
+            options[flag] = float(args[i + 1]) if flag == "--budget-ms" else int(args[i + 1])
+            del args[i:i + 2]
+    failed = run(args or ["core", "app"], options["--runs"], options["--top"], options["--budget-ms"])
+    sys.exit(1 if failed and options["--budget-ms"] is not None else 0)
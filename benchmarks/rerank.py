@@ -0,0 +1,95 @@
+"""
+Reranking benchmark: retrieval quality vs. added latency.
+
+For each question, retrieves TOP_K chunks with every rerank method and reports
+hit@k (a retrieved chunk contains the expected answer text), the number of
+distinct sources in the context (diversity) and the mean / p95 milliseconds
+added on top of plain retrieval.
+
+Questions come from a JSONL file of {"question": ..., "answer_contains": ...}
+lines. Without one, a recall proxy is used: a sentence is sampled from random
+indexed chunks and used as the question, and the hit is that chunk's text.
+
+Run from the repo root (Ollama running, documents uploaded):
+  python benchmarks/rerank.py [questions.jsonl] [--n 30]
+"""
+
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import core  # noqa: E402
+
+METHODS = ["none", "mmr", "cross_encoder"]
+
+
+def load_questions(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def sample_questions(n):
+    """Recall proxy: one sentence from each of n random chunks."""
+    docs = [
+        d
+        for vs in core.list_partitions()
+        for d in vs._collection.get(include=["documents"])["documents"]
+        if d and len(d) > 200
+    ]
+    random.seed(0)
+    questions = []
+    for text in random.sample(docs, min(n, len(docs))):
+        sentences = [s.strip() for s in text.split(".") if len(s.strip()) > 40]
+        if sentences:
+            questions.append({"question": random.choice(sentences), "answer_contains": text[:200]})
+    return questions
+
+
+def run(questions):
+    # Warm the embedding cache so timings measure retrieval + rerank, not Ollama.
+    for q in questions:
+        core.ensure_embeddings().embed_query(q["question"])
+
+    methods = list(METHODS)
+    if core.reranker._get_cross_encoder() is None:
+        # retrieve_scored would silently fall back to MMR and report it as cross_encoder
+        methods.remove("cross_encoder")
+        print(f"skipping cross_encoder: {core.RERANK_MODEL} could not be loaded (is sentence-transformers installed?)\n")
+
+    baseline = {}
+    print(f"{'method':<14}{'hit@k':>8}{'sources':>9}{'mean ms':>10}{'p95 ms':>9}{'+ms':>8}")
+    for method in methods:
+        hits, sources, times = 0, [], []
+        for q in questions:
+            started = time.perf_counter()
+            scored = core.retrieve_scored(q["question"], rerank=method)
+            times.append((time.perf_counter() - started) * 1000)
+            needle = q["answer_contains"].lower()
+            hits += any(needle in d.page_content.lower() for d, _ in scored)
+            sources.append(len({d.metadata.get("source") for d, _ in scored}))
+        mean = statistics.mean(times)
+        p95 = sorted(times)[int(0.95 * (len(times) - 1))]
+        baseline.setdefault("mean", mean)
+        print(
+            f"{method:<14}{hits / len(questions):>8.2f}{statistics.mean(sources):>9.2f}"
+            f"{mean:>10.1f}{p95:>9.1f}{mean - baseline['mean']:>8.1f}"
+        )
+    print(f"\nreranker stats: {core.reranker.stats}")
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    n = 30
+    if "--n" in args:
+        i = args.index("--n")
+        n = int(args[i + 1])
+        del args[i:i + 2]
+    questions = load_questions(args[0]) if args else sample_questions(n)
+    if not questions:
+        sys.exit("No questions (upload documents first or pass a questions JSONL file).")
+    run(questions)
@@ -4,207 +4,3116 @@ used by the Streamlit UI. This module contains embedding/LLM setup,
 vectorstore helpers, state management and text extraction.
 """
 
+import asyncio
+import hashlib
 import io
 import json
+import multiprocessing
 import os
+import shutil
+import sqlite3
+import tempfile
+import threading
 import time
-from typing import List, Optional, Any, Dict
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from typing import TYPE_CHECKING, List, Optional, Any, Dict, Tuple, Callable, Iterator, AsyncIterator
 
-from pypdf import PdfReader
-from docx import Document as DocxDocument
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+import httpx
+from pydantic import BaseModel, Field, ValidationError
+import re
+import math
+
+# pypdf, python-docx, the text splitter, Chroma (chromadb), langchain_ollama and
+# numpy are imported where they are first needed: most Streamlit reruns and API
+# boots never touch them. benchmarks/import_time.py tracks the import cost.
+if TYPE_CHECKING:
+    from langchain_chroma import Chroma
+    from langchain_ollama import ChatOllama, OllamaEmbeddings
+
+# ----------------------------
+# Config (LOCAL)
+# ----------------------------
+OLLAMA_BASE_URL = "http://127.0.0.1:11434"
+LLM_MODEL = "mistral"  # Changed from llama3.2:1b for better JSON output
+# Use the exact tag shown by `ollama list` for the embeddings model
+# (e.g. `nomic-embed-text:latest`) to avoid "model not found" errors.
+EMBED_MODEL = "mxbai-embed-large"  # Better quality embeddings (free via Ollama)
+# Ollama HTTP: all sync clients share one keep-alive connection pool; connection
+# errors and 429/502/503/504 are retried with exponential backoff
+OLLAMA_MAX_CONNECTIONS = 16
+OLLAMA_MAX_KEEPALIVE = 8
+OLLAMA_CONNECT_TIMEOUT_S = 5.0
+OLLAMA_READ_TIMEOUT_S = 300.0  # per read; generous for a cold model load
+OLLAMA_RETRIES = 3
+OLLAMA_RETRY_BACKOFF_S = 0.5
+# Seconds Ollama keeps the models loaded after a request (-1 = until it stops)
+OLLAMA_KEEP_ALIVE = 1800
+
+PERSIST_DIR = "./chroma_db"
+COLLECTION = "study_rag"
+# Vectors are partitioned: one collection per note (COLLECTION__<note_id>, created
+# lazily) plus COLLECTION__shared for uploads without a note. All-notes queries
+# search the partitions concurrently and merge by relevance.
+SHARED_PARTITION = "shared"
+PARTITION_SEARCH_WORKERS = 8
+TOP_K = 5
+DATA_DIR = "./data"
+STATE_PATH = os.path.join(DATA_DIR, "state.json")  # legacy, migrated into STATE_DB_PATH
+STATE_DB_PATH = os.path.join(DATA_DIR, "state.sqlite3")
+MANIFEST_PATH = os.path.join(DATA_DIR, "manifest.json")
+
+CHUNK_SIZE = 900
+CHUNK_OVERLAP = 150
+
+# Prompt context: retrieved chunks are de-overlapped, merged with neighbours from
+# the same source and packed in relevance order up to this many (estimated) tokens
+CONTEXT_TOKEN_BUDGET = 1_200
+CHARS_PER_TOKEN = 4
+
+# Ingestion: chunks per embedding request, concurrent requests to Ollama,
+# and rows per bulk Chroma upsert
+EMBED_BATCH_SIZE = 32
+EMBED_MAX_WORKERS = 4
+CHROMA_WRITE_BATCH = 512
+
+# Text extraction: worker processes and PDF pages per extraction task
+EXTRACT_MAX_WORKERS = os.cpu_count() or 1
+PDF_PAGES_PER_TASK = 20
+
+# Retrieval: "hybrid" (BM25 + dense, reciprocal-rank fused), "dense", or
+# "lexical" (BM25 only; no embedding call). The BM25 index lives next to Chroma.
+RETRIEVAL_MODE = "hybrid"
+RRF_K = 60
+LEXICAL_INDEX_PATH = os.path.join(PERSIST_DIR, "lexical.sqlite3")
+
+# Reranking: fetch RERANK_CANDIDATES cheaply, then keep the best TOP_K by
+# "mmr" (diversity over the stored vectors), "cross_encoder" (needs
+# sentence-transformers; falls back to mmr) or "none". Reranking is truncated to
+# fit RERANK_BUDGET_MS and skipped while RERANK_MAX_INFLIGHT reranks are running.
+RERANK_MODE = "mmr"
+RERANK_CANDIDATES = 50
+RERANK_BUDGET_MS = 150
+RERANK_MAX_INFLIGHT = 4
+MMR_LAMBDA = 0.7
+RERANK_MODEL = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+
+# Summary tree: chunks per section summary, and whether uploads build it in the background
+SUMMARY_SECTION_CHUNKS = 5
+SUMMARY_ON_INGEST = True
+
+# Generators (quiz, flashcards, mind map): pass a JSON schema to Ollama and
+# validate per item, re-asking only for failed items up to STRUCTURED_MAX_RETRIES
+STRUCTURED_OUTPUT = True
+STRUCTURED_MAX_RETRIES = 2
+
+# Quiz generation: questions per LLM call (plus spares to absorb duplicates),
+# concurrent calls, and word overlap at which two questions count as duplicates
+QUIZ_BATCH_SIZE = 5
+QUIZ_BATCH_SPARE = 1
+QUIZ_MAX_WORKERS = 4
+QUIZ_DEDUP_THRESHOLD = 0.8
+# Extra single-batch calls asking only for the questions still missing after dedup
+QUIZ_TOPUP_ROUNDS = 2
+
+# Background jobs: worker threads per process, idle poll interval, how long
+# finished jobs are kept, and where queued uploads wait to be indexed
+JOB_WORKERS = 2
+JOB_POLL_S = 1.0
+JOB_TTL_S = 7 * 24 * 3600
+JOB_UPLOAD_DIR = os.path.join(DATA_DIR, "uploads")
+
+# Warm-up at startup: load both models into Ollama, open the indexes and run one
+# synthetic retrieval so the first real question doesn't pay for it
+WARMUP_QUERY = "What are the key ideas in these notes?"
+
+# Semantic answer cache: cosine similarity needed for a hit, entry lifetime, size cap
+ANSWER_CACHE_THRESHOLD = 0.95
+ANSWER_CACHE_TTL_S = 24 * 3600
+ANSWER_CACHE_MAX_ENTRIES = 1_000
+
+# Tool routing: decisions are logged here; the embedding tie-breaker needs this
+# cosine margin between "calculator" and "none" prototypes to decide on its own
+ROUTING_LOG_PATH = os.path.join(DATA_DIR, "routing_log.jsonl")
+ROUTER_USE_EMBEDDINGS = True
+ROUTER_EMBED_MARGIN = 0.05
+
+# Multi-agent answers: "fused" (facts + explanation in one generation) or
+# "two_pass" (Researcher call, then Teacher call). Either way the Researcher is
+# skipped ("fast" path) when the best chunk's relevance reaches FAST_PATH_MIN_SCORE.
+AGENT_MODE = "fused"
+FAST_PATH_MIN_SCORE = 0.75
+
+# Max LLM generations in flight from the async (FastAPI) path; extra requests queue FIFO
+LLM_MAX_CONCURRENCY = 4
+
+# Embedding cache (SQLite file next to PERSIST_DIR + small in-memory LRU in front)
+EMBED_CACHE_PATH = "./embed_cache.sqlite3"
+EMBED_CACHE_MAX_ENTRIES = 200_000
+EMBED_CACHE_MEMORY_ENTRIES = 2_048
+
+
+# LLM, embeddings and vectorstore partitions live in `resources` (see ResourcePool)
+emb_cache: Optional["EmbeddingCache"] = None
+
+chroma_client: Any = None
+_vectorstore_lock = threading.RLock()
+_rebuilding_generation: Optional[int] = None
+_partition_cache: Optional[Tuple[int, List[Tuple[str, int]]]] = None  # (corpus version, partitions)
+partition_pool: Optional[ThreadPoolExecutor] = None
+lexical_index: Optional["LexicalIndex"] = None
+_lexical_lock = threading.Lock()
+state_db: Optional[sqlite3.Connection] = None
+_state_lock = threading.RLock()
+manifest_cache: Optional[Dict[str, Any]] = None
+_manifest_stamp: Optional[Tuple[int, int]] = None
+_index_lock = threading.Lock()
+extract_pool: Optional[ProcessPoolExecutor] = None
+_extract_pool_lock = threading.Lock()
+_llm_semaphore: Optional[Tuple[asyncio.AbstractEventLoop, asyncio.Semaphore]] = None
+summary_pool: Optional[ThreadPoolExecutor] = None
+# Bumped whenever this process changes a corpus version or a summary status: a
+# cache key that costs no database read (changes made by other processes are not counted)
+local_version = 0
+_summary_pool_lock = threading.Lock()
+_parse_stats_lock = threading.Lock()
+parse_stats: Dict[str, Dict[str, int]] = {}
+_job_threads: List[threading.Thread] = []
+_job_lock = threading.Lock()
+_job_wakeup = threading.Event()
+
+
+# ----------------------------
+# Helpers
+# ----------------------------
+class StreamingJSONParser:
+    """Single-pass, tolerant JSON parser for LLM output fed token by token.
+
+    Skips prose and code fences around the first object/array, and accepts
+    trailing commas, single-quoted strings and unquoted keys or words. Every
+    object that closes directly inside a top-level array (or an array that is
+    a value of the top-level object, as in {"quiz": [...]}) is returned from
+    feed() as soon as its closing brace arrives.
+    """
+
+    _ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "b": "\b", "f": "\f"}
+
+    def __init__(self):
+        self.items: List[Dict[str, Any]] = []
+        self._stack: List[Any] = []
+        self._keys: List[Optional[str]] = []
+        self._root: Any = None
+        self._fallback: Any = None
+        self._done = False
+        self._quote: Optional[str] = None
+        self._escape = False
+        self._unicode: Optional[str] = None
+        self._maybe_close = False
+        self._buf: List[str] = []
+        self._scalar: List[str] = []
+        self._new: List[Dict[str, Any]] = []
+
+    def feed(self, text: str) -> List[Dict[str, Any]]:
+        """Consume more text; returns the items completed by it."""
+        for ch in text:
+            if self._done:
+                break
+            if self._quote:
+                self._string_char(ch)
+            elif self._stack:
+                self._structure_char(ch)
+            elif ch in "{[":
+                self._open({} if ch == "{" else [])
+        new, self._new = self._new, []
+        return new
+
+    def result(self) -> Any:
+        """The top-level value; containers left open by a truncated stream are closed."""
+        if not self._done and self._stack:
+            if self._quote:
+                self._end_string()
+            self._flush_scalar()
+            while self._stack and not self._done:
+                self._close()
+        return self._root if self._root is not None else self._fallback
+
+    def _string_char(self, ch: str) -> None:
+        if self._maybe_close:
+            self._maybe_close = False
+            # An apostrophe followed by a delimiter ends a single-quoted string;
+            # otherwise it is part of the text ("don't").
+            if ch in ",:}] \n\t\r":
+                self._end_string()
+                self._structure_char(ch)
+                return
+            self._buf.append("'")
+        if self._unicode is not None:
+            self._unicode += ch
+            if len(self._unicode) == 4:
+                try:
+                    self._buf.append(chr(int(self._unicode, 16)))
+                except ValueError:
+                    self._buf.append("\\u" + self._unicode)
+                self._unicode = None
+        elif self._escape:
+            self._escape = False
+            if ch == "u":
+                self._unicode = ""
+            else:
+                self._buf.append(self._ESCAPES.get(ch, ch))
+        elif ch == "\\":
+            self._escape = True
+        elif ch == self._quote:
+            if ch == "'":
+                self._maybe_close = True
+            else:
+                self._end_string()
+        else:
+            self._buf.append(ch)
+
+    def _end_string(self) -> None:
+        self._quote = None
+        self._maybe_close = False
+        value = "".join(self._buf)
+        self._buf = []
+        self._add(value)
+
+    def _structure_char(self, ch: str) -> None:
+        if ch in "\"'":
+            self._flush_scalar()
+            self._quote = ch
+        elif ch in "{[":
+            self._flush_scalar()
+            self._open({} if ch == "{" else [])
+        elif ch in "}]":
+            self._flush_scalar()
+            self._close()
+        elif ch in ",: \n\t\r`":
+            self._flush_scalar()
+        else:
+            self._scalar.append(ch)
+
+    def _flush_scalar(self) -> None:
+        if not self._scalar:
+            return
+        token = "".join(self._scalar)
+        self._scalar = []
+        low = token.lower()
+        if low in ("true", "false"):
+            self._add(low == "true")
+        elif low in ("null", "none"):
+            self._add(None)
+        else:
+            try:
+                self._add(int(token))
+            except ValueError:
+                try:
+                    self._add(float(token))
+                except ValueError:
+                    self._add(token)
+
+    def _open(self, container: Any) -> None:
+        self._stack.append(container)
+        self._keys.append(None)
+
+    def _close(self) -> None:
+        container = self._stack.pop()
+        self._keys.pop()
+        if not self._stack:
+            if isinstance(container, dict) or self.items or any(isinstance(v, (dict, list)) for v in container):
+                self._root = container
+                self._done = True
+            else:
+                # A bracketed aside in prose ("[1]"): remember it, keep looking.
+                self._fallback = container
+            return
+        parent_is_item_list = isinstance(self._stack[-1], list) and (
+            len(self._stack) == 1 or (len(self._stack) == 2 and isinstance(self._stack[0], dict))
+        )
+        if isinstance(container, dict) and parent_is_item_list:
+            self.items.append(container)
+            self._new.append(container)
+        self._add(container)
+
+    def _add(self, value: Any) -> None:
+        if not self._stack:
+            return
+        top = self._stack[-1]
+        if isinstance(top, list):
+            top.append(value)
+        elif self._keys[-1] is None:
+            self._keys[-1] = str(value)
+        else:
+            top[self._keys[-1]] = value
+            self._keys[-1] = None
+
+
+def parse_json_loose(text: str) -> Any:
+    """Best-effort JSON extraction from LLM output."""
+    parser = StreamingJSONParser()
+    parser.feed(text)
+    value = parser.result()
+    if value is None:
+        return {"raw": text, "error": "Invalid JSON from model"}
+    return value
+
+
+def retrieve_docs(retriever, query: str):
+    """LangChain version compatibility: some retrievers use .invoke()."""
+    if hasattr(retriever, "get_relevant_documents"):
+        return retriever.get_relevant_documents(query)
+    return retriever.invoke(query)
+
+
+def extract_text(filename: str, data: bytes) -> str:
+    name = filename.lower()
+
+    if name.endswith(".pdf"):
+        from pypdf import PdfReader
+
+        reader = PdfReader(io.BytesIO(data))
+        return "\n".join([(p.extract_text() or "") for p in reader.pages]).strip()
+
+    if name.endswith(".docx"):
+        from docx import Document as DocxDocument
+
+        doc = DocxDocument(io.BytesIO(data))
+        return "\n".join([p.text for p in doc.paragraphs]).strip()
+
+    # txt/md/anything else -> treat as text
+    return data.decode("utf-8", errors="ignore").strip()
+
+
+# ----------------------------
+# Parallel extraction
+# ----------------------------
+def _extract_pdf_pages(path: str, start: int, end: int) -> str:
+    """Process-pool task: text of pages [start, end) of the PDF at `path`."""
+    from pypdf import PdfReader
+
+    reader = PdfReader(path)
+    return "\n".join([(reader.pages[i].extract_text() or "") for i in range(start, end)])
+
+
+def get_extract_pool() -> ProcessPoolExecutor:
+    global extract_pool
+    with _extract_pool_lock:
+        if extract_pool is None:
+            # Never fork: the parent runs job, summary and HTTP threads whose
+            # held locks would be copied into the child locked forever
+            extract_pool = ProcessPoolExecutor(
+                max_workers=EXTRACT_MAX_WORKERS, mp_context=multiprocessing.get_context("spawn")
+            )
+        return extract_pool
+
+
+def extract_many(files: List[Tuple[str, bytes]]) -> Iterator[Tuple[str, str]]:
+    """Yield (filename, text) for each file in input order.
+
+    PDF and DOCX parsing fans out across a process pool; large PDFs are split
+    into PDF_PAGES_PER_TASK page ranges. Each file is yielded as soon as it and
+    every file before it are done, so chunking can start early.
+    """
+    plan: List[Tuple[str, bytes, int, int]] = []  # (name, data, pdf pages, pool tasks)
+    for name, data in files:
+        lower = name.lower()
+        if lower.endswith(".pdf"):
+            from pypdf import PdfReader
+
+            n_pages = len(PdfReader(io.BytesIO(data)).pages)
+            plan.append((name, data, n_pages, max(1, math.ceil(n_pages / PDF_PAGES_PER_TASK))))
+        elif lower.endswith(".docx"):
+            plan.append((name, data, 0, 1))
+        else:
+            plan.append((name, data, 0, 0))
+
+    if sum(p[3] for p in plan) <= 1 or EXTRACT_MAX_WORKERS <= 1:
+        for name, data, _, _ in plan:
+            yield name, extract_text(name, data)
+        return
+
+    pool = get_extract_pool()
+    tmp_paths: List[str] = []
+    submitted: List[List[Any]] = []
+    try:
+        for name, data, n_pages, tasks in plan:
+            if tasks > 1:
+                # Shards read the PDF from disk instead of each pickling the full bytes
+                with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp:
+                    tmp.write(data)
+                tmp_paths.append(tmp.name)
+                submitted.append([
+                    pool.submit(_extract_pdf_pages, tmp.name, i, min(i + PDF_PAGES_PER_TASK, n_pages))
+                    for i in range(0, n_pages, PDF_PAGES_PER_TASK)
+                ])
+            elif tasks == 1:
+                submitted.append([pool.submit(extract_text, name, data)])
+            else:
+                submitted.append([])
+
+        for (name, data, _, _), futures in zip(plan, submitted):
+            if not futures:
+                yield name, extract_text(name, data)
+            else:
+                yield name, "\n".join(f.result() for f in futures).strip()
+    finally:
+        for futures in submitted:
+            for f in futures:
+                f.cancel()
+        for path in tmp_paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+# ----------------------------
+# Embedding cache
+# ----------------------------
+class EmbeddingCache:
+    """Disk-backed LRU of embedding vectors keyed by (model, sha256(text)).
+
+    Hot entries are also kept in an in-memory LRU so repeated queries skip
+    both Ollama and SQLite.
+    """
+
+    def __init__(
+        self,
+        path: str = EMBED_CACHE_PATH,
+        max_entries: int = EMBED_CACHE_MAX_ENTRIES,
+        memory_entries: int = EMBED_CACHE_MEMORY_ENTRIES,
+    ):
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self._memory: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings(last_used)")
+        self._conn.commit()
+        self._count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    @staticmethod
+    def key(model: str, text: str) -> str:
+        return f"{model}:{content_digest(text.encode('utf-8'))}"
+
+    def _remember(self, key: str, vector: List[float]) -> None:
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        found: Dict[str, List[float]] = {}
+        with self._lock:
+            missing = []
+            for k in keys:
+                if k in self._memory:
+                    self._memory.move_to_end(k)
+                    found[k] = self._memory[k]
+                else:
+                    missing.append(k)
+            if not missing:
+                return found
+            now = time.time()
+            for i in range(0, len(missing), 500):
+                part = missing[i : i + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(part))})",
+                    part,
+                ).fetchall()
+                for k, blob in rows:
+                    vector = array("f", blob).tolist()
+                    found[k] = vector
+                    self._remember(k, vector)
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE key = ?", [(now, k) for k, _ in rows]
+                )
+            self._conn.commit()
+        return found
+
+    def put_many(self, items: Dict[str, List[float]]) -> None:
+        if not items:
+            return
+        now = time.time()
+        with self._lock:
+            cur = self._conn.executemany(
+                "INSERT OR IGNORE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                [(k, array("f", v).tobytes(), now) for k, v in items.items()],
+            )
+            self._count += max(cur.rowcount, 0)
+            for k, v in items.items():
+                self._remember(k, v)
+            if self._count > self.max_entries:
+                # Evict least-recently-used rows down to 90% of the cap
+                excess = self._count - int(self.max_entries * 0.9)
+                self._conn.execute(
+                    "DELETE FROM embeddings WHERE key IN "
+                    "(SELECT key FROM embeddings ORDER BY last_used ASC LIMIT ?)",
+                    (excess,),
+                )
+                self._count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            self._conn.commit()
+
+
+class CachedEmbeddings(Embeddings):
+    """Wraps an embeddings client so each distinct text is embedded once per model."""
+
+    def __init__(self, inner: "OllamaEmbeddings", cache: EmbeddingCache):
+        self.inner = inner
+        self.cache = cache
+        self.model = inner.model
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [EmbeddingCache.key(self.model, t) for t in texts]
+        found = self.cache.get_many(keys)
+        todo: Dict[str, str] = {}
+        for k, t in zip(keys, texts):
+            if k not in found:
+                todo.setdefault(k, t)
+        if todo:
+            vectors = self.inner.embed_documents(list(todo.values()))
+            fresh = dict(zip(todo.keys(), vectors))
+            self.cache.put_many(fresh)
+            found.update(fresh)
+        return [found[k] for k in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        k = EmbeddingCache.key(self.model, text)
+        hit = self.cache.get_many([k]).get(k)
+        if hit is not None:
+            return hit
+        vector = self.inner.embed_query(text)
+        self.cache.put_many({k: vector})
+        return vector
+
+    async def aembed_query(self, text: str) -> List[float]:
+        k = EmbeddingCache.key(self.model, text)
+        hit = self.cache.get_many([k]).get(k)
+        if hit is not None:
+            return hit
+        vector = await self.inner.aembed_query(text)
+        self.cache.put_many({k: vector})
+        return vector
+
+
+def get_embedding_cache() -> EmbeddingCache:
+    global emb_cache
+    if emb_cache is None:
+        emb_cache = EmbeddingCache()
+    return emb_cache
+
+
+# ----------------------------
+# Ollama HTTP transport
+# ----------------------------
+_RETRY_STATUSES = {429, 502, 503, 504}
+_RETRY_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.RemoteProtocolError)
+
+
+def _backoff(attempt: int) -> float:
+    return OLLAMA_RETRY_BACKOFF_S * (2 ** attempt)
+
+
+class RetryTransport(httpx.BaseTransport):
+    """Retries transient failures (refused/dropped connections, busy server)
+    before any of the response body has been consumed."""
+
+    def __init__(self, inner: httpx.BaseTransport, retries: int = OLLAMA_RETRIES):
+        self.inner = inner
+        self.retries = retries
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.inner.handle_request(request)
+            except _RETRY_ERRORS:
+                if attempt == self.retries:
+                    raise
+            else:
+                if response.status_code not in _RETRY_STATUSES or attempt == self.retries:
+                    return response
+                response.close()
+            time.sleep(_backoff(attempt))
+        raise AssertionError("unreachable")
+
+    def close(self) -> None:
+        self.inner.close()
+
+
+class AsyncRetryTransport(httpx.AsyncBaseTransport):
+    """Async counterpart of RetryTransport."""
+
+    def __init__(self, inner: httpx.AsyncBaseTransport, retries: int = OLLAMA_RETRIES):
+        self.inner = inner
+        self.retries = retries
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        for attempt in range(self.retries + 1):
+            try:
+                response = await self.inner.handle_async_request(request)
+            except _RETRY_ERRORS:
+                if attempt == self.retries:
+                    raise
+            else:
+                if response.status_code not in _RETRY_STATUSES or attempt == self.retries:
+                    return response
+                await response.aclose()
+            await asyncio.sleep(_backoff(attempt))
+        raise AssertionError("unreachable")
+
+    async def aclose(self) -> None:
+        await self.inner.aclose()
+
+
+def _ollama_limits() -> httpx.Limits:
+    return httpx.Limits(max_connections=OLLAMA_MAX_CONNECTIONS, max_keepalive_connections=OLLAMA_MAX_KEEPALIVE)
+
+
+def _ollama_timeout() -> httpx.Timeout:
+    return httpx.Timeout(OLLAMA_READ_TIMEOUT_S, connect=OLLAMA_CONNECT_TIMEOUT_S)
+
+
+def get_ollama_transport() -> RetryTransport:
+    """The process-wide pooled keep-alive transport for synchronous Ollama calls."""
+    return resources.get(
+        ("transport", OLLAMA_BASE_URL, ""),
+        lambda: RetryTransport(httpx.HTTPTransport(limits=_ollama_limits())),
+    )
+
+
+def ollama_kwargs() -> Dict[str, Any]:
+    """Connection settings shared by every ChatOllama / OllamaEmbeddings in core.
+
+    Async clients get their own pool each (httpx async pools are bound to an
+    event loop), but since clients are shared that is still one pool per model.
+    """
+    return {
+        "base_url": OLLAMA_BASE_URL,
+        "keep_alive": OLLAMA_KEEP_ALIVE,
+        "client_kwargs": {"timeout": _ollama_timeout()},
+        "sync_client_kwargs": {"transport": get_ollama_transport()},
+        "async_client_kwargs": {"transport": AsyncRetryTransport(httpx.AsyncHTTPTransport(limits=_ollama_limits()))},
+    }
+
+
+def get_ollama_http() -> httpx.Client:
+    """Plain HTTP client on the shared transport, for Ollama's metadata endpoints."""
+    return resources.get(
+        ("http", OLLAMA_BASE_URL, ""),
+        lambda: httpx.Client(base_url=OLLAMA_BASE_URL, transport=get_ollama_transport(), timeout=_ollama_timeout()),
+    )
+
+
+def _model_tag(name: str) -> str:
+    return name if ":" in name else f"{name}:latest"
+
+
+def ollama_models() -> Optional[set]:
+    """Model tags Ollama has pulled (GET /api/tags), or None if it is unreachable."""
+    try:
+        res = get_ollama_http().get("/api/tags")
+        res.raise_for_status()
+        return {_model_tag(m["name"]) for m in res.json().get("models", [])}
+    except (httpx.HTTPError, ValueError, KeyError):
+        return None
+# ----------------------------
+# Shared clients (LLM, embeddings, vectorstore partitions)
+# ----------------------------
+class ResourcePool:
+    """Thread-safe pool of shared client handles keyed by (kind, model, scope),
+    e.g. ("vectorstore", EMBED_MODEL, collection) or ("llm", LLM_MODEL, "").
+
+    Each handle is created once (concurrent first callers wait for the same
+    build) and shared by all threads and Streamlit sessions. `lease()` counts
+    a caller as a reader for the duration of a block; `retire()` takes a key
+    out of service so new callers no longer get it, and runs its `close` once
+    the last reader is done, so in-flight queries finish on the old handle.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._live: Dict[Tuple[str, str, str], Dict[str, Any]] = {}
+        self._building: Dict[Tuple[str, str, str], threading.Lock] = {}
+        self._retired: set = set()
+        self._draining: List[Dict[str, Any]] = []
+
+    def _slot(self, key: Tuple[str, str, str], factory: Callable[[], Any]) -> Dict[str, Any]:
+        with self._lock:
+            slot = self._live.get(key)
+            if slot is not None:
+                return slot
+            if key in self._retired:
+                raise LookupError(f"Retired resource: {key}")
+            build_lock = self._building.setdefault(key, threading.Lock())
+        with build_lock:
+            with self._lock:
+                slot = self._live.get(key)
+                if slot is not None:
+                    return slot
+            value = factory()
+            with self._lock:
+                self._building.pop(key, None)
+                if key in self._retired:
+                    raise LookupError(f"Retired resource: {key}")
+                slot = self._live[key] = {"key": key, "value": value, "refs": 0, "close": None}
+                return slot
+
+    def get(self, key: Tuple[str, str, str], factory: Callable[[], Any]) -> Any:
+        """The shared handle for `key`, created with `factory` on first use."""
+        return self._slot(key, factory)["value"]
+
+    @contextmanager
+    def lease(self, key: Tuple[str, str, str], factory: Callable[[], Any]) -> Iterator[Any]:
+        slot = self._slot(key, factory)
+        with self._lock:
+            if self._live.get(key) is not slot:
+                raise LookupError(f"Retired resource: {key}")
+            slot["refs"] += 1
+        try:
+            yield slot["value"]
+        finally:
+            with self._lock:
+                slot["refs"] -= 1
+                drained = slot["refs"] == 0 and slot in self._draining
+                if drained:
+                    self._draining.remove(slot)
+            if drained:
+                self._close(key, slot["close"])
+
+    def retire(self, key: Tuple[str, str, str], close: Optional[Callable[[], None]] = None) -> None:
+        """Stop handing out `key`; `close` runs now, or when its last lease ends."""
+        with self._lock:
+            self._retired.add(key)
+            slot = self._live.pop(key, None)
+            if slot is not None and slot["refs"]:
+                slot["close"] = close
+                self._draining.append(slot)
+                return
+        self._close(key, close)
+
+    def _close(self, key: Tuple[str, str, str], close: Optional[Callable[[], None]]) -> None:
+        try:
+            if close:
+                close()
+        finally:
+            # Once closed, the key may be created afresh (e.g. a later rebuild reusing the name)
+            with self._lock:
+                self._retired.discard(key)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "live": sorted("/".join(k for k in key if k) for key in self._live),
+                "leases": sum(slot["refs"] for slot in self._live.values()),
+                "draining": len(self._draining),
+            }
+
+
+resources = ResourcePool()
+
+
+def _open_embeddings() -> CachedEmbeddings:
+    from langchain_ollama import OllamaEmbeddings
+
+    # Checking the pulled models is a cheap metadata call; embedding a probe
+    # string used to load the model just to find out. If Ollama is down we
+    # cannot tell, so keep EMBED_MODEL rather than switch vector spaces.
+    models = ollama_models()
+    model = EMBED_MODEL if models is None or _model_tag(EMBED_MODEL) in models else LLM_MODEL
+    return CachedEmbeddings(OllamaEmbeddings(model=model, **ollama_kwargs()), get_embedding_cache())
+
+
+def ensure_embeddings() -> CachedEmbeddings:
+    """Use EMBED_MODEL if available; fallback to LLM_MODEL for embeddings."""
+    return resources.get(("embeddings", EMBED_MODEL, ""), _open_embeddings)
+
+
+def _open_llm(**kwargs: Any) -> "ChatOllama":
+    from langchain_ollama import ChatOllama
+
+    return ChatOllama(model=LLM_MODEL, **kwargs, **ollama_kwargs())
+
+
+def get_llm() -> "ChatOllama":
+    """Shared ChatOllama instance for LLM_MODEL."""
+    return resources.get(("llm", LLM_MODEL, ""), _open_llm)
+
+
+def stream_llm(prompt: str) -> Iterator[str]:
+    """Yield the completion for `prompt` piece by piece as Ollama produces it."""
+    for chunk in get_llm().stream(prompt):
+        if chunk.content:
+            yield chunk.content
+
+
+# ----------------------------
+# Vector partitions
+# ----------------------------
+def partition_name(note_id: Optional[str], generation: int = 0) -> str:
+    """Chroma collection holding a note's chunks (uploads without a note share one).
+
+    A full rebuild writes into the next generation (`<name>.<n>`) while readers
+    stay on the current one.
+    """
+    suffix = re.sub(r"[^A-Za-z0-9_-]", "-", note_id) if note_id else SHARED_PARTITION
+    name = f"{COLLECTION}__{suffix}"
+    return f"{name}.{generation}" if generation else name
+
+
+def get_chroma_client() -> Any:
+    """One persistent Chroma client for all partitions; migrates the old single
+    collection into per-note partitions the first time."""
+    global chroma_client
+    with _vectorstore_lock:
+        if chroma_client is None:
+            import chromadb
+
+            chroma_client = chromadb.PersistentClient(path=PERSIST_DIR)
+            _migrate_global_collection(chroma_client)
+        return chroma_client
+
+
+def _partition_collections(refresh: bool = False) -> List[Tuple[str, int]]:
+    """(collection name, generation) of every partition on disk.
+
+    Listed once per corpus version (every ingest, in any process, bumps it and
+    is the only way partitions appear), not on every query.
+    """
+    global _partition_cache
+    version = corpus_version()
+    cached = _partition_cache
+    if refresh or cached is None or cached[0] != version:
+        prefix = f"{COLLECTION}__"
+        found = []
+        for c in get_chroma_client().list_collections():
+            name = getattr(c, "name", c)
+            if name.startswith(prefix):
+                gen = name.rpartition(".")[2] if "." in name else "0"
+                found.append((name, int(gen) if gen.isdigit() else 0))
+        _partition_cache = cached = (version, sorted(found))
+    return cached[1]
+
+
+def current_generation() -> int:
+    """Generation readers use: the newest on disk, unless it is still being built here."""
+    return max((gen for _, gen in _partition_collections() if gen != _rebuilding_generation), default=0)
+
+
+def partition_names(note_id: Optional[str] = None) -> List[str]:
+    """Collections to search: the note's partition, or every partition."""
+    gen = current_generation()
+    if note_id:
+        return [partition_name(note_id, gen)]
+    return [name for name, g in _partition_collections() if g == gen]
+
+
+def _partition_key(name: str) -> Tuple[str, str, str]:
+    return ("vectorstore", EMBED_MODEL, name)
+
+
+def _partition_factory(name: str) -> Callable[[], "Chroma"]:
+    from langchain_chroma import Chroma
+
+    # Resolve the client and embeddings before the pool's per-key build lock is taken
+    client, embeddings = get_chroma_client(), ensure_embeddings()
+    return lambda: Chroma(client=client, collection_name=name, embedding_function=embeddings)
+
+
+def _partition(name: str) -> "Chroma":
+    return resources.get(_partition_key(name), _partition_factory(name))
+
+
+def lease_partition(name: str):
+    """Context manager holding a partition handle; a retired partition is only
+    dropped once every lease on it is released."""
+    return resources.lease(_partition_key(name), _partition_factory(name))
+
+
+def ensure_vectorstore(note_id: Optional[str] = None, generation: Optional[int] = None) -> "Chroma":
+    """Router: the (lazily created, shared) partition for a note, or the shared
+    partition for uploads without a note."""
+    return _partition(partition_name(note_id, current_generation() if generation is None else generation))
+
+
+def list_partitions() -> List["Chroma"]:
+    """Every note partition of the current generation, for all-notes queries."""
+    return [_partition(name) for name in partition_names()]
+
+
+def begin_rebuild() -> int:
+    """Start a full rebuild into a new generation; readers keep the current one."""
+    global _rebuilding_generation
+    with _vectorstore_lock:
+        _rebuilding_generation = max((gen for _, gen in _partition_collections(refresh=True)), default=0) + 1
+        return _rebuilding_generation
+
+
+def finish_rebuild(generation: int, ok: bool = True) -> None:
+    """Publish a rebuilt generation (or abandon it) and retire the other one.
+
+    Retired partitions are deleted once their last reader releases them.
+    """
+    global _rebuilding_generation, _partition_cache
+    client = get_chroma_client()
+    with _vectorstore_lock:
+        _rebuilding_generation = None
+        for name, gen in _partition_collections(refresh=True):
+            if (gen != generation) if ok else (gen == generation):
+                resources.retire(_partition_key(name), close=lambda n=name: client.delete_collection(n))
+        _partition_cache = None
+
+
+def _migrate_global_collection(client: Any) -> None:
+    """Move chunks of the pre-partitioning `COLLECTION` into per-note partitions."""
+    if COLLECTION not in {getattr(c, "name", c) for c in client.list_collections()}:
+        return
+    legacy = client.get_collection(COLLECTION)
+    offset = 0
+    while True:
+        got = legacy.get(
+            include=["embeddings", "documents", "metadatas"], limit=CHROMA_WRITE_BATCH, offset=offset
+        )
+        if not len(got["ids"]):
+            break
+        groups: Dict[str, Dict[str, list]] = {}
+        for i, cid in enumerate(got["ids"]):
+            meta = got["metadatas"][i] or {}
+            rows = groups.setdefault(
+                partition_name(meta.get("note_id")), {"ids": [], "embeddings": [], "documents": [], "metadatas": []}
+            )
+            rows["ids"].append(cid)
+            rows["embeddings"].append(got["embeddings"][i])
+            rows["documents"].append(got["documents"][i])
+            rows["metadatas"].append(meta)
+        for name, rows in groups.items():
+            _partition(name)._collection.upsert(**rows)
+        offset += len(got["ids"])
+    client.delete_collection(COLLECTION)
+
+
+# ----------------------------
+# Context packing and retrieval
+# ----------------------------
+def format_context(docs: List[Document]) -> str:
+    return "\n\n".join(
+        [f"[{i+1}] {d.metadata.get('source','?')}\n{d.page_content}" for i, d in enumerate(docs)]
+    )
+
+
+def estimate_tokens(text: str) -> int:
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def _merge_spans(docs: List[Document]) -> List[Document]:
+    """Merge same-source chunks whose character spans touch or overlap, dropping
+    the repeated overlap. Chunks without a start_index are only de-duplicated."""
+    merged: List[Document] = []
+    for d in sorted(docs, key=lambda d: d.metadata["start_index"]):
+        start = d.metadata["start_index"]
+        if merged:
+            prev = merged[-1]
+            end = prev.metadata["start_index"] + len(prev.page_content)
+            if start <= end:
+                tail = d.page_content[end - start:]
+                merged[-1] = Document(page_content=prev.page_content + tail, metadata=prev.metadata)
+                continue
+        merged.append(d)
+    return merged
+
+
+def pack_context(docs: List[Document], budget: int = CONTEXT_TOKEN_BUDGET) -> List[Document]:
+    """Pick docs in relevance order while the packed context fits `budget` tokens.
+
+    Overlap between chunks of the same source is counted (and sent) once, and
+    neighbouring chunks are merged into one passage. Passages keep the order of
+    their most relevant chunk. The first doc is always kept, truncated if needed.
+    """
+    groups: Dict[Tuple[Any, ...], List[Document]] = {}
+    rank: Dict[Tuple[Any, ...], int] = {}
+    used = 0
+    seen = set()
+    for i, d in enumerate(docs):
+        if d.page_content in seen:
+            continue
+        if "start_index" in d.metadata:
+            key: Tuple[Any, ...] = (d.metadata.get("note_id"), d.metadata.get("source"))
+        else:
+            key = ("chunk", i)
+        trial = _merge_spans(groups.get(key, []) + [d]) if key[0] != "chunk" else [d]
+        cost = sum(estimate_tokens(m.page_content) for m in trial)
+        before = sum(estimate_tokens(m.page_content) for m in _merge_spans(groups[key])) if key in groups else 0
+        if used - before + cost > budget:
+            if not groups:
+                text = d.page_content[: budget * CHARS_PER_TOKEN]
+                return [Document(page_content=text, metadata=d.metadata)]
+            continue
+        groups.setdefault(key, []).append(d)
+        rank.setdefault(key, i)
+        used += cost - before
+        seen.add(d.page_content)
+
+    passages: List[Tuple[int, int, Document]] = []
+    for key, members in groups.items():
+        spans = _merge_spans(members) if key[0] != "chunk" else members
+        for m in spans:
+            passages.append((rank[key], m.metadata.get("start_index", 0), m))
+    passages.sort(key=lambda p: (p[0], p[1]))
+    return [m for _, _, m in passages]
+
+
+def _search_partition(name: str, vector: List[float], k: int) -> List[Tuple[Document, float]]:
+    with lease_partition(name) as vs:
+        hits = vs.similarity_search_by_vector_with_relevance_scores(vector, k=k)
+        to_relevance = vs._select_relevance_score_fn()
+    return [(d, to_relevance(distance)) for d, distance in hits]
+
+
+def get_partition_pool() -> ThreadPoolExecutor:
+    global partition_pool
+    with _vectorstore_lock:
+        if partition_pool is None:
+            partition_pool = ThreadPoolExecutor(max_workers=PARTITION_SEARCH_WORKERS, thread_name_prefix="partition")
+        return partition_pool
+
+
+def _search_by_vector(
+    vector: List[float], k: int, note_id: Optional[str], retry: bool = True
+) -> List[Tuple[Document, float]]:
+    """(doc, relevance in [0, 1]) pairs for a query vector, best first: the
+    note's partition, or all partitions searched concurrently and merged."""
+    global _partition_cache
+    try:
+        names = partition_names(note_id)
+        if len(names) <= 1:
+            return _search_partition(names[0], vector, k) if names else []
+        results = list(get_partition_pool().map(lambda name: _search_partition(name, vector, k), names))
+    except LookupError:
+        if not retry:
+            raise
+        # A rebuild was published mid-query: search the new generation instead (once)
+        _partition_cache = None
+        return _search_by_vector(vector, k, note_id, retry=False)
+    return sorted((hit for hits in results for hit in hits), key=lambda hit: hit[1], reverse=True)[:k]
+
+
+def get_stored_embeddings(docs: List[Document]) -> Dict[str, Any]:
+    """Stored vectors of already-indexed chunks, keyed by chunk ID."""
+    by_note: Dict[Optional[str], List[str]] = {}
+    for d in docs:
+        by_note.setdefault(d.metadata.get("note_id"), []).append(_doc_key(d))
+    stored: Dict[str, Any] = {}
+    for note_id, keys in by_note.items():
+        got = ensure_vectorstore(note_id)._collection.get(ids=keys, include=["embeddings"])
+        stored.update(zip(got["ids"], got["embeddings"]))
+    return stored
+
+
+def _doc_key(d: Document) -> str:
+    return getattr(d, "id", None) or chunk_id(d.metadata.get("source", "?"), d.page_content, d.metadata.get("note_id"))
+
+
+def reciprocal_rank_fusion(
+    dense: List[Tuple[Document, float]], lexical: List[Tuple[Document, float]], k: int
+) -> List[Tuple[Document, float]]:
+    """Merge two ranked lists by RRF. Scores returned are the dense relevance
+    (0.0 for lexical-only hits) so they stay comparable to FAST_PATH_MIN_SCORE."""
+    fused: Dict[str, float] = {}
+    docs: Dict[str, Tuple[Document, float]] = {}
+    for ranked, is_dense in ((dense, True), (lexical, False)):
+        for rank, (d, score) in enumerate(ranked):
+            key = _doc_key(d)
+            fused[key] = fused.get(key, 0.0) + 1.0 / (RRF_K + rank + 1)
+            docs.setdefault(key, (d, score if is_dense else 0.0))
+    order = sorted(fused, key=fused.get, reverse=True)[:k]
+    return [docs[key] for key in order]
+
+
+def _fetch_size(k: int, mode: str, rerank: str) -> int:
+    if rerank != "none":
+        return max(k, RERANK_CANDIDATES)
+    return k * 2 if mode == "hybrid" else k
+
+
+def _candidates(
+    query: str, vector: Optional[List[float]], note_id: Optional[str], n: int, mode: str
+) -> List[Tuple[Document, float]]:
+    """Up to n (doc, dense relevance) candidates, best first, for the given mode."""
+    if mode == "lexical":
+        return [(d, 0.0) for d, _ in get_lexical_index().search(query, n, note_id)]
+    dense = _search_by_vector(vector, n, note_id)
+    if mode != "hybrid":
+        return dense
+    return reciprocal_rank_fusion(dense, get_lexical_index().search(query, n, note_id), n)
+
+
+def retrieve_scored(
+    query: str,
+    note_id: Optional[str] = None,
+    k: int = TOP_K,
+    mode: Optional[str] = None,
+    rerank: Optional[str] = None,
+) -> List[Tuple[Document, float]]:
+    """Top-k (doc, dense relevance) for a query using RETRIEVAL_MODE / RERANK_MODE
+    (or `mode` / `rerank`)."""
+    mode = mode or RETRIEVAL_MODE
+    rerank = rerank or RERANK_MODE
+    vector = None if mode == "lexical" else ensure_embeddings().embed_query(query)
+    cands = _candidates(query, vector, note_id, _fetch_size(k, mode, rerank), mode)
+    return reranker.rerank(query, vector, cands, k, rerank)
+
+
+def build_context(query: str, note_id: Optional[str] = None, mode: Optional[str] = None) -> str:
+    return format_context(pack_context([d for d, _ in retrieve_scored(query, note_id, mode=mode)]))
+
+
+# ----------------------------
+# Lexical (BM25) index
+# ----------------------------
+class LexicalIndex:
+    """Persistent BM25 inverted index over chunk text (SQLite FTS5), kept in
+    sync with Chroma during ingestion and keyed by the same chunk IDs."""
+
+    def __init__(self, path: str = LEXICAL_INDEX_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS chunks (
+                rowid INTEGER PRIMARY KEY,
+                chunk_id TEXT UNIQUE NOT NULL,
+                note_id TEXT,
+                metadata TEXT NOT NULL,
+                text TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_chunks_note_id ON chunks(note_id);
+            CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts USING fts5(
+                text, content='chunks', content_rowid='rowid', tokenize='porter unicode61'
+            );
+            CREATE TRIGGER IF NOT EXISTS chunks_ai AFTER INSERT ON chunks BEGIN
+                INSERT INTO chunks_fts(rowid, text) VALUES (new.rowid, new.text);
+            END;
+            CREATE TRIGGER IF NOT EXISTS chunks_ad AFTER DELETE ON chunks BEGIN
+                INSERT INTO chunks_fts(chunks_fts, rowid, text) VALUES ('delete', old.rowid, old.text);
+            END;
+            """
+        )
+        self._conn.commit()
+
+    def add(self, ids: List[str], docs: List[Document]) -> None:
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO chunks (chunk_id, note_id, metadata, text) VALUES (?, ?, ?, ?)",
+                [
+                    (cid, d.metadata.get("note_id"), json.dumps(d.metadata), d.page_content)
+                    for cid, d in zip(ids, docs)
+                ],
+            )
+
+    def delete(self, ids: List[str]) -> None:
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM chunks WHERE chunk_id = ?", [(cid,) for cid in ids])
+
+    def reset(self) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM chunks")
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM chunks LIMIT 1").fetchone() is None
+
+    def search(self, query: str, k: int = TOP_K, note_id: Optional[str] = None) -> List[Tuple[Document, float]]:
+        """BM25-ranked (doc, score) pairs; higher score is better."""
+        terms = re.findall(r"\w+", query.lower())
+        if not terms:
+            return []
+        match = " OR ".join(f'"{t}"' for t in dict.fromkeys(terms))
+        sql = (
+            "SELECT c.chunk_id, c.metadata, c.text, bm25(chunks_fts) AS rank "
+            "FROM chunks_fts JOIN chunks c ON c.rowid = chunks_fts.rowid "
+            "WHERE chunks_fts MATCH ?"
+        )
+        params: List[Any] = [match]
+        if note_id:
+            sql += " AND c.note_id = ?"
+            params.append(note_id)
+        sql += " ORDER BY rank LIMIT ?"
+        params.append(k)
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [
+            (Document(id=cid, page_content=text, metadata=json.loads(meta)), -rank)
+            for cid, meta, text, rank in rows
+        ]
+
+
+def get_lexical_index() -> LexicalIndex:
+    global lexical_index
+    with _lexical_lock:
+        if lexical_index is None:
+            index = LexicalIndex()
+            if index.is_empty():
+                _backfill_lexical(index)
+            lexical_index = index
+        return lexical_index
+
+
+def _backfill_lexical(index: LexicalIndex) -> None:
+    """Fill an empty BM25 index from the current Chroma partitions, so chunks
+    ingested before the lexical index existed are searchable by keyword too."""
+    client = get_chroma_client()
+    for name in partition_names():
+        collection = client.get_collection(name)
+        offset = 0
+        while True:
+            got = collection.get(include=["documents", "metadatas"], limit=CHROMA_WRITE_BATCH, offset=offset)
+            if not len(got["ids"]):
+                break
+            index.add(
+                list(got["ids"]),
+                [
+                    Document(page_content=text or "", metadata=meta or {})
+                    for text, meta in zip(got["documents"], got["metadatas"])
+                ],
+            )
+            offset += len(got["ids"])
+
+
+# ----------------------------
+# Reranking
+# ----------------------------
+class Reranker:
+    """Second-stage reranker over retrieval candidates with a latency budget.
+
+    Per-candidate cost is tracked as a moving average so only as many
+    candidates as fit in RERANK_BUDGET_MS are reranked (the rest are dropped);
+    under load (too many reranks in flight) candidates pass through unchanged.
+    Returned scores stay the dense relevance; only the order changes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inflight = 0
+        self._ms_per_candidate: Dict[str, float] = {}
+        self._cross_encoder: Any = None
+        # Separate from _lock, which is held while the cross-encoder loads
+        self._stats_lock = threading.Lock()
+        self.stats = {"reranked": 0, "skipped": 0, "truncated": 0, "fallbacks": 0, "last_ms": 0.0}
+
+    def _count(self, name: str) -> None:
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def rerank(
+        self,
+        query: str,
+        query_vector: Optional[List[float]],
+        candidates: List[Tuple[Document, float]],
+        k: int,
+        method: str = RERANK_MODE,
+    ) -> List[Tuple[Document, float]]:
+        if method == "none" or len(candidates) <= k:
+            return candidates[:k]
+        if method == "cross_encoder" and self._get_cross_encoder() is None:
+            method = "mmr"
+            self._count("fallbacks")
+        if method == "mmr" and query_vector is None:
+            method = "none"  # lexical mode: no query vector, and MMR must not embed
+        with self._lock:
+            busy = self._inflight >= RERANK_MAX_INFLIGHT
+            if not busy and method != "none":
+                self._inflight += 1
+        if busy or method == "none":
+            self._count("skipped")
+            return candidates[:k]
+
+        try:
+            with self._stats_lock:
+                per = self._ms_per_candidate.get(method)
+            n = len(candidates) if per is None else max(k, min(len(candidates), int(RERANK_BUDGET_MS / per)))
+            if n < len(candidates):
+                self._count("truncated")
+            started = time.perf_counter()
+            if method == "cross_encoder":
+                out = self._cross_encoder_rank(query, candidates[:n], k)
+            else:
+                out = self._mmr_rank(query_vector, candidates[:n], k)
+            elapsed = (time.perf_counter() - started) * 1000
+            sample = max(elapsed / n, 1e-3)
+            with self._stats_lock:
+                per = self._ms_per_candidate.get(method)
+                self._ms_per_candidate[method] = sample if per is None else 0.8 * per + 0.2 * sample
+                self.stats["reranked"] += 1
+                self.stats["last_ms"] = round(elapsed, 2)
+            return out
+        finally:
+            with self._lock:
+                self._inflight -= 1
+
+    def _mmr_rank(
+        self, query_vector: List[float], candidates: List[Tuple[Document, float]], k: int
+    ) -> List[Tuple[Document, float]]:
+        """Maximal marginal relevance over the vectors already stored in Chroma."""
+        keys = [_doc_key(d) for d, _ in candidates]
+        stored = get_stored_embeddings([d for d, _ in candidates])
+        usable = [i for i, key in enumerate(keys) if key in stored]
+        if len(usable) <= k:
+            return candidates[:k]
+        import numpy as np
+        from langchain_chroma.vectorstores import maximal_marginal_relevance
+
+        picks = maximal_marginal_relevance(
+            np.array(query_vector, dtype=np.float32),
+            [stored[keys[i]] for i in usable],
+            lambda_mult=MMR_LAMBDA,
+            k=k,
+        )
+        return [candidates[usable[j]] for j in picks]
+
+    def _get_cross_encoder(self) -> Any:
+        with self._lock:
+            if self._cross_encoder is None:
+                try:
+                    from sentence_transformers import CrossEncoder
+                    self._cross_encoder = CrossEncoder(RERANK_MODEL, device="cpu")
+                except Exception:
+                    self._cross_encoder = False
+            return self._cross_encoder or None
+
+    def _cross_encoder_rank(
+        self, query: str, candidates: List[Tuple[Document, float]], k: int
+    ) -> List[Tuple[Document, float]]:
+        scores = self._cross_encoder.predict([(query, d.page_content) for d, _ in candidates], batch_size=16)
+        order = sorted(range(len(candidates)), key=lambda i: float(scores[i]), reverse=True)
+        return [candidates[i] for i in order[:k]]
+
+
+reranker = Reranker()
+
+
+# ----------------------------
+# Async path (FastAPI)
+# ----------------------------
+def get_llm_semaphore() -> asyncio.Semaphore:
+    """Semaphore bounding concurrent LLM calls, created per running event loop."""
+    global _llm_semaphore
+    loop = asyncio.get_running_loop()
+    if _llm_semaphore is None or _llm_semaphore[0] is not loop:
+        _llm_semaphore = (loop, asyncio.Semaphore(LLM_MAX_CONCURRENCY))
+    return _llm_semaphore[1]
+
+
+async def ainvoke_llm(prompt: str, model: Optional["ChatOllama"] = None) -> str:
+    """Non-blocking LLM call; waits its turn when LLM_MAX_CONCURRENCY calls are in flight."""
+    model = model or get_llm()
+    async with get_llm_semaphore():
+        return (await model.ainvoke(prompt)).content
+
+
+async def astream_llm(prompt: str, model: Optional["ChatOllama"] = None) -> AsyncIterator[str]:
+    """Async counterpart of stream_llm; holds a concurrency slot for the whole stream."""
+    model = model or get_llm()
+    async with get_llm_semaphore():
+        async for chunk in model.astream(prompt):
+            if chunk.content:
+                yield chunk.content
+
+
+async def aretrieve_scored(
+    query: str,
+    note_id: Optional[str] = None,
+    k: int = TOP_K,
+    mode: Optional[str] = None,
+    rerank: Optional[str] = None,
+) -> List[Tuple[Document, float]]:
+    """Async retrieve_scored: query embedding over Ollama's async client, then
+    the local HNSW / BM25 lookups and reranking off the event loop."""
+    mode = mode or RETRIEVAL_MODE
+    rerank = rerank or RERANK_MODE
+    vector = None if mode == "lexical" else await ensure_embeddings().aembed_query(query)
+
+    def finish() -> List[Tuple[Document, float]]:
+        cands = _candidates(query, vector, note_id, _fetch_size(k, mode, rerank), mode)
+        return reranker.rerank(query, vector, cands, k, rerank)
+
+    return await asyncio.to_thread(finish)
+
+
+async def abuild_context(query: str, note_id: Optional[str] = None) -> str:
+    return format_context(pack_context([d for d, _ in await aretrieve_scored(query, note_id)]))
+
+
+# ----------------------------
+# Incremental ingestion
+# ----------------------------
+def content_digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def chunk_id(source: str, content: str, note_id: Optional[str] = None) -> str:
+    """Stable chunk ID: the same text from the same file/note always maps to the same ID."""
+    key = f"{note_id or ''}\x00{source}\x00{content}"
+    return content_digest(key.encode("utf-8"))
+
+
+def _file_stamp(path: str) -> Optional[Tuple[int, int]]:
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def load_manifest() -> Dict[str, Any]:
+    """Manifest of indexed files: digest + chunk IDs per (note, source).
+
+    Cached in memory and re-read whenever the file changes on disk, so an
+    upload indexed by another process (API vs. Streamlit) is seen here too.
+    """
+    global manifest_cache, _manifest_stamp
+    stamp = _file_stamp(MANIFEST_PATH)
+    if manifest_cache is not None and stamp == _manifest_stamp:
+        return manifest_cache
+    if stamp is not None:
+        with open(MANIFEST_PATH, "r", encoding="utf-8") as f:
+            manifest_cache = json.load(f)
+    else:
+        manifest_cache = {}
+    _manifest_stamp = stamp
+    manifest_cache.setdefault("files", {})
+    # Corpus versions used to live here; the state store imports them on open
+    if manifest_cache.pop("versions", None):
+        get_state_db()
+    return manifest_cache
+
+
+def save_manifest(manifest: Dict[str, Any]) -> None:
+    global manifest_cache, _manifest_stamp
+    os.makedirs(DATA_DIR, exist_ok=True)
+    tmp = MANIFEST_PATH + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=True)
+    os.replace(tmp, MANIFEST_PATH)
+    manifest_cache, _manifest_stamp = manifest, _file_stamp(MANIFEST_PATH)
+
+
+def corpus_version(note_id: Optional[str] = None) -> int:
+    """Counter bumped whenever the documents of a note (or of any note, for None) change.
+
+    Kept in the state store so every process sees the same value.
+    """
+    with _state_lock:
+        row = get_state_db().execute(
+            "SELECT version FROM corpus_versions WHERE scope = ?", (note_id or "",)
+        ).fetchone()
+    return row["version"] if row else 0
+
+
+def _bump_corpus_version(note_id: Optional[str]) -> None:
+    global local_version
+    with _state_lock, get_state_db() as conn:
+        conn.executemany(
+            "INSERT INTO corpus_versions (scope, version) VALUES (?, 1) "
+            "ON CONFLICT(scope) DO UPDATE SET version = version + 1",
+            [(scope,) for scope in dict.fromkeys(["", note_id or ""])],
+        )
+        local_version += 1
+
+
+def split_text(text: str, source: str, note_id: Optional[str] = None) -> List[Document]:
+    meta = {"source": source}
+    if note_id:
+        meta["note_id"] = note_id
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+    splitter = RecursiveCharacterTextSplitter(
+        chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, add_start_index=True
+    )
+    return splitter.split_documents([Document(page_content=text, metadata=meta)])
+
+
+def _ingest_progress(done: int, total: int, started: float) -> Dict[str, Any]:
+    elapsed = max(time.time() - started, 1e-6)
+    rate = done / elapsed
+    return {
+        "stage": "embedding",
+        "done": done,
+        "total": total,
+        "chunks_per_sec": rate,
+        "eta_s": (total - done) / rate if rate > 0 else None,
+    }
+
+
+def embed_and_store(
+    vs: "Chroma",
+    docs: List[Document],
+    ids: List[str],
+    progress: Optional[Callable[[Dict[str, Any]], None]] = None,
+    batch_size: int = EMBED_BATCH_SIZE,
+    max_workers: int = EMBED_MAX_WORKERS,
+) -> int:
+    """Embed docs in batches over a bounded pool of concurrent Ollama requests,
+    then upsert the precomputed vectors into Chroma in bulk."""
+    if not docs:
+        return 0
+    embedder = ensure_embeddings()
+    total = len(docs)
+    started = time.time()
+    done = 0
+    pending: Dict[str, List[Any]] = {"ids": [], "embeddings": [], "metadatas": [], "documents": []}
+
+    def flush():
+        if pending["ids"]:
+            vs._collection.upsert(**pending)
+            for v in pending.values():
+                v.clear()
+
+    batches = [list(range(i, min(i + batch_size, total))) for i in range(0, total, batch_size)]
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {
+            pool.submit(embedder.embed_documents, [docs[i].page_content for i in batch]): batch
+            for batch in batches
+        }
+        for fut in as_completed(futures):
+            batch = futures[fut]
+            vectors = fut.result()
+            for i, vector in zip(batch, vectors):
+                pending["ids"].append(ids[i])
+                pending["embeddings"].append(vector)
+                pending["metadatas"].append(docs[i].metadata)
+                pending["documents"].append(docs[i].page_content)
+            if len(pending["ids"]) >= CHROMA_WRITE_BATCH:
+                flush()
+            done += len(batch)
+            if progress:
+                progress(_ingest_progress(done, total, started))
+    flush()
+    return total
+
+
+def index_files(
+    files: List[Tuple[str, bytes]],
+    note_id: Optional[str] = None,
+    progress: Optional[Callable[[Dict[str, Any]], None]] = None,
+) -> Dict[str, Any]:
+    """Incrementally index (filename, bytes) pairs into the vectorstore.
+
+    Unchanged files are skipped by content digest, only chunks with new IDs are
+    embedded, and chunks that disappeared from a replaced file are deleted.
+    `progress` receives dicts with done/total/chunks_per_sec/eta_s while embedding.
+    Calls run one at a time: each one reads the manifest, diffs against it and
+    saves it, so two overlapping calls would orphan each other's chunks.
+    """
+    with _index_lock:
+        return _index_files(files, note_id, progress)
+
+
+def _seed_manifest() -> Dict[str, Dict[str, Any]]:
+    """Manifest entries for chunks already stored without a manifest, grouped by
+    (note, source) from their metadata.
+
+    The digests are unknown, so re-uploading such a file re-chunks it and its
+    old chunks are deleted as stale; every other note keeps its chunks.
+    """
+    client = get_chroma_client()
+    files: Dict[str, Dict[str, Any]] = {}
+    now = int(time.time())
+    for name in partition_names():
+        collection = client.get_collection(name)
+        offset = 0
+        while True:
+            got = collection.get(include=["metadatas"], limit=CHROMA_WRITE_BATCH, offset=offset)
+            if not len(got["ids"]):
+                break
+            for cid, meta in zip(got["ids"], got["metadatas"]):
+                meta = meta or {}
+                source = meta.get("source", "?")
+                entry = files.setdefault(
+                    f"{meta.get('note_id') or ''}::{source}",
+                    {"source": source, "note_id": meta.get("note_id"), "digest": "", "chunk_ids": [], "ts": now},
+                )
+                entry["chunk_ids"].append(cid)
+            offset += len(got["ids"])
+    return files
+
+
+def _index_files(
+    files: List[Tuple[str, bytes]],
+    note_id: Optional[str],
+    progress: Optional[Callable[[Dict[str, Any]], None]],
+) -> Dict[str, Any]:
+    manifest = load_manifest()
+
+    # An index built before the manifest existed: adopt its chunks as they are
+    if not os.path.exists(MANIFEST_PATH):
+        manifest["files"] = _seed_manifest()
+    # ...and a manifest that outlived a deleted chroma_db describes nothing.
+    elif manifest["files"] and not any(p._collection.count() for p in list_partitions()):
+        manifest["files"].clear()
+        get_lexical_index().reset()
+    vs = ensure_vectorstore(note_id)
+
+    docs, chunks = 0, 0
+    skipped = []
+    updates: Dict[str, Optional[Dict[str, Any]]] = {}
+    stale_ids: List[str] = []
+    fresh: Dict[str, Document] = {}
+    changed_docs: Dict[str, Tuple[str, List[Document]]] = {}
+    changed_files: List[Tuple[str, bytes]] = []
+    digests: Dict[str, str] = {}
+    for name, data in files:
+        key = f"{note_id or ''}::{name}"
+        digests[key] = content_digest(data)
+        entry = manifest["files"].get(key)
+        if entry and entry["digest"] == digests[key]:
+            skipped.append(name)
+        else:
+            changed_files.append((name, data))
+
+    for name, text in extract_many(changed_files):
+        key = f"{note_id or ''}::{name}"
+        entry = manifest["files"].get(key)
+        splits = split_text(text, name, note_id) if text else []
+
+        new_docs: Dict[str, Document] = {}
+        for d in splits:
+            new_docs.setdefault(chunk_id(name, d.page_content, note_id), d)
+        old_ids = set(entry["chunk_ids"]) if entry else set()
+
+        stale_ids.extend(cid for cid in old_ids if cid not in new_docs)
+        for cid, d in new_docs.items():
+            if cid not in old_ids:
+                fresh.setdefault(cid, d)
+
+        if new_docs:
+            if set(new_docs) != old_ids:
+                changed_docs[name] = (digests[key], list(new_docs.values()))
+            updates[key] = {
+                "source": name,
+                "note_id": note_id,
+                "digest": digests[key],
+                "chunk_ids": list(new_docs),
+                "ts": int(time.time()),
+            }
+            docs += 1
+            chunks += len(new_docs)
+        else:
+            updates[key] = None
+
+    if stale_ids:
+        vs.delete(ids=stale_ids)
+        get_lexical_index().delete(stale_ids)
+    embed_and_store(vs, list(fresh.values()), list(fresh), progress=progress)
+    get_lexical_index().add(list(fresh), list(fresh.values()))
+
+    # Only record files in the manifest once their chunks are actually stored
+    for key, entry in updates.items():
+        if entry is None:
+            manifest["files"].pop(key, None)
+        else:
+            manifest["files"][key] = entry
+    changed = bool(stale_ids or fresh)
+    if changed:
+        _bump_corpus_version(note_id)
+        answer_cache.invalidate(note_id)
+    if changed or updates or not os.path.exists(MANIFEST_PATH):
+        save_manifest(manifest)
+    if changed and SUMMARY_ON_INGEST:
+        removed = [key.split("::", 1)[1] for key, entry in updates.items() if entry is None]
+        schedule_summary_tree(note_id, changed_docs, removed)
+
+    if not docs and not skipped:
+        return {"ok": False, "message": "No extractable text"}
+    return {
+        "ok": True,
+        "docs": docs,
+        "chunks": chunks,
+        "added": len(fresh),
+        "deleted": len(stale_ids),
+        "skipped": skipped,
+    }
+
+
+# ----------------------------
+# Semantic answer cache
+# ----------------------------
+def _normalize(vector: List[float]) -> List[float]:
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norm for x in vector]
+
+
+class SemanticAnswerCache:
+    """Answers for previously asked questions, scoped by note, corpus version
+    and prompt template.
+
+    A lookup hits when a cached question's embedding is within `threshold`
+    cosine similarity of the new question. Entries expire after `ttl_s` and
+    the least recently used are evicted beyond `max_entries`.
+    """
+
+    def __init__(
+        self,
+        threshold: float = ANSWER_CACHE_THRESHOLD,
+        ttl_s: float = ANSWER_CACHE_TTL_S,
+        max_entries: int = ANSWER_CACHE_MAX_ENTRIES,
+    ):
+        self.threshold = threshold
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        # scope -> entries of that scope, plus one LRU order over all entries
+        self._buckets: Dict[Tuple[str, int, str], "OrderedDict[int, Dict[str, Any]]"] = {}
+        self._order: "OrderedDict[int, Tuple[str, int, str]]" = OrderedDict()
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    @staticmethod
+    def _scope(note_id: Optional[str], template: str) -> Tuple[str, int, str]:
+        return (note_id or "", corpus_version(note_id), template)
+
+    def lookup(self, question: str, note_id: Optional[str], template: str) -> Optional[Any]:
+        if RETRIEVAL_MODE == "lexical":
+            return None  # lexical mode must not call the embedding model
+        scope = self._scope(note_id, template)
+        return self._match(scope, ensure_embeddings().embed_query(question))
+
+    async def alookup(self, question: str, note_id: Optional[str], template: str) -> Optional[Any]:
+        if RETRIEVAL_MODE == "lexical":
+            return None
+        scope = self._scope(note_id, template)
+        return self._match(scope, await ensure_embeddings().aembed_query(question))
+
+    def _match(self, scope: Tuple[str, int, str], vector: List[float]) -> Optional[Any]:
+        """Best same-scope entry; the similarities are computed outside the lock."""
+        import numpy as np
+
+        now = time.time()
+        with self._lock:
+            bucket = self._buckets.get(scope, {})
+            for entry_id in [i for i, e in bucket.items() if now - e["ts"] > self.ttl_s]:
+                self._drop(entry_id)
+                self.stats["evictions"] += 1
+            candidates = [(i, e["vector"]) for i, e in self._buckets.get(scope, {}).items()]
+        best_id = None
+        if candidates:
+            sims = np.stack([v for _, v in candidates]) @ self._unit(vector)
+            best = int(np.argmax(sims))
+            if sims[best] >= self.threshold:
+                best_id = candidates[best][0]
+        with self._lock:
+            entry = self._buckets.get(scope, {}).get(best_id)
+            if entry is None:  # no match, or evicted meanwhile
+                self.stats["misses"] += 1
+                return None
+            self._order.move_to_end(best_id)
+            self.stats["hits"] += 1
+            return entry["value"]
+
+    def store(self, question: str, note_id: Optional[str], template: str, value: Any) -> None:
+        if RETRIEVAL_MODE == "lexical":
+            return
+        scope = self._scope(note_id, template)
+        self._add(scope, ensure_embeddings().embed_query(question), value)
+
+    async def astore(self, question: str, note_id: Optional[str], template: str, value: Any) -> None:
+        if RETRIEVAL_MODE == "lexical":
+            return
+        scope = self._scope(note_id, template)
+        self._add(scope, await ensure_embeddings().aembed_query(question), value)
+
+    @staticmethod
+    def _unit(vector: List[float]) -> Any:
+        import numpy as np
+
+        v = np.asarray(vector, dtype=np.float32)
+        return v / (np.linalg.norm(v) or 1.0)
+
+    def _add(self, scope: Tuple[str, int, str], vector: List[float], value: Any) -> None:
+        entry = {"vector": self._unit(vector), "value": value, "ts": time.time()}
+        with self._lock:
+            entry_id, self._next_id = self._next_id, self._next_id + 1
+            self._buckets.setdefault(scope, OrderedDict())[entry_id] = entry
+            self._order[entry_id] = scope
+            while len(self._order) > self.max_entries:
+                self._drop(next(iter(self._order)))
+                self.stats["evictions"] += 1
+
+    def _drop(self, entry_id: int) -> None:
+        scope = self._order.pop(entry_id)
+        bucket = self._buckets[scope]
+        del bucket[entry_id]
+        if not bucket:
+            del self._buckets[scope]
+
+    def invalidate(self, note_id: Optional[str] = None) -> None:
+        """Drop answers for a note whose documents changed (and all-notes answers)."""
+        with self._lock:
+            for scope in [s for s in self._buckets if s[0] in ("", note_id or "")]:
+                for entry_id in list(self._buckets[scope]):
+                    self._drop(entry_id)
+                    self.stats["invalidations"] += 1
+
+
+answer_cache = SemanticAnswerCache()
+
+
+# ----------------------------
+# State store (SQLite, WAL)
+# ----------------------------
+def get_state_db() -> sqlite3.Connection:
+    """Open the notes/chats database, creating tables and migrating state.json once."""
+    global state_db
+    with _state_lock:
+        if state_db is not None:
+            return state_db
+        os.makedirs(DATA_DIR, exist_ok=True)
+        conn = sqlite3.connect(STATE_DB_PATH, check_same_thread=False, timeout=10)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS notes (
+                id TEXT PRIMARY KEY,
+                title TEXT NOT NULL,
+                created_ts INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS chats (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                note_id TEXT NOT NULL,
+                question TEXT NOT NULL,
+                answer TEXT NOT NULL,
+                ts INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_chats_note_id ON chats(note_id, id);
+            CREATE INDEX IF NOT EXISTS idx_chats_ts ON chats(ts);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                params TEXT NOT NULL,
+                status TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                progress TEXT,
+                cancel_requested INTEGER NOT NULL DEFAULT 0,
+                worker_pid INTEGER,
+                created_ts INTEGER NOT NULL,
+                started_ts INTEGER,
+                finished_ts INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, created_ts);
+            CREATE TABLE IF NOT EXISTS summary_nodes (
+                scope TEXT NOT NULL,
+                source TEXT NOT NULL,
+                level TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                version TEXT NOT NULL,
+                text TEXT NOT NULL,
+                ts INTEGER NOT NULL,
+                PRIMARY KEY (scope, source, level, position)
+            );
+            CREATE TABLE IF NOT EXISTS corpus_versions (scope TEXT PRIMARY KEY, version INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS summary_status (
+                scope TEXT PRIMARY KEY,
+                state TEXT NOT NULL,
+                error TEXT,
+                worker_pid INTEGER NOT NULL,
+                ts INTEGER NOT NULL
+            );
+            """
+        )
+        _import_manifest_versions(conn)
+        if os.path.exists(STATE_PATH):
+            _import_json_state(conn, STATE_PATH)
+        state_db = conn
+    return state_db
+
+
+def _import_json_state(conn: sqlite3.Connection, path: str) -> Dict[str, int]:
+    with open(path, "r", encoding="utf-8") as f:
+        legacy = json.load(f)
+    notes = legacy.get("notes", {})
+    chats = legacy.get("chats", {})
+    now = int(time.time())
+    marker = f"migrated:{os.path.abspath(path)}"
+    # IMMEDIATE + marker: a second process starting at the same time imports nothing
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if conn.execute("SELECT 1 FROM meta WHERE key = ?", (marker,)).fetchone() is None:
+            conn.executemany(
+                "INSERT OR IGNORE INTO notes (id, title, created_ts) VALUES (?, ?, ?)",
+                [(nid, n.get("title", nid), now) for nid, n in notes.items()],
+            )
+            conn.executemany(
+                "INSERT INTO chats (note_id, question, answer, ts) VALUES (?, ?, ?, ?)",
+                [
+                    (nid, c.get("question", ""), c.get("answer", ""), int(c.get("ts", now)))
+                    for nid, items in chats.items()
+                    for c in items
+                ],
+            )
+            conn.execute("INSERT INTO meta (key, value) VALUES (?, ?)", (marker, str(now)))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    try:
+        os.replace(path, path + ".migrated")
+    except OSError:
+        pass
+    return {"notes": len(notes), "chats": sum(len(v) for v in chats.values())}
+
+
+def _import_manifest_versions(conn: sqlite3.Connection) -> None:
+    """Carry corpus versions over from manifests written before they moved here."""
+    try:
+        with open(MANIFEST_PATH, "r", encoding="utf-8") as f:
+            versions = json.load(f).get("versions") or {}
+    except (OSError, ValueError):
+        return
+    with conn:
+        conn.executemany(
+            "INSERT INTO corpus_versions (scope, version) VALUES (?, ?) "
+            "ON CONFLICT(scope) DO UPDATE SET version = max(version, excluded.version)",
+            list(versions.items()),
+        )
+
+
+def migrate_json_state(path: str = STATE_PATH) -> Dict[str, int]:
+    """One-shot import of a legacy state.json into the SQLite store.
+
+    Runs automatically the first time the store is opened; the JSON file is
+    renamed to `<path>.migrated` afterwards so it is never imported twice.
+    """
+    conn = get_state_db()
+    with _state_lock:
+        return _import_json_state(conn, path)
+
+
+def list_notes() -> Dict[str, Dict[str, Any]]:
+    conn = get_state_db()
+    with _state_lock:
+        rows = conn.execute("SELECT id, title FROM notes ORDER BY created_ts, id").fetchall()
+    return {r["id"]: {"title": r["title"]} for r in rows}
+
+
+def get_note(note_id: str) -> Optional[Dict[str, Any]]:
+    conn = get_state_db()
+    with _state_lock:
+        row = conn.execute("SELECT id, title FROM notes WHERE id = ?", (note_id,)).fetchone()
+    return {"title": row["title"]} if row else None
+
+
+def create_note(title: str) -> str:
+    conn = get_state_db()
+    note_id = new_id("note")
+    with _state_lock, conn:
+        conn.execute(
+            "INSERT INTO notes (id, title, created_ts) VALUES (?, ?, ?)", (note_id, title, int(time.time()))
+        )
+    return note_id
+
+
+def rename_note(note_id: str, title: str) -> bool:
+    conn = get_state_db()
+    with _state_lock, conn:
+        cur = conn.execute("UPDATE notes SET title = ? WHERE id = ?", (title, note_id))
+    return cur.rowcount > 0
+
+
+def append_chat(note_id: str, question: str, answer: str) -> int:
+    """Append one chat turn (O(1), no rewrite of history). Returns its id."""
+    conn = get_state_db()
+    with _state_lock, conn:
+        cur = conn.execute(
+            "INSERT INTO chats (note_id, question, answer, ts) VALUES (?, ?, ?, ?)",
+            (note_id, question, answer, int(time.time())),
+        )
+    return cur.lastrowid
+
+
+def get_chats(note_id: str, limit: int = 50, before: Optional[int] = None) -> Dict[str, Any]:
+    """One page of a note's chat history, oldest first.
+
+    Pages go backwards in time: pass the returned "next_before" as `before`
+    to get the previous page (None when there is nothing older).
+    """
+    conn = get_state_db()
+    with _state_lock:
+        rows = conn.execute(
+            "SELECT id, question, answer, ts FROM chats WHERE note_id = ? AND id < ? ORDER BY id DESC LIMIT ?",
+            (note_id, before if before is not None else 2**63 - 1, limit),
+        ).fetchall()
+    chats = [dict(r) for r in reversed(rows)]
+    return {"chats": chats, "next_before": chats[0]["id"] if len(rows) == limit else None}
+
+
+def new_id(prefix: str) -> str:
+    return f"{prefix}_{int(time.time() * 1000)}"
+
+
+def calculator_tool(expression: str) -> str:
+    """
+    Safe calculator tool for basic math operations.
+    Supports: +, -, *, /, ^, sqrt, sin, cos, tan, log, pi, e
+    """
+    try:
+        # Clean and validate the expression
+        allowed_chars = set('0123456789+-*/().^ sqrtincologepi')
+        expr = expression.lower().replace(' ', '')
+        
+        if not all(c in allowed_chars for c in expr.replace('sqrt', '').replace('sin', '').replace('cos', '').replace('tan', '').replace('log', '').replace('pi', '').replace('e', '')):
+            return "Error: Invalid characters in expression"
+        
+        # Replace math symbols
+        expr = expr.replace('^', '**')
+        expr = expr.replace('sqrt', 'math.sqrt')
+        expr = expr.replace('sin', 'math.sin')
+        expr = expr.replace('cos', 'math.cos')
+        expr = expr.replace('tan', 'math.tan')
+        expr = expr.replace('log', 'math.log10')
+        expr = expr.replace('pi', str(math.pi))
+        expr = re.sub(r"(?<![\d.])e", str(math.e), expr)  # the constant, not the "1e5" exponent
+        
+        # Evaluate safely
+        result = eval(expr, {"__builtins__": {}, "math": math})
+        return f"Result: {result}"
+    except Exception as e:
+        return f"Calculation error: {str(e)}"
+
+
+# ----------------------------
+# Summary tree (built at ingest time)
+# ----------------------------
+def study_summary_prompt(topic: str, ctx: str) -> str:
+    topic_text = f'about "{topic}"' if topic.strip() else "from the materials"
+
+    return f"""You are "My Learning Buddy" — a friendly study helper creating summaries from the user's own notes.
+
+RULES:
+- Use ONLY information from the CONTEXT below — don't add outside knowledge
+- Keep it student-friendly and easy to understand
+- Be encouraging and supportive in tone
+
+Create a helpful study summary {topic_text} with:
+📌 **Key Points** (clear bullet points of the main ideas)
+📖 **Important Definitions** (key terms explained simply)
+❓ **Review Questions** (5 questions to test understanding)
+
+CONTEXT FROM USER'S NOTES:
+{ctx}
+
+Make it clear, organized, and helpful for studying!"""
+
+
+def mindmap_prompt(topic: str, ctx: str) -> str:
+    topic_text = f'about "{topic}"' if topic and topic.strip() else ""
+
+    return f"""Create ONE mindmap {topic_text} from the context below.
+
+CRITICAL RULES:
+1. Use ONLY facts from the CONTEXT - never make up content
+2. Return exactly ONE JSON object
+3. If context is about cooking, make a cooking mindmap. If about history, make a history mindmap. Match the actual content!
+
+Format (return ONLY this, no extra text):
+{{"title": "Topic from context", "branches": [{{"name": "Theme 1", "items": ["fact 1", "fact 2"]}}, {{"name": "Theme 2", "items": ["fact 1", "fact 2"]}}]}}
+
+CONTEXT:
+{ctx}
+
+Return ONE JSON object only:"""
+
+
+def clean_mindmap(out: str) -> str:
+    """The first JSON object in `out` re-serialized (or `out` as-is)."""
+    value = parse_json_loose(out)
+    if isinstance(value, dict) and "error" not in value:
+        return json.dumps(value)
+    return out
+
+
+def _condense_prompt(text: str) -> str:
+    return f"""Condense the study material below into a short summary (at most 150 words).
+Keep every key fact, term, definition and formula. Use ONLY the material; no introduction.
+
+MATERIAL:
+{text}
+
+SUMMARY:"""
+
+
+def _condense(text: str) -> str:
+    return get_llm().invoke(_condense_prompt(text)).content.strip()
+
+
+def _section_texts(chunks: List[Document]) -> List[str]:
+    """A document's chunks (in order) grouped into sections, overlap removed."""
+    sections = []
+    for i in range(0, len(chunks), SUMMARY_SECTION_CHUNKS):
+        group = chunks[i:i + SUMMARY_SECTION_CHUNKS]
+        if all("start_index" in d.metadata for d in group):
+            group = _merge_spans(group)
+        sections.append("\n".join(d.page_content for d in group))
+    return sections
+
+
+def _rollup(texts: List[str]) -> str:
+    """Condense summaries level by level until they fit one prompt's context budget."""
+    limit = CONTEXT_TOKEN_BUDGET * CHARS_PER_TOKEN
+    while len(texts) > 1 and sum(len(t) for t in texts) > limit:
+        batches: List[List[str]] = [[]]
+        size = 0
+        for t in texts:
+            if batches[-1] and size + len(t) > limit:
+                batches.append([])
+                size = 0
+            batches[-1].append(t)
+            size += len(t)
+        if len(batches) == len(texts):
+            texts = [t[: limit // len(texts)] for t in texts]
+            break
+        texts = [_condense("\n\n".join(b)) for b in batches]
+    return "\n\n".join(texts)
+
+
+def _store_nodes(scope: str, source: str, levels: Dict[str, List[str]], version: str) -> None:
+    conn = get_state_db()
+    now = int(time.time())
+    with _state_lock, conn:
+        conn.execute(
+            f"DELETE FROM summary_nodes WHERE scope = ? AND source = ? AND level IN ({','.join('?' * len(levels))})",
+            (scope, source, *levels),
+        )
+        conn.executemany(
+            "INSERT INTO summary_nodes (scope, source, level, position, version, text, ts) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(scope, source, level, i, version, text, now) for level, texts in levels.items() for i, text in enumerate(texts)],
+        )
+
+
+def build_summary_tree(
+    note_id: Optional[str],
+    documents: Dict[str, Tuple[str, List[Document]]],
+    removed: Optional[List[str]] = None,
+) -> None:
+    """Summarize changed documents chunk -> section -> document, then roll the
+    document summaries up into the study summary and mind map of the note and
+    of all notes. `documents` maps source -> (content digest, ordered chunks)."""
+    scope = note_id or ""
+    conn = get_state_db()
+    with _state_lock, conn:
+        conn.executemany(
+            "DELETE FROM summary_nodes WHERE scope = ? AND source = ?",
+            [(scope, source) for source in removed or []],
+        )
+    for source, (digest, chunks) in documents.items():
+        sections = [_condense(text) for text in _section_texts(chunks)]
+        document = sections[0] if len(sections) == 1 else _condense(_rollup(sections))
+        _store_nodes(scope, source, {"section": sections, "document": [document]}, digest)
+
+    for target in dict.fromkeys([scope, ""]):
+        version = str(corpus_version(target or None))
+        with _state_lock:
+            rows = conn.execute(
+                "SELECT text FROM summary_nodes WHERE level = 'document' AND (scope = ? OR ? = '') ORDER BY scope, source",
+                (target, target),
+            ).fetchall()
+        if not rows:
+            _store_nodes(target, "", {"note": [], "mindmap": []}, version)
+            continue
+        ctx = _rollup([r["text"] for r in rows])
+        llm = get_llm()
+        summary = llm.invoke(study_summary_prompt("", ctx)).content
+        mindmap = generate_mindmap_json(mindmap_prompt("", ctx))
+        _store_nodes(target, "", {"note": [summary], "mindmap": [mindmap]}, version)
+
+
+def _set_summary_status(note_id: Optional[str], state: str, error: Optional[str] = None) -> None:
+    global local_version
+    with _state_lock, get_state_db() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO summary_status (scope, state, error, worker_pid, ts) VALUES (?, ?, ?, ?, ?)",
+            (note_id or "", state, error, os.getpid(), int(time.time())),
+        )
+        local_version += 1
+
+
+def summary_status() -> Dict[str, Dict[str, Any]]:
+    """Summary-tree build state per note ("" = uploads without a note), shared by
+    every process; a build whose process died is reported as an error."""
+    with _state_lock:
+        rows = get_state_db().execute("SELECT * FROM summary_status").fetchall()
+    out = {}
+    for r in rows:
+        status = {"state": r["state"], "ts": r["ts"]}
+        if r["state"] in ("queued", "building") and not _pid_alive(r["worker_pid"]):
+            status = {"state": "error", "error": "Interrupted: the building process exited", "ts": r["ts"]}
+        elif r["error"]:
+            status["error"] = r["error"]
+        out[r["scope"]] = status
+    return out
+
+
+def _run_summary_build(note_id: Optional[str], documents: Dict[str, Tuple[str, List[Document]]], removed: List[str]) -> None:
+    _set_summary_status(note_id, "building")
+    try:
+        build_summary_tree(note_id, documents, removed)
+        _set_summary_status(note_id, "ready")
+    except Exception as e:
+        _set_summary_status(note_id, "error", f"{type(e).__name__}: {e}")
+
+
+def schedule_summary_tree(
+    note_id: Optional[str], documents: Dict[str, Tuple[str, List[Document]]], removed: List[str]
+) -> None:
+    """Build the summary tree in the background (one build at a time, in order)."""
+    global summary_pool
+    with _summary_pool_lock:
+        if summary_pool is None:
+            summary_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="summary")
+    _set_summary_status(note_id, "queued")
+    summary_pool.submit(_run_summary_build, note_id, documents, removed)
+
+
+def get_summary_node(note_id: Optional[str], level: str = "note") -> Optional[str]:
+    """Precomputed study summary ("note") or mind map ("mindmap") if it is current."""
+    with _state_lock:
+        row = get_state_db().execute(
+            "SELECT text, version FROM summary_nodes WHERE scope = ? AND source = '' AND level = ?",
+            (note_id or "", level),
+        ).fetchone()
+    if row and row["version"] == str(corpus_version(note_id)):
+        return row["text"]
+    return None
+
+
+def nearest_summary_node(topic: str, note_id: Optional[str] = None) -> Optional[str]:
+    """Section/document summary closest to `topic` (embeddings are cached)."""
+    with _state_lock:
+        rows = get_state_db().execute(
+            "SELECT text FROM summary_nodes WHERE level IN ('section', 'document') AND (scope = ? OR ? = '')",
+            (note_id or "", note_id or ""),
+        ).fetchall()
+    if not rows or RETRIEVAL_MODE == "lexical":
+        return None
+    texts = [r["text"] for r in rows]
+    embeddings = ensure_embeddings()
+    query = _normalize(embeddings.embed_query(topic))
+    vectors = [_normalize(v) for v in embeddings.embed_documents(texts)]
+    best = max(range(len(texts)), key=lambda i: sum(a * b for a, b in zip(query, vectors[i])))
+    return texts[best]
+
+
+def summary_context(topic: str, note_id: Optional[str], default_query: str) -> str:
+    """Retrieved context for a topic, led by the nearest precomputed summary node."""
+    ctx = build_context(topic or default_query, note_id=note_id)
+    node = nearest_summary_node(topic, note_id) if topic.strip() else None
+    return f"[Overview]\n{node}\n\n{ctx}" if node else ctx
+
+
+def generate_summary(topic: str = "", note_id: Optional[str] = None) -> str:
+    if not topic.strip():
+        cached = get_summary_node(note_id, "note")
+        if cached:
+            return cached
+    ctx = summary_context(topic, note_id, "main topics")
+    return get_llm().invoke(study_summary_prompt(topic, ctx)).content
+
+
+def generate_summary_stream(topic: str = "", note_id: Optional[str] = None) -> Iterator[str]:
+    if not topic.strip():
+        cached = get_summary_node(note_id, "note")
+        if cached:
+            return iter([cached])
+    ctx = summary_context(topic, note_id, "main topics")
+    return stream_llm(study_summary_prompt(topic, ctx))
+
+
+def generate_mindmap(topic: str = "", note_id: Optional[str] = None) -> str:
+    if not (topic or "").strip():
+        cached = get_summary_node(note_id, "mindmap")
+        if cached:
+            return cached
+    topic = topic or ""
+    ctx = summary_context(topic, note_id, "overview")
+
+    # Check if we have context
+    if not ctx or not ctx.strip() or ctx.strip() in ["No relevant context found.", "None", ""]:
+        return '{"title": "No Content", "branches": [{"name": "Upload documents first", "items": ["Go to Upload tab", "Add your study materials"]}]}'
+
+    return generate_mindmap_json(mindmap_prompt(topic, ctx))
+
+
+# ----------------------------
+# Structured generation (JSON schema enforced by Ollama)
+# ----------------------------
+class Flashcard(BaseModel):
+    front: str = Field(min_length=5)
+    back: str = Field(min_length=5)
+
+
+class FlashcardSet(BaseModel):
+    flashcards: List[Flashcard]
+
+
+class QuizQuestion(BaseModel):
+    question: str = Field(min_length=10)
+    choices: List[str] = Field(min_length=4, max_length=4)
+    answer_index: int = Field(ge=0, le=3)
+    explanation: str = ""
 
-from langchain_core.documents import Document
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_chroma import Chroma
-from langchain_ollama import ChatOllama, OllamaEmbeddings
-import re
-import math
 
-# ----------------------------
-# Config (LOCAL)
-# ----------------------------
-OLLAMA_BASE_URL = "http://127.0.0.1:11434"
-LLM_MODEL = "mistral"  # Changed from llama3.2:1b for better JSON output
-# Use the exact tag shown by `ollama list` for the embeddings model
-# (e.g. `nomic-embed-text:latest`) to avoid "model not found" errors.
-EMBED_MODEL = "mxbai-embed-large"  # Better quality embeddings (free via Ollama)
+class QuizSet(BaseModel):
+    quiz: List[QuizQuestion]
+
+
+class MindmapBranch(BaseModel):
+    name: str = Field(min_length=1)
+    items: List[str]
+
+
+class Mindmap(BaseModel):
+    title: str = Field(min_length=1)
+    branches: List[MindmapBranch] = Field(min_length=1)
+
+
+def _avoid_text(avoid: List[str]) -> str:
+    if not avoid:
+        return ""
+    listed = "\n".join(f"- {a}" for a in avoid)
+    return f"\nDo NOT repeat any of these, they already exist:\n{listed}\n"
+
+
+def _flashcards_prompt(ctx: str, n: int, avoid: Optional[List[str]] = None) -> str:
+    # Very simple prompt for small models
+    return f"""Read this text and create {n} flashcards.
+
+TEXT:
+{ctx}
+{_avoid_text(avoid or [])}
+Create flashcards as JSON. Example:
+{{"flashcards": [{{"front": "What is DNA?", "back": "DNA is the molecule that carries genetic information."}}]}}
+
+Your {n} flashcards as JSON:"""
+
+
+def _quiz_prompt(ctx: str, n: int, avoid: Optional[List[str]] = None) -> str:
+    # Clearer prompt with real examples - not placeholder letters
+    return f"""Read the text and create {n} multiple choice questions.
+
+TEXT:
+{ctx}
+{_avoid_text(avoid or [])}
+IMPORTANT: Each choice must be a real answer, NOT just a letter!
+
+Return JSON like this example:
+{{"quiz": [
+  {{"question": "What is the main function of the heart?", "choices": ["To pump blood throughout the body", "To digest food", "To filter air", "To produce hormones"], "answer_index": 0, "explanation": "The heart pumps blood to all parts of the body."}}
+]}}
+
+Create {n} questions with 4 real answer choices each. JSON:"""
 
-PERSIST_DIR = "./chroma_db"
-COLLECTION = "study_rag"
-TOP_K = 5
-DATA_DIR = "./data"
-STATE_PATH = os.path.join(DATA_DIR, "state.json")
 
+def get_structured_llm(schema_model: type) -> "ChatOllama":
+    """ChatOllama constrained to emit JSON matching `schema_model` (one per model)."""
+    return resources.get(
+        ("llm", LLM_MODEL, schema_model.__name__),
+        lambda: _open_llm(format=schema_model.model_json_schema()),
+    )
+
+
+def _parse_stat(kind: str, field: str, amount: int = 1) -> None:
+    with _parse_stats_lock:
+        stats = parse_stats.setdefault(
+            kind, {"generations": 0, "retries": 0, "parse_failures": 0, "invalid_items": 0, "wasted_generations": 0}
+        )
+        stats[field] += amount
+
+
+def generate_items(
+    kind: str,
+    prompt_fn: Callable[..., str],
+    ctx: str,
+    n: int,
+    item_model: type,
+    set_model: type,
+    clean: Callable[[Any], Optional[Dict[str, Any]]],
+    on_item: Optional[Callable[[Dict[str, Any]], None]] = None,
+    cancelled: Optional[Callable[[], bool]] = None,
+    avoid: Optional[List[str]] = None,
+) -> Dict[str, Any]:
+    """Generate n items, validating each one as soon as it streams in.
+
+    With STRUCTURED_OUTPUT the JSON schema is enforced by Ollama. Items that
+    fail cleaning or validation are dropped and only the shortfall is requested
+    again (up to STRUCTURED_MAX_RETRIES times), listing what already exists
+    (plus `avoid`) so the retry does not repeat it. `on_item` receives each
+    accepted item; `cancelled` is checked between streamed items and stops the
+    generation early. Counters go to parse_stats[kind].
+    """
+    llm = get_structured_llm(set_model) if STRUCTURED_OUTPUT else get_llm()
+    first = next(iter(item_model.model_fields))
+    items: List[Dict[str, Any]] = []
+    raw: List[str] = []
+    stopped = False
+    for attempt in range(STRUCTURED_MAX_RETRIES + 1):
+        missing = n - len(items)
+        if missing <= 0 or stopped or (cancelled and cancelled()):
+            break
+        if attempt:
+            _parse_stat(kind, "retries")
+        _parse_stat(kind, "generations")
+        parser = StreamingJSONParser()
+        raw = []
+        kept = 0
+        for chunk in llm.stream(prompt_fn(ctx, missing, list(avoid or []) + [str(i[first]) for i in items])):
+            raw.append(chunk.content)
+            entries = parser.feed(chunk.content)
+            if entries and cancelled and cancelled():
+                stopped = True  # closing the stream stops the generation
+                break
+            for entry in entries:
+                if kept >= missing:
+                    continue
+                try:
+                    item = clean(entry)
+                    item = item_model.model_validate(item).model_dump() if item is not None else None
+                except ValidationError:
+                    item = None
+                if item is None or any(str(item[first]).lower() == str(i[first]).lower() for i in items):
+                    _parse_stat(kind, "invalid_items")
+                    continue
+                items.append(item)
+                kept += 1
+                if on_item:
+                    on_item(item)
+        if not parser.items:
+            _parse_stat(kind, "parse_failures")
+        if not kept:
+            _parse_stat(kind, "wasted_generations")
+
+    result: Dict[str, Any] = {kind: items}
+    if not items:
+        result["error"] = f"Could not generate valid {kind} items from the model response. Try again."
+        result["_raw"] = "".join(raw)[:1000]
+    return result
 
-# LLM + embeddings (lazy init for embeddings/vectorstore)
-llm: Optional[ChatOllama] = None
-emb: Optional[OllamaEmbeddings] = None
 
-vectorstore: Optional[Chroma] = None
-state_cache: Optional[Dict[str, Any]] = None
+def generate_mindmap_json(prompt: str) -> str:
+    """Mind map JSON for a prompt: schema-enforced and validated (whole map
+    retried on failure) when STRUCTURED_OUTPUT, otherwise loosely cleaned."""
+    if not STRUCTURED_OUTPUT:
+        return clean_mindmap(get_llm().invoke(prompt).content)
+    llm = get_structured_llm(Mindmap)
+    raw = ""
+    for attempt in range(STRUCTURED_MAX_RETRIES + 1):
+        if attempt:
+            _parse_stat("mindmap", "retries")
+        _parse_stat("mindmap", "generations")
+        raw = llm.invoke(prompt).content
+        try:
+            return Mindmap.model_validate(parse_json_loose(raw)).model_dump_json()
+        except ValidationError:
+            _parse_stat("mindmap", "parse_failures")
+            _parse_stat("mindmap", "wasted_generations")
+    return clean_mindmap(raw)
 
 
 # ----------------------------
-# Helpers
+# Quiz and flashcard generation
 # ----------------------------
-def parse_json_loose(text: str) -> Any:
-    """Best-effort JSON extraction from LLM output."""
+def _clean_flashcard(card: Any) -> Optional[Dict[str, str]]:
+    """A usable {"front", "back"} card, or None for placeholders / junk."""
+    if not isinstance(card, dict):
+        return None
+
+    # Get front and back, handle different key names
+    front = card.get("front") or card.get("question") or card.get("q") or ""
+    back = card.get("back") or card.get("answer") or card.get("a") or ""
+
+    front = str(front).strip()
+    back = str(back).strip()
+
+    # Skip empty or placeholder cards
+    if not front or not back:
+        return None
+    if front in ["...", "[term]", "What is [term]?"]:
+        return None
+    if back in ["...", "[Definition - 2-3 sentences]", "[definition]"]:
+        return None
+    if len(front) < 5 or len(back) < 5:
+        return None
+
+    # Ensure front is a question (add ? if missing)
+    if not front.endswith("?") and not front.endswith(":"):
+        if front.lower().startswith(("what", "who", "when", "where", "why", "how", "which", "explain", "describe", "define")):
+            front = front + "?"
+
+    return {"front": front, "back": back}
+
+
+def _clean_quiz_question(q: Any) -> Optional[Dict[str, Any]]:
+    """A usable multiple-choice question (4 choices, answer_index 0-3), or None."""
+    if not isinstance(q, dict):
+        return None
+
+    # Check if choices are valid (not just letters or too short)
+    if not isinstance(q.get("choices"), list):
+        return None  # No choices, skip question
+    choices = q["choices"]
+    # Filter out invalid choices (single letters, empty, too short)
+    invalid_patterns = ["A", "B", "C", "D", "a", "b", "c", "d", "...", ""]
+    if all(str(c).strip() in invalid_patterns or len(str(c).strip()) < 3 for c in choices):
+        return None  # Choices are placeholders
+
+    # Clean up choices
+    clean_choices = []
+    for c in choices:
+        choice_str = str(c).strip()
+        # Remove leading "A.", "B.", etc. if model added them
+        if len(choice_str) > 2 and choice_str[0] in "ABCDabcd" and choice_str[1] in ".):":
+            choice_str = choice_str[2:].strip()
+        if choice_str and len(choice_str) >= 3:
+            clean_choices.append(choice_str)
+
+    if len(clean_choices) < 2:
+        return None  # Not enough valid choices
+
+    # Pad to 4 choices if needed
+    while len(clean_choices) < 4:
+        clean_choices.append(f"Option {chr(65 + len(clean_choices))}")
+    q["choices"] = clean_choices[:4]
+
+    # Ensure answer_index is valid (0-3)
     try:
-        return json.loads(text)
-    except Exception:
-        pass
+        idx = int(q.get("answer_index", 0))
+    except (TypeError, ValueError):
+        idx = 0
+    q["answer_index"] = idx if 0 <= idx <= 3 else 0
+
+    # Ensure question exists and is meaningful
+    if not q.get("question") or len(str(q["question"]).strip()) < 10:
+        return None  # Skip questions that are too short
+
+    return q
+
+
+def generate_flashcards(
+    topic: str,
+    n: int = 10,
+    note_id: Optional[str] = None,
+    progress: Optional[Callable[[Dict[str, Any]], None]] = None,
+):
+    """Flashcards; `progress` gets the cards so far as each one streams in."""
+    ctx = summary_context(topic or "", note_id, "key concepts")
+    
+    # Check if we have context
+    if not ctx or not ctx.strip() or ctx.strip() in ["No relevant context found.", "None", ""]:
+        return {"flashcards": [], "error": "No documents uploaded. Please upload study materials first."}
 
-    # attempt to extract {...} or [...]
-    for a, b in [("{", "}"), ("[", "]")]:
-        i, j = text.find(a), text.rfind(b)
-        if i != -1 and j != -1 and j > i:
-            snippet = text[i : j + 1]
-            try:
-                return json.loads(snippet)
-            except Exception:
-                continue
+    cards: List[Dict[str, Any]] = []
 
-    return {"raw": text, "error": "Invalid JSON from model"}
+    def on_item(card: Dict[str, Any]) -> None:
+        cards.append(card)
+        if progress:
+            progress({"flashcards": cards})
 
+    return generate_items(
+        "flashcards", _flashcards_prompt, ctx, n, Flashcard, FlashcardSet, _clean_flashcard, on_item=on_item
+    )
 
-def retrieve_docs(retriever, query: str):
-    """LangChain version compatibility: some retrievers use .invoke()."""
-    if hasattr(retriever, "get_relevant_documents"):
-        return retriever.get_relevant_documents(query)
-    return retriever.invoke(query)
 
+def _question_words(q: Dict[str, Any]) -> set:
+    return set(re.findall(r"\w+", str(q.get("question", "")).lower()))
+
+
+def _is_duplicate_question(q: Dict[str, Any], kept: List[Dict[str, Any]]) -> bool:
+    """Near-identical question text (word-set Jaccard >= QUIZ_DEDUP_THRESHOLD)."""
+    words = _question_words(q)
+    for other in kept:
+        seen = _question_words(other)
+        if words and seen and len(words & seen) / len(words | seen) >= QUIZ_DEDUP_THRESHOLD:
+            return True
+    return False
+
+
+def _quiz_slices(topic: str, note_id: Optional[str], batches: int) -> List[str]:
+    """One context per batch: retrieved chunks dealt round-robin so each batch
+    works from different material, led by the nearest summary node."""
+    k = min(RERANK_CANDIDATES, TOP_K * batches)
+    docs = [d for d, _ in retrieve_scored(topic or "key topics", note_id, k=k)]
+    if not docs:
+        return []
+    overview = nearest_summary_node(topic, note_id) if topic.strip() else None
+    slices = []
+    for i in range(batches):
+        ctx = format_context(pack_context(docs[i::batches] or docs[:TOP_K]))
+        slices.append(f"[Overview]\n{overview}\n\n{ctx}" if overview else ctx)
+    return slices
+
+
+def generate_quiz(
+    topic: str,
+    n: int = 10,
+    note_id: Optional[str] = None,
+    progress: Optional[Callable[[Dict[str, Any]], None]] = None,
+    cancelled: Optional[Callable[[], bool]] = None,
+):
+    """Quiz of n questions. Above QUIZ_BATCH_SIZE the questions are generated in
+    concurrent batches over different context slices and merged without
+    near-duplicates; `progress` gets the merged questions as each one streams in."""
+    sizes = [QUIZ_BATCH_SIZE] * (n // QUIZ_BATCH_SIZE) + ([n % QUIZ_BATCH_SIZE] if n % QUIZ_BATCH_SIZE else [])
+    if len(sizes) == 1:
+        slices = [summary_context(topic or "", note_id, "key topics")]
+    else:
+        slices = _quiz_slices(topic or "", note_id, len(sizes))
+    # Check if we have context
+    slices = [ctx for ctx in slices if ctx and ctx.strip() not in ["No relevant context found.", "None", ""]]
+    if not slices:
+        return {"quiz": [], "error": "No documents uploaded. Please upload study materials first."}
+    # Fewer usable slices than batches: reuse them rather than dropping batches
+    slices = [slices[i % len(slices)] for i in range(len(sizes))]
+    spare = QUIZ_BATCH_SPARE if len(sizes) > 1 else 0
+
+    quiz: List[Dict[str, Any]] = []
+    failures: List[str] = []
+    batches_done = 0
+    lock = threading.Lock()
+
+    def report() -> None:
+        if progress:
+            progress({"quiz": quiz, "batches_done": batches_done, "batches": len(sizes)})
+
+    def on_item(q: Dict[str, Any]) -> None:
+        with lock:
+            if len(quiz) < n and not _is_duplicate_question(q, quiz):
+                quiz.append(q)
+                report()
+
+    def record(batch: Dict[str, Any], topup: bool = False) -> None:
+        nonlocal batches_done
+        if not batch.get("quiz") and batch.get("_raw"):
+            failures.append(batch["_raw"])
+        if not topup:
+            with lock:
+                batches_done += 1
+                report()
+
+    pool = ThreadPoolExecutor(max_workers=QUIZ_MAX_WORKERS)
+    try:
+        futures = [
+            pool.submit(generate_items, "quiz", _quiz_prompt, ctx, size + spare, QuizQuestion, QuizSet,
+                        _clean_quiz_question, on_item, cancelled)
+            for ctx, size in zip(slices, sizes)
+        ]
+        for future in as_completed(futures):
+            try:
+                record(future.result())
+            except Exception as e:
+                record({"quiz": [], "_raw": f"{type(e).__name__}: {e}"})
+            if cancelled and cancelled():
+                break
+    finally:
+        # A cancelled quiz returns now; running batches stop at their next item
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    # Duplicates across batches can leave the quiz short: ask for the rest
+    for i in range(QUIZ_TOPUP_ROUNDS):
+        missing = n - len(quiz)
+        if missing <= 0 or (cancelled and cancelled()):
+            break
+        with lock:
+            avoid = [str(q["question"]) for q in quiz]
+        try:
+            record(generate_items("quiz", _quiz_prompt, slices[i % len(slices)], missing + spare, QuizQuestion,
+                                  QuizSet, _clean_quiz_question, on_item, cancelled, avoid), topup=True)
+        except Exception as e:
+            record({"quiz": [], "_raw": f"{type(e).__name__}: {e}"}, topup=True)
+
+    result: Dict[str, Any] = {"quiz": list(quiz)}
+    if not quiz:
+        result["error"] = "Could not generate valid quiz questions. The model may have returned placeholder content. Try again."
+        result["_raw"] = failures[0][:1000] if failures else ""
+    elif len(quiz) < n:
+        result.update(
+            requested=n,
+            returned=len(quiz),
+            warning=f"Only {len(quiz)} of {n} questions could be generated without repeats.",
+        )
+    return result
 
-def extract_text(filename: str, data: bytes) -> str:
-    name = filename.lower()
 
-    if name.endswith(".pdf"):
-        reader = PdfReader(io.BytesIO(data))
-        return "\n".join([(p.extract_text() or "") for p in reader.pages]).strip()
+# ----------------------------
+# Background jobs (SQLite-backed queue)
+# ----------------------------
+class JobContext:
+    """Handed to job handlers: report progress / partial results, check for cancellation."""
 
-    if name.endswith(".docx"):
-        doc = DocxDocument(io.BytesIO(data))
-        return "\n".join([p.text for p in doc.paragraphs]).strip()
+    def __init__(self, job_id: str):
+        self.id = job_id
 
-    # txt/md/anything else -> treat as text
-    return data.decode("utf-8", errors="ignore").strip()
+    def progress(self, data: Dict[str, Any]) -> None:
+        with _state_lock, get_state_db() as conn:
+            conn.execute("UPDATE jobs SET progress = ? WHERE id = ?", (json.dumps(data), self.id))
 
+    def cancelled(self) -> bool:
+        with _state_lock:
+            row = get_state_db().execute("SELECT cancel_requested FROM jobs WHERE id = ?", (self.id,)).fetchone()
+        return bool(row and row["cancel_requested"])
 
-def ensure_embeddings() -> OllamaEmbeddings:
-    """Use EMBED_MODEL if available; fallback to LLM_MODEL for embeddings."""
-    global emb
-    if emb is not None:
-        return emb
-    primary = OllamaEmbeddings(model=EMBED_MODEL, base_url=OLLAMA_BASE_URL)
+
+def _pid_alive(pid: int) -> bool:
     try:
-        primary.embed_query("healthcheck")
-        emb = primary
-        return emb
-    except Exception:
-        fallback = OllamaEmbeddings(model=LLM_MODEL, base_url=OLLAMA_BASE_URL)
-        emb = fallback
-        return emb
-
-
-def ensure_vectorstore():
-    global vectorstore
-    if vectorstore is None:
-        ensure_embeddings()
-        vectorstore = Chroma(
-            collection_name=COLLECTION,
-            embedding_function=emb,
-            persist_directory=PERSIST_DIR,
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def start_job_workers() -> None:
+    """Start JOB_WORKERS worker threads (once per process) and re-queue jobs whose
+    worker process died mid-run; finished jobs older than JOB_TTL_S are pruned."""
+    global _job_threads
+    with _job_lock:
+        if _job_threads:
+            return
+        conn = get_state_db()
+        with _state_lock, conn:
+            rows = conn.execute("SELECT id, worker_pid FROM jobs WHERE status = 'running'").fetchall()
+            orphans = [(r["id"],) for r in rows if r["worker_pid"] == os.getpid() or not _pid_alive(r["worker_pid"] or 0)]
+            conn.executemany("UPDATE jobs SET status = 'queued', worker_pid = NULL WHERE id = ?", orphans)
+            finished = conn.execute(
+                "SELECT params FROM jobs WHERE kind = 'index' AND status IN ('done', 'error', 'cancelled')"
+            ).fetchall()
+            conn.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'error', 'cancelled') AND finished_ts < ?",
+                (int(time.time()) - JOB_TTL_S,),
+            )
+        # Uploads a finished index job never got to (cancelled while queued, or interrupted)
+        for r in finished:
+            _remove_upload(json.loads(r["params"]))
+        _job_threads = [
+            threading.Thread(target=_job_worker, name=f"job-worker-{i}", daemon=True) for i in range(JOB_WORKERS)
+        ]
+        for t in _job_threads:
+            t.start()
+
+
+def _claim_job() -> Optional[sqlite3.Row]:
+    with _state_lock, get_state_db() as conn:
+        return conn.execute(
+            """
+            UPDATE jobs SET status = 'running', worker_pid = ?, started_ts = ?
+            WHERE id = (SELECT id FROM jobs WHERE status = 'queued' ORDER BY created_ts, rowid LIMIT 1)
+            RETURNING id, kind, params
+            """,
+            (os.getpid(), int(time.time())),
+        ).fetchone()
+
+
+def _finish_job(job_id: str, status: str, result: Any = None, error: Optional[str] = None) -> None:
+    with _state_lock, get_state_db() as conn:
+        conn.execute(
+            "UPDATE jobs SET status = ?, result = ?, error = ?, finished_ts = ? WHERE id = ?",
+            (status, json.dumps(result) if result is not None else None, error, int(time.time()), job_id),
         )
-    return vectorstore
 
 
-def get_llm() -> ChatOllama:
-    """Lazily create and return the ChatOllama instance."""
-    global llm
-    if llm is not None:
-        return llm
-    llm = ChatOllama(model=LLM_MODEL, base_url=OLLAMA_BASE_URL)
-    return llm
+def _job_worker() -> None:
+    while True:
+        row = _claim_job()
+        if row is None:
+            _job_wakeup.wait(timeout=JOB_POLL_S)
+            _job_wakeup.clear()
+            continue
+        job = JobContext(row["id"])
+        handler = JOB_HANDLERS.get(row["kind"])
+        try:
+            if handler is None:
+                raise ValueError(f"Unknown job kind: {row['kind']}")
+            result = handler(json.loads(row["params"]), job)
+            _finish_job(job.id, "cancelled" if job.cancelled() else "done", result)
+        except Exception as e:
+            _finish_job(job.id, "error", error=f"{type(e).__name__}: {e}")
+
+
+def submit_job(kind: str, params: Optional[Dict[str, Any]] = None) -> str:
+    """Queue a job (kinds: JOB_HANDLERS) and return its ID."""
+    if kind not in JOB_HANDLERS:
+        raise ValueError(f"Unknown job kind: {kind}")
+    start_job_workers()
+    job_id = f"{new_id('job')}_{os.urandom(3).hex()}"
+    with _state_lock, get_state_db() as conn:
+        conn.execute(
+            "INSERT INTO jobs (id, kind, params, status, created_ts) VALUES (?, ?, ?, 'queued', ?)",
+            (job_id, kind, json.dumps(params or {}), int(time.time())),
+        )
+    _job_wakeup.set()
+    return job_id
+
+
+def _job_row(row: sqlite3.Row) -> Dict[str, Any]:
+    job = dict(row)
+    job["params"] = json.loads(job["params"])
+    for key in ("result", "progress"):
+        job[key] = json.loads(job[key]) if job[key] else None
+    job["cancel_requested"] = bool(job["cancel_requested"])
+    job.pop("worker_pid", None)
+    return job
+
+
+def get_job(job_id: str) -> Optional[Dict[str, Any]]:
+    with _state_lock:
+        row = get_state_db().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    return _job_row(row) if row else None
+
+
+def list_jobs(limit: int = 20) -> List[Dict[str, Any]]:
+    with _state_lock:
+        rows = get_state_db().execute(
+            "SELECT * FROM jobs ORDER BY created_ts DESC, rowid DESC LIMIT ?", (limit,)
+        ).fetchall()
+    return [_job_row(r) for r in rows]
+
+
+def cancel_job(job_id: str) -> bool:
+    """Cancel a queued job now, or ask a running one to stop at its next check."""
+    with _state_lock, get_state_db() as conn:
+        row = conn.execute("SELECT kind, params, status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        cur = conn.execute(
+            "UPDATE jobs SET status = CASE status WHEN 'queued' THEN 'cancelled' ELSE status END, "
+            "cancel_requested = 1, finished_ts = CASE status WHEN 'queued' THEN ? ELSE finished_ts END "
+            "WHERE id = ? AND status IN ('queued', 'running')",
+            (int(time.time()), job_id),
+        )
+    if cur.rowcount and row["status"] == "queued" and row["kind"] == "index":
+        _remove_upload(json.loads(row["params"]))  # the job will never run to clean up
+    return cur.rowcount > 0
 
 
-def build_context(query: str, note_id: Optional[str] = None) -> str:
-    vs = ensure_vectorstore()
-    if note_id:
-        retriever = vs.as_retriever(
-            search_kwargs={"k": TOP_K, "filter": {"note_id": note_id}}
-        )
-    else:
-        retriever = vs.as_retriever(search_kwargs={"k": TOP_K})
-    docs = retrieve_docs(retriever, query)
+def submit_index_job(files: List[Tuple[str, bytes]], note_id: Optional[str] = None) -> str:
+    """Queue an upload: files are written under JOB_UPLOAD_DIR so the job survives a restart."""
+    folder = os.path.join(JOB_UPLOAD_DIR, f"{new_id('upload')}_{os.urandom(3).hex()}")
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for i, (name, data) in enumerate(files):
+        path = os.path.join(folder, f"{i}_{os.path.basename(name)}")
+        with open(path, "wb") as f:
+            f.write(data)
+        paths.append([name, path])
+    return submit_job("index", {"files": paths, "note_id": note_id, "folder": folder})
 
-    return "\n\n".join(
-        [f"[{i+1}] {d.metadata.get('source','?')}\n{d.page_content}" for i, d in enumerate(docs)]
-    )
 
+def _remove_upload(params: Dict[str, Any]) -> None:
+    """Delete a queued upload's files (see submit_index_job)."""
+    if params.get("folder"):
+        shutil.rmtree(params["folder"], ignore_errors=True)
 
-def load_state() -> Dict[str, Any]:
-    global state_cache
-    if state_cache is not None:
-        return state_cache
-    os.makedirs(DATA_DIR, exist_ok=True)
-    if not os.path.exists(STATE_PATH):
-        state_cache = {"notes": {}, "chats": {}}
-        save_state(state_cache)
-        return state_cache
-    with open(STATE_PATH, "r", encoding="utf-8") as f:
-        state_cache = json.load(f)
-    state_cache.setdefault("notes", {})
-    state_cache.setdefault("chats", {})
-    return state_cache
-
-
-def save_state(state: Dict[str, Any]) -> None:
-    os.makedirs(DATA_DIR, exist_ok=True)
-    with open(STATE_PATH, "w", encoding="utf-8") as f:
-        json.dump(state, f, ensure_ascii=True, indent=2)
+
+def _index_job(params: Dict[str, Any], job: JobContext) -> Dict[str, Any]:
+    try:
+        files = []
+        for name, path in params["files"]:
+            with open(path, "rb") as f:
+                files.append((name, f.read()))
+        return index_files(files, note_id=params.get("note_id"), progress=job.progress)
+    finally:
+        _remove_upload(params)
+
+
+JOB_HANDLERS: Dict[str, Callable[[Dict[str, Any], JobContext], Any]] = {
+    "quiz": lambda p, job: generate_quiz(
+        p.get("topic") or "", int(p.get("n") or 10), p.get("note_id"), progress=job.progress, cancelled=job.cancelled
+    ),
+    "flashcards": lambda p, job: generate_flashcards(
+        p.get("topic") or "", int(p.get("n") or 10), p.get("note_id"), progress=job.progress
+    ),
+    "summary": lambda p, job: generate_summary(p.get("topic") or "", p.get("note_id")),
+    "mindmap": lambda p, job: generate_mindmap(p.get("topic") or "", p.get("note_id")),
+    "index": _index_job,
+}
 
 
-def new_id(prefix: str) -> str:
-    return f"{prefix}_{int(time.time() * 1000)}"
+# ----------------------------
+# Warm-up
+# ----------------------------
+warmup_status: Dict[str, Any] = {"state": "idle", "steps": {}, "error": None, "started_ts": None, "finished_ts": None}
+_warmup_lock = threading.Lock()
 
 
-def calculator_tool(expression: str) -> str:
-    """
-    Safe calculator tool for basic math operations.
-    Supports: +, -, *, /, ^, sqrt, sin, cos, tan, log, pi, e
+def _timed_step(name: str, fn: Callable[[], Any]) -> None:
+    started = time.perf_counter()
+    fn()
+    warmup_status["steps"][name] = round((time.perf_counter() - started) * 1000, 1)
+
+
+def _preload_llm() -> None:
+    # A generate request without a prompt only loads the model (and keeps it loaded)
+    res = get_ollama_http().post("/api/generate", json={"model": LLM_MODEL, "keep_alive": OLLAMA_KEEP_ALIVE})
+    res.raise_for_status()
+
+
+def _preload_embeddings() -> None:
+    # Bypass the embedding cache so the model is really loaded into Ollama
+    ensure_embeddings().inner.embed_query(WARMUP_QUERY)
+
+
+def _open_indexes() -> None:
+    for vs in list_partitions():
+        vs._collection.count()
+    get_lexical_index()
+    get_state_db()
+
+
+def warm_up() -> Dict[str, Any]:
+    """Preload the LLM and embedding model concurrently, open the vector, lexical
+    and state stores, then prime the caches with one synthetic retrieval.
+
+    Per-step milliseconds end up in `warmup_status`; a failed step (e.g. Ollama
+    not running) marks the warm-up failed but never raises.
     """
+    with _warmup_lock:
+        if warmup_status["state"] in ("running", "ready"):
+            return warmup_status
+        warmup_status.update(state="running", steps={}, error=None, started_ts=time.time(), finished_ts=None)
     try:
-        # Clean and validate the expression
-        allowed_chars = set('0123456789+-*/().^ sqrtincologepi')
-        expr = expression.lower().replace(' ', '')
-        
-        if not all(c in allowed_chars for c in expr.replace('sqrt', '').replace('sin', '').replace('cos', '').replace('tan', '').replace('log', '').replace('pi', '').replace('e', '')):
-            return "Error: Invalid characters in expression"
-        
-        # Replace math symbols
-        expr = expr.replace('^', '**')
-        expr = expr.replace('sqrt', 'math.sqrt')
-        expr = expr.replace('sin', 'math.sin')
-        expr = expr.replace('cos', 'math.cos')
-        expr = expr.replace('tan', 'math.tan')
-        expr = expr.replace('log', 'math.log10')
-        expr = expr.replace('pi', str(math.pi))
-        expr = expr.replace('e', str(math.e))
-        
-        # Evaluate safely
-        result = eval(expr, {"__builtins__": {}, "math": math})
-        return f"Result: {result}"
+        with ThreadPoolExecutor(max_workers=3, thread_name_prefix="warmup") as pool:
+            futures = [
+                pool.submit(_timed_step, "llm", _preload_llm),
+                pool.submit(_timed_step, "embeddings", _preload_embeddings),
+                pool.submit(_timed_step, "indexes", _open_indexes),
+            ]
+            for fut in futures:
+                fut.result()
+        _timed_step("retrieval", lambda: retrieve_scored(WARMUP_QUERY))
+        warmup_status["state"] = "ready"
     except Exception as e:
-        return f"Calculation error: {str(e)}"
+        warmup_status.update(state="failed", error=f"{type(e).__name__}: {e}")
+    warmup_status["finished_ts"] = time.time()
+    return warmup_status
 
 
-def ask_with_tools(question: str, note_id: str = None) -> str:
-    """
-    Enhanced Q&A that can use tools when needed.
-    The LLM decides whether to use a tool based on the question.
-    """
-    llm = get_llm()
-    
-    # First, ask the LLM if it needs a tool
+def start_warm_up() -> None:
+    """Run warm_up() on a background thread (once per process; retried after a failure)."""
+    with _warmup_lock:
+        if warmup_status["state"] in ("running", "ready"):
+            return
+    threading.Thread(target=warm_up, name="warmup", daemon=True).start()
+
+
+def is_ready() -> bool:
+    return warmup_status["state"] == "ready"
+
+
+# ----------------------------
+# Tool routing
+# ----------------------------
+_MATH_WORDS = re.compile(
+    r"\b(calculate|calculation|compute|evaluate|solve|sqrt|square root|squared|cubed|plus|minus|"
+    r"times|multiplied|divided|percent|percentage|sum of|product of|how much is|power of|"
+    r"sin|cos|tan|log)\b",
+    re.IGNORECASE,
+)
+_WORD_OPERATORS = [
+    (r"\bsquare root of\s*([\d.]+)", r"sqrt(\1)"),
+    (r"\bto the power of\b", "^"),
+    (r"\b(multiplied by|times)\b", "*"),
+    (r"\bdivided by\b", "/"),
+    (r"\bplus\b", "+"),
+    (r"\bminus\b", "-"),
+    (r"([\d.]+)\s*squared\b", r"\1^2"),
+    (r"([\d.]+)\s*cubed\b", r"\1^3"),
+    (r"(?<=\d)\s*[x×]\s*(?=\d)", "*"),
+    (r"÷", "/"),
+]
+# A number, with an optional exponent ("1e5", "2.5E-3")
+_NUMBER = r"(?:\d+\.?\d*|\.\d+)(?:e[+-]?\d+)?"
+_OPERAND = rf"(?:(?:sqrt|sin|cos|tan|log)\s*)?[(\s]*{_NUMBER}[\s()]*"
+_EXPRESSION = re.compile(
+    rf"{_OPERAND}(?:[-+*/^]\s*{_OPERAND})+"
+    rf"|(?:sqrt|sin|cos|tan|log)\s*\(\s*{_NUMBER}\s*\)",
+    re.IGNORECASE,
+)
+# "1914-1918", "pages 10-20", "page 2/3", "section 1.2-1.3": ranges and
+# references, arithmetic only with a math cue (see _has_math_cue)
+_REFERENCE = re.compile(r"\d+(?:\.\d+)*[-/]\d+(?:\.\d+)*")
+# "the 2020 - 2021 season", "1939 – 45": a year range even when spaced like
+# arithmetic; without a math word the rules leave it to the classifiers
+_YEAR_RANGE = re.compile(r"\b(?:1[5-9]|20)\d\d\s*[-–]\s*\d{2,4}\b")
+# Prototype questions for the optional embedding tie-breaker
+_ROUTER_PROTOTYPES = {
+    "calculator": [
+        "How much is 15 percent of 240?",
+        "Calculate the area of a circle with radius 3",
+        "What is the square root of 81?",
+        "Compute the average of these numbers",
+    ],
+    "none": [
+        "Explain how photosynthesis works",
+        "What is the main idea of chapter two?",
+        "Summarize the causes of World War I",
+        "Define the term osmosis",
+    ],
+}
+_router_prototype_vectors: Optional[Dict[str, List[List[float]]]] = None
+_routing_log_lock = threading.Lock()
+
+
+def extract_expression(question: str) -> Optional[str]:
+    """Pull a calculator expression out of a question, or None."""
+    text = question
+    for pattern, repl in _WORD_OPERATORS:
+        text = re.sub(pattern, repl, text, flags=re.IGNORECASE)
+    candidates = [m.group(0).strip() for m in _EXPRESSION.finditer(text)]
+    for expr in sorted(candidates, key=len, reverse=True):
+        if calculator_tool(expr).startswith("Result:"):
+            return expr
+    return None
+
+
+def _has_math_cue(question: str) -> bool:
+    """Math words, an equals sign, or operators written as arithmetic."""
+    return bool(
+        _MATH_WORDS.search(question)
+        or "=" in question
+        or re.search(r"\d\s+[-+*/^%]\s+\d|\d\s*[+*^%×÷]\s*\d", question)
+    )
+
+
+def _embedding_route(question: str) -> Optional[str]:
+    """Nearest-prototype vote; None when the margin is too small to trust."""
+    global _router_prototype_vectors
+    embedder = ensure_embeddings()
+    if _router_prototype_vectors is None:
+        _router_prototype_vectors = {
+            label: [_normalize(v) for v in embedder.embed_documents(examples)]
+            for label, examples in _ROUTER_PROTOTYPES.items()
+        }
+    q = _normalize(embedder.embed_query(question))
+    best = {
+        label: max(sum(a * b for a, b in zip(q, v)) for v in vectors)
+        for label, vectors in _router_prototype_vectors.items()
+    }
+    if abs(best["calculator"] - best["none"]) < ROUTER_EMBED_MARGIN:
+        return None
+    return "calculator" if best["calculator"] > best["none"] else "none"
+
+
+def _llm_tool_route(question: str) -> Optional[str]:
+    """The original LLM round-trip: returns a calculator expression or None."""
     tool_check_prompt = f"""You are a study assistant with access to tools.
 
 Available tools:
@@ -216,21 +3125,100 @@ Question: {question}
 If this question requires a calculation, respond ONLY with the calculator call like [CALC: expression].
 If no calculation is needed, respond with: NO_TOOL_NEEDED"""
 
-    tool_response = llm.invoke(tool_check_prompt).content.strip()
-    
-    # Check if LLM wants to use calculator
+    tool_response = get_llm().invoke(tool_check_prompt).content.strip()
     calc_match = re.search(r'\[CALC:\s*([^\]]+)\]', tool_response)
-    
-    tool_result = None
-    if calc_match:
-        expression = calc_match.group(1)
-        tool_result = calculator_tool(expression)
-    
-    # Now generate final answer
-    ctx = build_context(question, note_id=note_id)
-    
+    return calc_match.group(1) if calc_match else None
+
+
+def _log_routing(question: str, decision: Dict[str, Any]) -> None:
+    try:
+        os.makedirs(DATA_DIR, exist_ok=True)
+        line = json.dumps({"ts": int(time.time()), "question": question, **decision}, ensure_ascii=True)
+        with _routing_log_lock, open(ROUTING_LOG_PATH, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+    except OSError:
+        pass
+
+
+def route_tool(question: str) -> Dict[str, Any]:
+    """Decide whether a question needs the calculator, without an LLM call
+    when possible.
+
+    Regex/number heuristics settle clear cases; ambiguous ones go to the
+    optional embedding classifier and finally to the LLM. Every decision is
+    appended to ROUTING_LOG_PATH for accuracy review.
+    """
+    started = time.perf_counter()
+    expression = extract_expression(question)
+    if expression and _REFERENCE.fullmatch(expression) and not _has_math_cue(question):
+        decision = {"tool": None, "expression": None, "source": "rules"}
+    elif expression and not (_YEAR_RANGE.search(question) and not _MATH_WORDS.search(question)):
+        decision = {"tool": "calculator", "expression": expression, "source": "rules"}
+    elif not expression and not _MATH_WORDS.search(question) and not re.search(r"\d\s*[-+*/^=%]\s*\d", question):
+        decision = {"tool": None, "expression": None, "source": "rules"}
+    else:
+        label = None
+        if ROUTER_USE_EMBEDDINGS:
+            try:
+                label = _embedding_route(question)
+            except Exception:
+                label = None
+        if label == "none":
+            decision = {"tool": None, "expression": None, "source": "embeddings"}
+        else:
+            # Math-like but no usable expression: let the LLM write one
+            expression = _llm_tool_route(question)
+            decision = {
+                "tool": "calculator" if expression else None,
+                "expression": expression,
+                "source": "llm",
+            }
+    decision["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 3)
+    _log_routing(question, decision)
+    return decision
+
+
+# ----------------------------
+# Step graph executor
+# ----------------------------
+def run_step_graph(
+    steps: Dict[str, Tuple[Callable[..., Any], List[str]]],
+) -> Tuple[Dict[str, Any], Dict[str, float]]:
+    """Run named steps concurrently, each as soon as its dependencies finish.
+
+    `steps` maps name -> (fn, [dependency names]); fn is called with the
+    dependencies' results as keyword arguments. Returns (results, timings in ms).
+    """
+    results: Dict[str, Any] = {}
+    timings: Dict[str, float] = {}
+    pending = dict(steps)
+    running: Dict[Any, str] = {}
+    started = time.perf_counter()
+
+    def timed(fn, kwargs):
+        t0 = time.perf_counter()
+        out = fn(**kwargs)
+        return out, (time.perf_counter() - t0) * 1000
+
+    with ThreadPoolExecutor(max_workers=max(len(steps), 1)) as pool:
+        while pending or running:
+            for name in [n for n, (_, deps) in pending.items() if all(d in results for d in deps)]:
+                fn, deps = pending.pop(name)
+                fut = pool.submit(timed, fn, {d: results[d] for d in deps})
+                running[fut] = name
+            if not running:
+                raise ValueError(f"Unsatisfiable step dependencies: {sorted(pending)}")
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for fut in done:
+                name = running.pop(fut)
+                results[name], timings[name] = fut.result()
+    timings["total"] = (time.perf_counter() - started) * 1000
+    return results, {k: round(v, 1) for k, v in timings.items()}
+
+
+def _tools_answer_prompt(question: str, ctx: str, tool_result: Optional[str]) -> str:
     if tool_result:
-        final_prompt = f"""You are "My Learning Buddy" — a friendly study helper.
+        return f"""You are "My Learning Buddy" — a friendly study helper.
 
 You used the calculator tool and got: {tool_result}
 
@@ -240,8 +3228,7 @@ Context from notes:
 Question: {question}
 
 Provide a helpful answer incorporating the calculation result. Explain the math if relevant."""
-    else:
-        final_prompt = f"""You are "My Learning Buddy" — a friendly study helper.
+    return f"""You are "My Learning Buddy" — a friendly study helper.
 
 Context from notes:
 {ctx}
@@ -250,21 +3237,51 @@ Question: {question}
 
 Answer based on the context above."""
 
-    return llm.invoke(final_prompt).content
+
+def ask_with_tools_detailed(question: str, note_id: str = None) -> dict:
+    """
+    ask_with_tools as a step graph: safety check, tool routing (+ calculator)
+    and vector search run concurrently; only the final generation waits on
+    all of them. Returns the answer plus per-step timings in ms.
+    """
+    def answer(safety, tool, retrieve):
+        if safety["action"] == "refuse":
+            return (
+                f"I'm sorry, but I can't help with that. {safety['reason']} "
+                "Please consult an appropriate professional for this type of question."
+            )
+        return get_llm().invoke(_tools_answer_prompt(question, retrieve, tool)).content
+
+    results, timings = run_step_graph({
+        "safety": (lambda: check_safety(question), []),
+        "route": (lambda: route_tool(question), []),
+        "retrieve": (lambda: build_context(question, note_id=note_id), []),
+        "tool": (
+            lambda route: calculator_tool(route["expression"]) if route["tool"] == "calculator" else None,
+            ["route"],
+        ),
+        "answer": (answer, ["safety", "tool", "retrieve"]),
+    })
+    return {
+        "answer": results["answer"],
+        "tool_result": results["tool"],
+        "route": results["route"],
+        "safety": results["safety"],
+        "timings_ms": timings,
+    }
 
 
-def researcher_agent(question: str, note_id: str = None) -> str:
+def ask_with_tools(question: str, note_id: str = None) -> str:
     """
-    Agent 1: Researcher - Finds and extracts relevant information.
-    Returns raw facts without explanation.
+    Enhanced Q&A that can use tools when needed.
+    route_tool decides locally whether to use a tool; the LLM is only asked
+    for ambiguous questions.
     """
-    llm = get_llm()
-    ctx = build_context(question, note_id=note_id)
-    
-    if not ctx or not ctx.strip():
-        return "No relevant information found in the uploaded documents."
-    
-    prompt = f"""You are a RESEARCHER agent. Your job is to:
+    return ask_with_tools_detailed(question, note_id)["answer"]
+
+
+def _researcher_prompt(question: str, ctx: str) -> str:
+    return f"""You are a RESEARCHER agent. Your job is to:
 1. Find relevant facts from the provided context
 2. Extract key information that answers the question
 3. List facts as bullet points - be precise and factual
@@ -278,18 +3295,24 @@ CONTEXT:
 QUESTION: {question}
 
 EXTRACTED FACTS:"""
-    
-    return llm.invoke(prompt).content
 
 
-def teacher_agent(question: str, research_facts: str) -> str:
+def researcher_agent(question: str, note_id: str = None) -> str:
     """
-    Agent 2: Teacher - Takes research and explains it clearly.
-    Makes content student-friendly and engaging.
+    Agent 1: Researcher - Finds and extracts relevant information.
+    Returns raw facts without explanation.
     """
     llm = get_llm()
+    ctx = build_context(question, note_id=note_id)
+    
+    if not ctx or not ctx.strip():
+        return "No relevant information found in the uploaded documents."
     
-    prompt = f"""You are a TEACHER agent named "My Learning Buddy". Your job is to:
+    return llm.invoke(_researcher_prompt(question, ctx)).content
+
+
+def _teacher_prompt(question: str, research_facts: str) -> str:
+    return f"""You are a TEACHER agent named "My Learning Buddy". Your job is to:
 1. Take the research facts provided below
 2. Explain them in a friendly, easy-to-understand way
 3. Add helpful examples or analogies if useful
@@ -305,26 +3328,257 @@ RESEARCH FACTS:
 STUDENT'S QUESTION: {question}
 
 YOUR FRIENDLY EXPLANATION:"""
-    
-    return llm.invoke(prompt).content
 
 
-def ask_with_agents(question: str, note_id: str = None) -> dict:
+def teacher_agent(question: str, research_facts: str) -> str:
+    """
+    Agent 2: Teacher - Takes research and explains it clearly.
+    Makes content student-friendly and engaging.
+    """
+    llm = get_llm()
+    return llm.invoke(_teacher_prompt(question, research_facts)).content
+
+
+def teacher_agent_stream(question: str, research_facts: str) -> Iterator[str]:
+    """Streaming variant of teacher_agent: yields the explanation token by token."""
+    return stream_llm(_teacher_prompt(question, research_facts))
+
+
+def _fused_prompt(question: str, ctx: str) -> str:
+    return f"""You are "My Learning Buddy", a study helper working in two steps.
+
+STEP 1 - RESEARCH: list the facts from the CONTEXT that answer the question as
+bullet points, with source references [1], [2], etc. Be precise and factual.
+
+STEP 2 - TEACH: explain those facts to the student in a friendly, easy-to-understand
+way, with helpful examples or analogies if useful. Do NOT add facts beyond Step 1.
+If the context has nothing relevant, kindly tell the student to upload relevant materials.
+
+Use exactly this format:
+FACTS:
+- ...
+EXPLANATION:
+...
+
+CONTEXT:
+{ctx}
+
+STUDENT'S QUESTION: {question}
+
+FACTS:"""
+
+
+_EXPLANATION_MARKER = re.compile(r"\**EXPLANATION\**\s*:\**", re.IGNORECASE)
+
+
+def _split_fused(text: str) -> Tuple[str, str]:
+    """Split a fused generation into (facts, explanation)."""
+    m = _EXPLANATION_MARKER.search(text)
+    if not m:
+        return "", text.strip()
+    return text[: m.start()].strip(), text[m.end() :].strip()
+
+
+def _top_score(scored: List[Tuple[Document, float]]) -> float:
+    return max((score for _, score in scored), default=0.0)
+
+
+def _choose_agent_path(scored: List[Tuple[Document, float]], mode: Optional[str]) -> str:
+    if _top_score(scored) >= FAST_PATH_MIN_SCORE:
+        return "fast"
+    return mode or AGENT_MODE
+
+
+def _skipped_research_note(top_score: float) -> str:
+    return f"(Researcher skipped: retrieved context is highly relevant, score {top_score:.2f})"
+
+
+def ask_with_agents(question: str, note_id: str = None, mode: Optional[str] = None) -> dict:
     """
     Multi-agent Q&A: Researcher finds info, Teacher explains it.
-    Returns both intermediate and final results for transparency.
+    Returns both intermediate and final results for transparency, plus
+    "path": "fast" (Teacher only), "fused" (one generation) or "two_pass".
     """
-    # Agent 1: Research
-    research_output = researcher_agent(question, note_id)
-    
-    # Agent 2: Teach
-    teacher_output = teacher_agent(question, research_output)
+    cached = answer_cache.lookup(question, note_id, "agents")
+    if cached is not None:
+        return dict(cached, cached=True)
+
+    scored = retrieve_scored(question, note_id)
+    ctx = format_context(pack_context([d for d, _ in scored]))
+    top_score = _top_score(scored)
+    path = _choose_agent_path(scored, mode)
+    llm = get_llm()
+
+    if not ctx.strip():
+        research_output = "No relevant information found in the uploaded documents."
+        teacher_output = teacher_agent(question, research_output)
+    elif path == "fast":
+        research_output = _skipped_research_note(top_score)
+        teacher_output = teacher_agent(question, ctx)
+    elif path == "fused":
+        research_output, teacher_output = _split_fused(llm.invoke(_fused_prompt(question, ctx)).content)
+    else:
+        # Agent 1: Research
+        research_output = llm.invoke(_researcher_prompt(question, ctx)).content
+        # Agent 2: Teach
+        teacher_output = teacher_agent(question, research_output)
     
-    return {
+    result = {
         "researcher_output": research_output,
         "teacher_output": teacher_output,
-        "final_answer": teacher_output
+        "final_answer": teacher_output,
+        "path": path,
+        "top_score": top_score,
     }
+    answer_cache.store(question, note_id, "agents", result)
+    return result
+
+
+def _stream_explanation(tokens: Iterator[str], result: dict) -> Iterator[str]:
+    """Yield only the EXPLANATION part of a fused generation; the FACTS part is
+    stored in result["researcher_output"] once the marker is seen."""
+    buffer = ""
+    in_explanation = False
+    for token in tokens:
+        if in_explanation:
+            yield token
+            continue
+        buffer += token
+        m = _EXPLANATION_MARKER.search(buffer)
+        if m:
+            in_explanation = True
+            result["researcher_output"] = buffer[: m.start()].strip()
+            rest = buffer[m.end() :].lstrip()
+            if rest:
+                yield rest
+    if not in_explanation:
+        # No marker: treat the whole generation as the explanation
+        result["researcher_output"] = ""
+        yield buffer
+
+
+async def _astream_explanation(tokens: AsyncIterator[str], result: dict) -> AsyncIterator[str]:
+    buffer = ""
+    in_explanation = False
+    async for token in tokens:
+        if in_explanation:
+            yield token
+            continue
+        buffer += token
+        m = _EXPLANATION_MARKER.search(buffer)
+        if m:
+            in_explanation = True
+            result["researcher_output"] = buffer[: m.start()].strip()
+            rest = buffer[m.end() :].lstrip()
+            if rest:
+                yield rest
+    if not in_explanation:
+        result["researcher_output"] = ""
+        yield buffer
+
+
+def ask_with_agents_stream(question: str, note_id: str = None, mode: Optional[str] = None) -> dict:
+    """
+    Like ask_with_agents, but the Teacher's answer is returned as a token
+    iterator under "answer_stream" so it can be rendered as it is generated.
+    On the fused path "researcher_output" is filled in while streaming.
+    """
+    cached = answer_cache.lookup(question, note_id, "agents")
+    if cached is not None:
+        return {
+            "researcher_output": cached["researcher_output"],
+            "answer_stream": iter([cached["final_answer"]]),
+            "path": cached.get("path"),
+            "cached": True,
+        }
+
+    scored = retrieve_scored(question, note_id)
+    ctx = format_context(pack_context([d for d, _ in scored]))
+    top_score = _top_score(scored)
+    path = _choose_agent_path(scored, mode)
+    result: Dict[str, Any] = {"path": path, "top_score": top_score}
+
+    if not ctx.strip():
+        result["researcher_output"] = "No relevant information found in the uploaded documents."
+        tokens = teacher_agent_stream(question, result["researcher_output"])
+    elif path == "fast":
+        result["researcher_output"] = _skipped_research_note(top_score)
+        tokens = teacher_agent_stream(question, ctx)
+    elif path == "fused":
+        result["researcher_output"] = None
+        tokens = _stream_explanation(stream_llm(_fused_prompt(question, ctx)), result)
+    else:
+        result["researcher_output"] = get_llm().invoke(_researcher_prompt(question, ctx)).content
+        tokens = teacher_agent_stream(question, result["researcher_output"])
+
+    def answer_stream():
+        parts = []
+        for token in tokens:
+            parts.append(token)
+            yield token
+        answer = "".join(parts)
+        answer_cache.store(question, note_id, "agents", {
+            "researcher_output": result["researcher_output"],
+            "teacher_output": answer,
+            "final_answer": answer,
+            "path": path,
+            "top_score": top_score,
+        })
+
+    result["answer_stream"] = answer_stream()
+    return result
+
+
+async def aask_with_agents_stream(question: str, note_id: str = None, mode: Optional[str] = None) -> dict:
+    """Async ask_with_agents_stream: "answer_stream" is an async token iterator."""
+    cached = await answer_cache.alookup(question, note_id, "agents")
+    if cached is not None:
+
+        async def cached_stream():
+            yield cached["final_answer"]
+
+        return {
+            "researcher_output": cached["researcher_output"],
+            "answer_stream": cached_stream(),
+            "path": cached.get("path"),
+            "cached": True,
+        }
+
+    scored = await aretrieve_scored(question, note_id)
+    ctx = format_context(pack_context([d for d, _ in scored]))
+    top_score = _top_score(scored)
+    path = _choose_agent_path(scored, mode)
+    result: Dict[str, Any] = {"path": path, "top_score": top_score}
+
+    if not ctx.strip():
+        result["researcher_output"] = "No relevant information found in the uploaded documents."
+        tokens = astream_llm(_teacher_prompt(question, result["researcher_output"]))
+    elif path == "fast":
+        result["researcher_output"] = _skipped_research_note(top_score)
+        tokens = astream_llm(_teacher_prompt(question, ctx))
+    elif path == "fused":
+        result["researcher_output"] = None
+        tokens = _astream_explanation(astream_llm(_fused_prompt(question, ctx)), result)
+    else:
+        result["researcher_output"] = await ainvoke_llm(_researcher_prompt(question, ctx))
+        tokens = astream_llm(_teacher_prompt(question, result["researcher_output"]))
+
+    async def answer_stream():
+        parts = []
+        async for token in tokens:
+            parts.append(token)
+            yield token
+        answer = "".join(parts)
+        await answer_cache.astore(question, note_id, "agents", {
+            "researcher_output": result["researcher_output"],
+            "teacher_output": answer,
+            "final_answer": answer,
+            "path": path,
+            "top_score": top_score,
+        })
+
+    result["answer_stream"] = answer_stream()
+    return result
     
     
 SAFETY_RULES = {
@@ -1,6 +1,5 @@
 import streamlit as st
 import io
-import time
 from typing import Optional
 
 import core as api
@@ -10,545 +9,224 @@ st.set_page_config(page_title="My Learning Buddy", layout="wide")
 
 
 def load_notes():
-    return api.load_state()
+    return api.list_notes()
 
 
 def create_note(title: str):
-    state = api.load_state()
-    note_id = api.new_id("note")
-    state["notes"][note_id] = {"title": title}
-    api.save_state(state)
-    return note_id
+    return api.create_note(title)
 
 
-def ingest_files(files, note_id: Optional[str] = None):
-    import shutil
-    import os
-    
-    # Clear old data first (fresh start with each upload)
-    chroma_path = "./chroma_db"
-    if os.path.exists(chroma_path):
-        shutil.rmtree(chroma_path)
-    # Reset the vectorstore reference
-    api.vectorstore = None
-    
-    raw_docs = []
-    for f in files:
-        data = f.read()
-        text = api.extract_text(getattr(f, "name", "upload"), data)
-        if text:
-            meta = {"source": getattr(f, "name", "upload")}
-            if note_id:
-                meta["note_id"] = note_id
-            raw_docs.append(api.Document(page_content=text, metadata=meta))
-    if not raw_docs:
-        return {"ok": False, "message": "No extractable text"}
-
-    splitter = api.RecursiveCharacterTextSplitter(chunk_size=900, chunk_overlap=150)
-    splits = splitter.split_documents(raw_docs)
-
-    vs = api.ensure_vectorstore()
-    vs.add_documents(splits)
-    return {"ok": True, "docs": len(raw_docs), "chunks": len(splits)}
+# ----------------------------
+# Caching: widget reruns reuse generated artifacts instead of touching disk or
+# the models. LLM, embedding and vectorstore handles are shared per process by
+# core's ResourcePool (which also swaps them after a rebuild).
+# ----------------------------
+# Uploads and summary builds started elsewhere (e.g. through the API) are not
+# seen by api.local_version; cached precomputed summaries expire after this long
+SUMMARY_CACHE_TTL_S = 30
 
 
-def ask_question(question: str, note_id: Optional[str] = None):
-    ctx = api.build_context(question, note_id=note_id)
-    
-    # Check if we have meaningful context
-    has_context = ctx and ctx.strip() and ctx.strip() not in ["", "No relevant context found.", "None"]
-    
-    if has_context:
-        prompt = f"""You are "My Learning Buddy" — a friendly study helper.
+def summary_key():
+    """Cache key part that changes whenever documents or precomputed summaries
+    change in this process (an in-memory counter, no database read)."""
+    return api.local_version
 
-YOUR JOB: Answer the user's question using ONLY the context provided below.
 
-RULES:
-1. If the answer IS in the context → Answer clearly and friendly, cite with [1], [2] where helpful
-2. If the answer is NOT in the context → Say "I couldn't find information about [topic] in your notes."
-3. NEVER add information from outside the context
-4. NEVER guess or make things up
-5. Keep answers clear and helpful
+class NotCached(Exception):
+    """Raised out of a cached function to return a value without caching it
+    (st.cache_data never caches exceptions)."""
 
-CONTEXT FROM USER'S NOTES:
-{ctx}
+    def __init__(self, value):
+        super().__init__()
+        self.value = value
 
-QUESTION: {question}
 
-Answer based ONLY on the context above:"""
-    else:
-        prompt = f"""You are "My Learning Buddy" — a friendly study helper.
+def uncached_ok(fn, *args):
+    try:
+        return fn(*args)
+    except NotCached as e:
+        return e.value
 
-The user asked: "{question}"
 
-You searched their notes but found no relevant information about this topic.
+def is_usable_mindmap(out: str) -> bool:
+    data = api.parse_json_loose(out or "")
+    return isinstance(data, dict) and bool(data.get("branches")) and data.get("title") != "No Content"
 
-Respond with a short, friendly message (2-3 sentences):
-- Let them know you couldn't find this in their notes
-- Suggest uploading materials about this topic
-- Do NOT explain or define the term — just say it's not in their notes"""
 
-    llm = api.get_llm()
-    out = llm.invoke(prompt).content
-    
-    if note_id:
-        state = api.load_state()
-        state.setdefault("chats", {})
-        state["chats"].setdefault(note_id, [])
-        state["chats"][note_id].append({"question": question, "answer": out, "ts": int(time.time())})
-        api.save_state(state)
+@st.cache_data(show_spinner=False, max_entries=64, ttl=SUMMARY_CACHE_TTL_S)
+def _precomputed_summary(note_id: Optional[str], level: str, key):
+    out = api.get_summary_node(note_id, level)
+    if out is None:
+        raise NotCached(None)  # may still be building: look again next time
     return out
 
 
-def generate_summary(topic: str, note_id: Optional[str] = None):
-    ctx = api.build_context(topic or "main topics", note_id=note_id)
-    
-    topic_text = f'about "{topic}"' if topic.strip() else "from the materials"
-    
-    prompt = f"""You are "My Learning Buddy" — a friendly study helper creating summaries from the user's own notes.
+def precomputed_summary(note_id: Optional[str], level: str, key):
+    """Precomputed study summary ("note") or mind map ("mindmap"), if current."""
+    return uncached_ok(_precomputed_summary, note_id, level, key)
 
-RULES:
-- Use ONLY information from the CONTEXT below — don't add outside knowledge
-- Keep it student-friendly and easy to understand
-- Be encouraging and supportive in tone
 
-Create a helpful study summary {topic_text} with:
-📌 **Key Points** (clear bullet points of the main ideas)
-📖 **Important Definitions** (key terms explained simply)
-❓ **Review Questions** (5 questions to test understanding)
+@st.cache_data(show_spinner=False, max_entries=32)
+def _generated_mindmap(topic: str, note_id: Optional[str], version: int) -> str:
+    out = api.generate_mindmap(topic, note_id)
+    if not is_usable_mindmap(out):
+        raise NotCached(out)  # failed or empty: Generate again retries
+    return out
 
-CONTEXT FROM USER'S NOTES:
-{ctx}
 
-Make it clear, organized, and helpful for studying!"""
-    
-    llm = api.get_llm()
-    return llm.invoke(prompt).content
+def generated_mindmap(topic: str, note_id: Optional[str], version: int) -> str:
+    """Mind map for a topic, reused until the note's documents change."""
+    return uncached_ok(_generated_mindmap, topic, note_id, version)
 
 
-def generate_flashcards(topic: str, n: int = 10, note_id: Optional[str] = None):
-    import re
-    import json
-    
-    ctx = api.build_context(topic or "key concepts", note_id=note_id)
-    
-    # Check if we have context
-    if not ctx or not ctx.strip() or ctx.strip() in ["No relevant context found.", "None", ""]:
-        return {"flashcards": [], "error": "No documents uploaded. Please upload study materials first."}
-    
-    # Very simple prompt for small models
-    prompt = f"""Read this text and create {n} flashcards.
+def invalidate_caches():
+    """Drop cached artifacts after an upload (keys would miss anyway; this frees them)."""
+    _precomputed_summary.clear()
+    _generated_mindmap.clear()
 
-TEXT:
-{ctx}
 
-Create flashcards as JSON. Example:
-{{"flashcards": [{{"front": "What is DNA?", "back": "DNA is the molecule that carries genetic information."}}]}}
+def ingest_files(files, note_id: Optional[str] = None) -> str:
+    """Queue the files for indexing in the background; returns the job ID."""
+    pairs = [(getattr(f, "name", "upload"), f.getvalue()) for f in files]
+    return api.submit_index_job(pairs, note_id=note_id)
 
-Your {n} flashcards as JSON:"""
 
-    llm = api.get_llm()
-    raw_output = llm.invoke(prompt).content
-    
-    # Clean up the response
-    out = raw_output.strip()
-    
-    # Remove markdown code blocks
-    out = re.sub(r'```json\s*\n?', '', out)
-    out = re.sub(r'```\s*\n?', '', out)
-    out = out.strip()
-    
-    # Fix common JSON issues from small models
-    out = re.sub(r',\s*([}\]])', r'\1', out)  # Remove trailing commas
-    
-    # Try to fix single quotes to double quotes
-    # This is tricky - we need to be careful about apostrophes in text
-    if "'" in out and '"' not in out:
-        # Likely using single quotes for JSON
-        out = out.replace("'", '"')
-    
-    # Try to parse JSON with multiple strategies
-    result = None
-    
-    # Strategy 1: Direct parse
-    try:
-        result = json.loads(out)
-    except:
-        pass
-    
-    # Strategy 2: Find JSON object containing "flashcards"
-    if result is None:
-        try:
-            # Find the start of the JSON object
-            start = out.find('{')
-            if start >= 0:
-                depth = 0
-                end = start
-                for i, char in enumerate(out[start:], start):
-                    if char == '{':
-                        depth += 1
-                    elif char == '}':
-                        depth -= 1
-                        if depth == 0:
-                            end = i + 1
-                            break
-                json_str = out[start:end]
-                result = json.loads(json_str)
-        except:
-            pass
-    
-    # Strategy 3: Find array and wrap it
-    if result is None:
-        try:
-            arr_start = out.find('[')
-            if arr_start >= 0:
-                depth = 0
-                end = arr_start
-                for i, char in enumerate(out[arr_start:], arr_start):
-                    if char == '[':
-                        depth += 1
-                    elif char == ']':
-                        depth -= 1
-                        if depth == 0:
-                            end = i + 1
-                            break
-                arr_str = out[arr_start:end]
-                arr = json.loads(arr_str)
-                if isinstance(arr, list):
-                    result = {"flashcards": arr}
-        except:
-            pass
-    
-    # Strategy 4: Try to extract front/back pairs with regex
-    if result is None:
-        try:
-            # Look for patterns like "front": "...", "back": "..."
-            pattern = r'"front"\s*:\s*"([^"]+)"\s*,\s*"back"\s*:\s*"([^"]+)"'
-            matches = re.findall(pattern, out)
-            if matches:
-                result = {"flashcards": [{"front": m[0], "back": m[1]} for m in matches]}
-        except:
-            pass
-    
-    # Strategy 5: Fallback to api parser
-    if result is None:
-        result = api.parse_json_loose(out)
-    
-    # Always include raw for debugging
-    if isinstance(result, dict):
-        result["_raw"] = raw_output[:1500]
-    else:
-        result = {"flashcards": [], "_raw": raw_output[:1500], "error": "Could not parse response"}
-    
-    # Validate and clean flashcards
-    if isinstance(result, dict) and "flashcards" in result and isinstance(result["flashcards"], list):
-        clean_cards = []
-        for card in result["flashcards"]:
-            if not isinstance(card, dict):
-                continue
-            
-            # Get front and back, handle different key names
-            front = card.get("front") or card.get("question") or card.get("q") or ""
-            back = card.get("back") or card.get("answer") or card.get("a") or ""
-            
-            front = str(front).strip()
-            back = str(back).strip()
-            
-            # Skip empty or placeholder cards
-            if not front or not back:
-                continue
-            if front in ["...", "[term]", "What is [term]?"]:
-                continue
-            if back in ["...", "[Definition - 2-3 sentences]", "[definition]"]:
-                continue
-            if len(front) < 5 or len(back) < 5:
-                continue
-                
-            # Ensure front is a question (add ? if missing)
-            if not front.endswith("?") and not front.endswith(":"):
-                if front.lower().startswith(("what", "who", "when", "where", "why", "how", "which", "explain", "describe", "define")):
-                    front = front + "?"
-            
-            clean_cards.append({"front": front, "back": back})
-        
-        result["flashcards"] = clean_cards
-        
-        if not clean_cards and "error" not in result:
-            result["error"] = "No valid flashcards could be extracted from the model response."
-    
-    elif "error" not in result:
-        result["flashcards"] = []
-        result["error"] = "Could not parse flashcards from model response"
-    
-    return result
+def render_upload_progress(p):
+    """Progress bar for an index job showing chunks/sec and ETA."""
+    if not p:
+        st.progress(0.0, text="Preparing documents...")
+        return
+    eta = f"{p['eta_s']:.0f}s" if p.get("eta_s") is not None else "?"
+    st.progress(
+        p["done"] / max(p["total"], 1),
+        text=f"Embedding {p['done']}/{p['total']} chunks · {p['chunks_per_sec']:.1f} chunks/s · ETA {eta}",
+    )
 
 
-def generate_quiz(topic: str, n: int = 10, note_id: Optional[str] = None):
-    import re
-    import json
-    
-    ctx = api.build_context(topic or "key topics", note_id=note_id)
-    
-    # Check if we have context
-    if not ctx or not ctx.strip() or ctx.strip() in ["No relevant context found.", "None", ""]:
-        return {"quiz": [], "error": "No documents uploaded. Please upload study materials first."}
-    
-    topic_text = f'about "{topic}"' if topic and topic.strip() else "from the materials"
-    
-    # Clearer prompt with real examples - not placeholder letters
-    prompt = f"""Read the text and create {n} multiple choice questions.
+def poll_job(state_key: str, label: str, on_done, render_progress=None, cancellable=True):
+    """Poll the background job whose ID is in st.session_state[state_key] every
+    second; once it finishes, hand it to on_done(job) and rerun the app."""
+
+    @st.fragment(run_every=1.0)
+    def poll():
+        job_id = st.session_state.get(state_key)
+        job = api.get_job(job_id) if job_id else None
+        if job is None:
+            st.session_state.pop(state_key, None)
+            return
+        if job["status"] in ("queued", "running"):
+            if render_progress:
+                render_progress(job["progress"])
+            else:
+                st.info(f"⏳ {label} ({job['status']})...")
+            if cancellable and st.button("Cancel", key=f"cancel_{job_id}"):
+                api.cancel_job(job_id)
+            return
+        st.session_state.pop(state_key, None)
+        on_done(job)
+        st.rerun()
+
+    if st.session_state.get(state_key):
+        poll()
+
+
+def render_quiz_progress(p):
+    """Questions of a running quiz job, shown as each batch completes."""
+    if not p:
+        st.info("⏳ Creating your quiz...")
+        return
+    st.progress(
+        p["batches_done"] / max(p["batches"], 1),
+        text=f"Created {len(p['quiz'])} questions ({p['batches_done']}/{p['batches']} batches)...",
+    )
+    if p["quiz"]:
+        render_interactive_quiz({"quiz": p["quiz"]})
 
-TEXT:
-{ctx}
 
-IMPORTANT: Each choice must be a real answer, NOT just a letter!
+def render_flashcards_progress(p):
+    """Cards of a running flashcards job, shown as each one is parsed."""
+    if not p or not p["flashcards"]:
+        st.info("⏳ Creating your flashcards...")
+        return
+    st.caption(f"Created {len(p['flashcards'])} cards so far...")
+    render_interactive_flashcards({"flashcards": p["flashcards"]})
 
-Return JSON like this example:
-{{"quiz": [
-  {{"question": "What is the main function of the heart?", "choices": ["To pump blood throughout the body", "To digest food", "To filter air", "To produce hormones"], "answer_index": 0, "explanation": "The heart pumps blood to all parts of the body."}}
-]}}
 
-Create {n} questions with 4 real answer choices each. JSON:"""
-
-    llm = api.get_llm()
-    raw_output = llm.invoke(prompt).content
-    
-    # Clean up the response
-    out = raw_output.strip()
-    
-    # Remove markdown code blocks
-    out = re.sub(r'```json\s*\n?', '', out)
-    out = re.sub(r'```\s*\n?', '', out)
-    out = out.strip()
-    
-    # Fix common JSON issues from small models
-    # Replace single quotes with double quotes (but not inside strings)
-    out = re.sub(r"'(\s*:\s*)", r'"\1', out)  # 'key': -> "key":
-    out = re.sub(r":\s*'([^']*)'", r': "\1"', out)  # : 'value' -> : "value"
-    
-    # Remove trailing commas before } or ]
-    out = re.sub(r',\s*([}\]])', r'\1', out)
-    
-    # Try multiple parsing strategies
-    result = None
-    
-    # Strategy 1: Direct parse
-    try:
-        result = json.loads(out)
-    except:
-        pass
-    
-    # Strategy 2: Find the outermost { } containing "quiz"
-    if result is None:
-        try:
-            # Find where "quiz" appears and work backwards/forwards
-            quiz_pos = out.find('"quiz"')
-            if quiz_pos == -1:
-                quiz_pos = out.find("'quiz'")
-            
-            if quiz_pos >= 0:
-                # Find the { before quiz
-                start = out.rfind('{', 0, quiz_pos)
-                if start >= 0:
-                    # Find matching }
-                    depth = 0
-                    end = start
-                    in_string = False
-                    escape = False
-                    for i, char in enumerate(out[start:], start):
-                        if escape:
-                            escape = False
-                            continue
-                        if char == '\\':
-                            escape = True
-                            continue
-                        if char == '"' and not escape:
-                            in_string = not in_string
-                            continue
-                        if in_string:
-                            continue
-                        if char == '{':
-                            depth += 1
-                        elif char == '}':
-                            depth -= 1
-                            if depth == 0:
-                                end = i + 1
-                                break
-                    
-                    json_str = out[start:end]
-                    result = json.loads(json_str)
-        except:
-            pass
-    
-    # Strategy 3: Try to find any valid JSON array for quiz
-    if result is None:
-        try:
-            # Look for array pattern
-            arr_start = out.find('[')
-            if arr_start >= 0:
-                depth = 0
-                end = arr_start
-                for i, char in enumerate(out[arr_start:], arr_start):
-                    if char == '[':
-                        depth += 1
-                    elif char == ']':
-                        depth -= 1
-                        if depth == 0:
-                            end = i + 1
-                            break
-                arr_str = out[arr_start:end]
-                arr = json.loads(arr_str)
-                if isinstance(arr, list) and len(arr) > 0:
-                    result = {"quiz": arr}
-        except:
-            pass
-    
-    # Strategy 4: Fallback to api parser
-    if result is None:
-        result = api.parse_json_loose(out)
-    
-    # Always include raw output for debugging
-    if isinstance(result, dict):
-        result["_raw"] = raw_output[:1000]
-    
-    # Validate and fix the result
-    if isinstance(result, dict) and "quiz" in result and isinstance(result["quiz"], list):
-        valid_questions = []
-        for q in result["quiz"]:
-            if not isinstance(q, dict):
-                continue
-            
-            # Check if choices are valid (not just letters or too short)
-            if "choices" in q and isinstance(q["choices"], list):
-                choices = q["choices"]
-                # Filter out invalid choices (single letters, empty, too short)
-                invalid_patterns = ["A", "B", "C", "D", "a", "b", "c", "d", "...", ""]
-                has_invalid_choices = all(
-                    str(c).strip() in invalid_patterns or len(str(c).strip()) < 3 
-                    for c in choices
-                )
-                if has_invalid_choices:
-                    # Skip this question - choices are placeholders
-                    continue
-                
-                # Clean up choices
-                clean_choices = []
-                for c in choices:
-                    choice_str = str(c).strip()
-                    # Remove leading "A.", "B.", etc. if model added them
-                    if len(choice_str) > 2 and choice_str[0] in "ABCDabcd" and choice_str[1] in ".):":
-                        choice_str = choice_str[2:].strip()
-                    if choice_str and len(choice_str) >= 3:
-                        clean_choices.append(choice_str)
-                
-                if len(clean_choices) < 2:
-                    continue  # Not enough valid choices
-                    
-                # Pad to 4 choices if needed
-                while len(clean_choices) < 4:
-                    clean_choices.append(f"Option {chr(65 + len(clean_choices))}")
-                q["choices"] = clean_choices[:4]
-            else:
-                continue  # No choices, skip question
-            
-            # Ensure answer_index is valid (0-3)
-            if "answer_index" in q:
-                idx = q["answer_index"]
-                if not isinstance(idx, int):
-                    try:
-                        idx = int(idx)
-                        q["answer_index"] = idx
-                    except:
-                        q["answer_index"] = 0
-                if idx < 0 or idx > 3:
-                    q["answer_index"] = 0
-            else:
-                q["answer_index"] = 0
-            
-            # Ensure question exists and is meaningful
-            if "question" not in q or not q["question"] or len(str(q["question"]).strip()) < 10:
-                continue  # Skip questions that are too short
-            
-            # This question passed all validation
-            valid_questions.append(q)
-        
-        # Use only valid questions
-        result["quiz"] = valid_questions
-        
-        # If no valid questions, add error message
-        if not valid_questions:
-            result["error"] = "Could not generate valid quiz questions. The model may have returned placeholder content. Try again."
-        
-    elif isinstance(result, dict) and "error" in result:
-        result["quiz"] = []
-        result["_raw"] = raw_output[:1000]
-    else:
-        result = {"quiz": [], "_raw": raw_output[:1000], "error": "Could not parse quiz from model response"}
-    
-    return result
+def job_result(job, key: str):
+    """A finished generation job as the dict the render_* helpers expect."""
+    if job["status"] == "done":
+        return job["result"]
+    if job["status"] == "cancelled":
+        return {key: [], "error": "Generation was cancelled."}
+    return {key: [], "error": job["error"]}
 
 
-def generate_mindmap(topic: str, note_id: Optional[str] = None):
-    ctx = api.build_context(topic or "overview", note_id=note_id)
-    
-    # Check if we have context
-    if not ctx or not ctx.strip() or ctx.strip() in ["No relevant context found.", "None", ""]:
-        return '{"title": "No Content", "branches": [{"name": "Upload documents first", "items": ["Go to Upload tab", "Add your study materials"]}]}'
-    
-    topic_text = f'about "{topic}"' if topic and topic.strip() else ""
+def _answer_prompt(question: str, ctx: str) -> str:
+    # Check if we have meaningful context
+    has_context = ctx and ctx.strip() and ctx.strip() not in ["", "No relevant context found.", "None"]
     
-    prompt = f"""Create ONE mindmap {topic_text} from the context below.
+    if has_context:
+        return f"""You are "My Learning Buddy" — a friendly study helper.
 
-CRITICAL RULES:
-1. Use ONLY facts from the CONTEXT - never make up content
-2. Return exactly ONE JSON object
-3. If context is about cooking, make a cooking mindmap. If about history, make a history mindmap. Match the actual content!
+YOUR JOB: Answer the user's question using ONLY the context provided below.
 
-Format (return ONLY this, no extra text):
-{{"title": "Topic from context", "branches": [{{"name": "Theme 1", "items": ["fact 1", "fact 2"]}}, {{"name": "Theme 2", "items": ["fact 1", "fact 2"]}}]}}
+RULES:
+1. If the answer IS in the context → Answer clearly and friendly, cite with [1], [2] where helpful
+2. If the answer is NOT in the context → Say "I couldn't find information about [topic] in your notes."
+3. NEVER add information from outside the context
+4. NEVER guess or make things up
+5. Keep answers clear and helpful
 
-CONTEXT:
+CONTEXT FROM USER'S NOTES:
 {ctx}
 
-Return ONE JSON object only:"""
-    
-    llm = api.get_llm()
-    out = llm.invoke(prompt).content.strip()
-    
-    # Clean up - extract only the first valid JSON object
-    import json
-    import re
-    
-    # Remove markdown code blocks
-    out = re.sub(r'```json\s*', '', out)
-    out = re.sub(r'```\s*', '', out)
-    
-    # Try to find and parse just the first JSON object
-    try:
-        # Find first { and matching }
-        start = out.find('{')
-        if start >= 0:
-            depth = 0
-            end = start
-            for i, char in enumerate(out[start:], start):
-                if char == '{':
-                    depth += 1
-                elif char == '}':
-                    depth -= 1
-                    if depth == 0:
-                        end = i + 1
-                        break
-            
-            json_str = out[start:end]
-            # Validate it's proper JSON
-            parsed = json.loads(json_str)
-            return json.dumps(parsed)  # Return clean JSON
-    except:
-        pass
-    
+QUESTION: {question}
+
+Answer based ONLY on the context above:"""
+    return f"""You are "My Learning Buddy" — a friendly study helper.
+
+The user asked: "{question}"
+
+You searched their notes but found no relevant information about this topic.
+
+Respond with a short, friendly message (2-3 sentences):
+- Let them know you couldn't find this in their notes
+- Suggest uploading materials about this topic
+- Do NOT explain or define the term — just say it's not in their notes"""
+
+
+def _save_chat(note_id: Optional[str], question: str, answer: str):
+    if note_id:
+        api.append_chat(note_id, question, answer)
+
+
+def ask_question(question: str, note_id: Optional[str] = None):
+    out = api.answer_cache.lookup(question, note_id, "answer")
+    if out is None:
+        ctx = api.build_context(question, note_id=note_id)
+        llm = api.get_llm()
+        out = llm.invoke(_answer_prompt(question, ctx)).content
+        api.answer_cache.store(question, note_id, "answer", out)
+    _save_chat(note_id, question, out)
     return out
 
 
+def ask_question_stream(question: str, note_id: Optional[str] = None):
+    """Token generator for st.write_stream; saves the chat once the answer is complete."""
+    out = api.answer_cache.lookup(question, note_id, "answer")
+    if out is None:
+        ctx = api.build_context(question, note_id=note_id)
+        parts = []
+        for token in api.stream_llm(_answer_prompt(question, ctx)):
+            parts.append(token)
+            yield token
+        out = "".join(parts)
+        api.answer_cache.store(question, note_id, "answer", out)
+    else:
+        yield out
+    _save_chat(note_id, question, out)
+
+
 def render_interactive_quiz(quiz_data):
     """Render quiz as interactive questions with click-to-reveal answers."""
     
@@ -572,6 +250,8 @@ def render_interactive_quiz(quiz_data):
                 st.info("💡 Tip: The model may be struggling with JSON format. Try generating again or use a larger model.")
         st.warning("No quiz questions generated. Make sure you have uploaded documents first, then try again.")
         return
+    if isinstance(quiz_data, dict) and quiz_data.get("warning"):
+        st.info(f"ℹ️ {quiz_data['warning']}")
     
     # Initialize session state for revealed answers
     if "revealed_answers" not in st.session_state:
@@ -1113,10 +793,16 @@ def render_interactive_flashcards(flashcards_data):
             st.rerun()
 
 
+AGENT_PATH_LABELS = {
+    "fast": "⚡ fast (high-confidence retrieval, Teacher only)",
+    "fused": "🔀 fused (Researcher + Teacher in one generation)",
+    "two_pass": "🔁 two-pass (Researcher, then Teacher)",
+}
+
+
 def get_note_options(include_all=False, include_none=False):
     """Get fresh note options for dropdowns."""
-    state = load_notes()
-    notes = state.get("notes", {})
+    notes = load_notes()
     note_map = {nid: n["title"] for nid, n in notes.items()}
     
     options = []
@@ -1141,6 +827,8 @@ def extract_note_id(selection):
 
 
 def main():
+    api.start_job_workers()
+    api.start_warm_up()
     st.markdown(
         """
         <style>
@@ -1153,6 +841,10 @@ def main():
 
     st.title("My Learning Buddy")
     st.caption("Your friendly local RAG assistant — upload, learn, quiz, and review.")
+    if api.warmup_status["state"] == "running":
+        st.caption("⏳ Loading the models in the background; the first answer may take a moment.")
+    elif api.warmup_status["state"] == "failed":
+        st.warning(f"Model warm-up failed (is Ollama running?): {api.warmup_status['error']}")
     
     # ADD THIS DISCLAIMER
     with st.expander("⚠️ Important Disclaimer", expanded=False):
@@ -1191,12 +883,33 @@ def main():
                 if not uploaded:
                     st.warning("No files selected")
                 else:
-                    res = ingest_files(uploaded)
-                    if res.get("ok"):
-                        st.success(f"✅ Indexed {res['docs']} documents into {res['chunks']} chunks!")
+                    st.session_state.upload_job = ingest_files(uploaded)
+
+            def upload_done(job):
+                if job["status"] == "done":
+                    invalidate_caches()
+                st.session_state.upload_result = job["result"] if job["status"] == "done" else {
+                    "ok": False,
+                    "error": "Upload was cancelled." if job["status"] == "cancelled" else job["error"],
+                }
+
+            poll_job("upload_job", "Indexing", upload_done, render_progress=render_upload_progress, cancellable=False)
+
+            res = st.session_state.pop("upload_result", None)
+            if res is not None:
+                if res.get("ok"):
+                    if res["docs"]:
+                        st.success(
+                            f"✅ Indexed {res['docs']} documents into {res['chunks']} chunks "
+                            f"({res['added']} new, {res['deleted']} removed)!"
+                        )
                         st.balloons()
-                    else:
-                        st.error(res.get("message") or res.get("error"))
+                        if res["added"] or res["deleted"]:
+                            st.caption("📋 Summary and mindmap are being prepared in the background.")
+                    if res["skipped"]:
+                        st.info(f"Already indexed, unchanged: {', '.join(res['skipped'])}")
+                else:
+                    st.error(res.get("message") or res.get("error"))
         
         with col2:
             st.markdown("""
@@ -1207,7 +920,7 @@ def main():
                     3. Chat, Quiz, Summarize, etc.<br><br>
                     <b>Supported formats:</b><br>
                     PDF, DOCX, TXT, Images<br><br>
-                    <b>Note:</b> Uploading new files replaces old content automatically.
+                    <b>Note:</b> Re-uploading a file only re-indexes what changed.
                 </div>
             """, unsafe_allow_html=True)
 
@@ -1227,15 +940,19 @@ def main():
             if not question.strip():
                 st.warning("Enter a question")
             else:
-                with st.spinner("Agents working..." if show_agent_process else "Thinking..."):
-                    if use_tools:
-                        # Use multi-agent approach with tools
-                        result = api.ask_with_agents(question.strip())
-                        answer = result["final_answer"]
-                    else:
-                        # Original version without agents
-                        answer = ask_question(question.strip())
-                        result = None
+                if use_tools:
+                    # Use multi-agent approach with tools; only the Researcher blocks
+                    with st.spinner("Agents working..." if show_agent_process else "Thinking..."):
+                        result = api.ask_with_agents_stream(question.strip())
+                    answer_stream = result["answer_stream"]
+                    if result.get("cached"):
+                        st.caption("⚡ Answered from cache (a very similar question was asked before)")
+                    elif result.get("path"):
+                        st.caption(f"Path: {AGENT_PATH_LABELS.get(result['path'], result['path'])}")
+                else:
+                    # Original version without agents
+                    answer_stream = ask_question_stream(question.strip())
+                    result = None
                 
                 # Show agent collaboration process if enabled AND using tools
                 if show_agent_process and use_tools and result:
@@ -1243,14 +960,19 @@ def main():
                         # Researcher Agent Section
                         st.markdown("### 🔎 Agent 1: Researcher")
                         st.markdown("*Role: Finds and extracts relevant facts from your documents*")
-                        st.info(result["researcher_output"])
+                        # On the fused path the facts arrive with the answer stream
+                        research_box = st.empty()
+                        if result["researcher_output"] is not None:
+                            research_box.info(result["researcher_output"])
                         
                         st.markdown("---")
                         
                         # Teacher Agent Section
                         st.markdown("### 📚 Agent 2: Teacher")
                         st.markdown("*Role: Explains the research in a student-friendly way*")
-                        st.success(result["teacher_output"])
+                        st.write_stream(answer_stream)
+                        if result.get("path") == "fused":
+                            research_box.info(result["researcher_output"] or "(no separate facts section returned)")
                         
                         st.markdown("---")
                         st.markdown("**🔄 Collaboration Flow:**")
@@ -1268,7 +990,7 @@ def main():
                 else:
                     # Show final answer ONLY when agent process is NOT shown
                     st.markdown("### ✅ Final Answer")
-                    st.write(answer)
+                    st.write_stream(answer_stream)
         # question = st.text_input("Ask a question about your uploaded materials")
         # if st.button("🔍 Ask", type="primary"):
         #     if not question.strip():
@@ -1291,12 +1013,15 @@ def main():
         n = st.number_input("Number of questions", min_value=1, max_value=50, value=5)
         
         if st.button("Generate Quiz", type="primary"):
-            with st.spinner("Creating your quiz..."):
-                out = generate_quiz(topic, n)
-            st.session_state.current_quiz = out
+            st.session_state.quiz_job = api.submit_job("quiz", {"topic": topic, "n": int(n)})
+            st.session_state.current_quiz = None
             st.session_state.revealed_answers = set()
             st.session_state.user_answers = {}
-            st.rerun()
+
+        def quiz_done(job):
+            st.session_state.current_quiz = job_result(job, "quiz")
+
+        poll_job("quiz_job", "Creating your quiz", quiz_done, render_progress=render_quiz_progress)
         
         if "current_quiz" in st.session_state and st.session_state.current_quiz:
             render_interactive_quiz(st.session_state.current_quiz)
@@ -1307,11 +1032,21 @@ def main():
         st.caption("Get a concise summary of your study materials")
         
         topic = st.text_input("Topic to summarize (optional)", key="summary_topic")
+        precomputed = None if topic.strip() else precomputed_summary(None, "note", summary_key())
+        if not topic.strip() and precomputed is None:
+            if api.summary_status().get("", {}).get("state") in ("queued", "building"):
+                st.caption("⏳ The precomputed summary is still being prepared; generating one now may take longer.")
         
         if st.button("Generate Summary", type="primary"):
-            with st.spinner("Summarizing..."):
-                out = generate_summary(topic)
-            st.write(out)
+            if precomputed:
+                st.session_state.current_summary = precomputed
+                st.markdown(precomputed)
+            else:
+                with st.spinner("Summarizing..."):
+                    summary_stream = api.generate_summary_stream(topic)
+                st.session_state.current_summary = st.write_stream(summary_stream)
+        elif st.session_state.get("current_summary"):
+            st.markdown(st.session_state.current_summary)
 
     # Flashcards tab
     with tabs[4]:
@@ -1322,11 +1057,14 @@ def main():
         n = st.number_input("Number of flashcards", min_value=1, max_value=50, value=10, key="flash_n")
         
         if st.button("Generate Flashcards", type="primary"):
-            with st.spinner("Creating your flashcards..."):
-                out = generate_flashcards(topic, int(n))
-            st.session_state.current_flashcards = out
+            st.session_state.flash_job = api.submit_job("flashcards", {"topic": topic, "n": int(n)})
+            st.session_state.current_flashcards = None
             st.session_state.flipped_cards = set()
-            st.rerun()
+
+        def flashcards_done(job):
+            st.session_state.current_flashcards = job_result(job, "flashcards")
+
+        poll_job("flash_job", "Creating your flashcards", flashcards_done, render_progress=render_flashcards_progress)
         
         if "current_flashcards" in st.session_state and st.session_state.current_flashcards:
             render_interactive_flashcards(st.session_state.current_flashcards)
@@ -1339,8 +1077,10 @@ def main():
         topic = st.text_input("Central topic (optional)", key="mind_topic")
         
         if st.button("Generate Mindmap", type="primary"):
-            with st.spinner("Creating your mindmap..."):
-                out = generate_mindmap(topic)
+            out = None if topic.strip() else precomputed_summary(None, "mindmap", summary_key())
+            if out is None:
+                with st.spinner("Creating your mindmap..."):
+                    out = generated_mindmap(topic, None, api.corpus_version())
             st.session_state.current_mindmap = out
             st.rerun()
         
@@ -0,0 +1,23 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import core  # noqa: E402
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    """Point core's on-disk state (manifest, state DB) at a temp directory."""
+    monkeypatch.setattr(core, "DATA_DIR", str(tmp_path))
+    monkeypatch.setattr(core, "MANIFEST_PATH", str(tmp_path / "manifest.json"))
+    monkeypatch.setattr(core, "STATE_DB_PATH", str(tmp_path / "state.sqlite3"))
+    monkeypatch.setattr(core, "STATE_PATH", str(tmp_path / "state.json"))
+    monkeypatch.setattr(core, "manifest_cache", None)
+    monkeypatch.setattr(core, "state_db", None)
+    monkeypatch.setattr(core, "_partition_cache", None)
+    yield tmp_path
+    if core.state_db is not None:
+        core.state_db.close()
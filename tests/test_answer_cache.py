@@ -0,0 +1,93 @@
+import asyncio
+
+import pytest
+
+import core
+
+
+class FakeEmbeddings:
+    def embed_query(self, text):
+        return [1.0, float(len(text))]
+
+    async def aembed_query(self, text):
+        return self.embed_query(text)
+
+
+@pytest.fixture
+def llm_calls(data_dir, monkeypatch):
+    calls = []
+
+    async def fake_astream_llm(prompt, model=None):
+        calls.append(prompt)
+        for token in ("Plants ", "make ", "food."):
+            yield token
+
+    async def no_context(question, note_id=None, *args, **kwargs):
+        return []
+
+    monkeypatch.setattr(core, "answer_cache", core.SemanticAnswerCache())
+    monkeypatch.setattr(core, "ensure_embeddings", lambda: FakeEmbeddings())
+    monkeypatch.setattr(core, "aretrieve_scored", no_context)
+    monkeypatch.setattr(core, "astream_llm", fake_astream_llm)
+    return calls
+
+
+async def ask(question, note_id="bio"):
+    result = await core.aask_with_agents_stream(question, note_id)
+    return result, "".join([token async for token in result["answer_stream"]])
+
+
+def test_async_agents_stream_answers_repeat_questions_from_cache(llm_calls):
+    first, first_answer = asyncio.run(ask("What is photosynthesis?"))
+    second, second_answer = asyncio.run(ask("What is photosynthesis?"))
+
+    assert len(llm_calls) == 1
+    assert second_answer == first_answer == "Plants make food."
+    assert second.get("cached") and not first.get("cached")
+    assert second["researcher_output"] == first["researcher_output"]
+
+
+def test_async_cache_is_dropped_when_the_note_changes(llm_calls):
+    asyncio.run(ask("What is photosynthesis?"))
+    core._bump_corpus_version("bio")
+    asyncio.run(ask("What is photosynthesis?"))
+
+    assert len(llm_calls) == 2
+
+
+@pytest.fixture
+def cache(data_dir, monkeypatch):
+    monkeypatch.setattr(core, "ensure_embeddings", lambda: FakeEmbeddings())
+    return core.SemanticAnswerCache(max_entries=3)
+
+
+def test_lookup_only_matches_the_same_scope(cache):
+    cache.store("What is osmosis?", "bio", "chat", "bio answer")
+    cache.store("What is osmosis?", "chem", "chat", "chem answer")
+
+    assert cache.lookup("What is osmosis?", "bio", "chat") == "bio answer"
+    assert cache.lookup("What is osmosis?", "bio", "agents") is None
+    assert cache.lookup("What is osmosis?", "hist", "chat") is None
+
+
+def test_least_recently_used_is_evicted_across_scopes(cache):
+    cache.store("q one", "bio", "chat", 1)
+    cache.store("q two", "chem", "chat", 2)
+    cache.store("q three", "bio", "chat", 3)
+    assert cache.lookup("q one", "bio", "chat") == 1  # now most recent
+    cache.store("q four", "hist", "chat", 4)
+
+    assert cache.lookup("q two", "chem", "chat") is None
+    assert cache.lookup("q one", "bio", "chat") == 1
+    assert cache.stats["evictions"] == 1
+
+
+def test_invalidate_drops_the_note_and_all_notes_scopes(cache):
+    cache.store("q one", "bio", "chat", 1)
+    cache.store("q one", None, "chat", 2)
+    cache.store("q one", "chem", "chat", 3)
+    cache.invalidate("bio")
+
+    assert cache.lookup("q one", "bio", "chat") is None
+    assert cache.lookup("q one", None, "chat") is None
+    assert cache.lookup("q one", "chem", "chat") == 3
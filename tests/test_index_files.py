@@ -0,0 +1,162 @@
+import os
+import threading
+import time
+
+import pytest
+
+import core
+
+
+class FakeCollection:
+    def __init__(self, store):
+        self.store = store
+
+    def count(self):
+        return len(self.store.docs)
+
+
+class FakeStore:
+    """Stands in for a Chroma partition and the BM25 index (chunk ID -> text)."""
+
+    def __init__(self):
+        self.docs = {}
+        self._collection = FakeCollection(self)
+
+    def delete(self, ids):
+        for cid in ids:
+            self.docs.pop(cid, None)
+
+    def add(self, ids, docs):
+        self.docs.update((cid, d.page_content) for cid, d in zip(ids, docs))
+
+    def reset(self):
+        self.docs.clear()
+
+
+@pytest.fixture
+def store(data_dir, monkeypatch):
+    vectors, lexical = FakeStore(), FakeStore()
+
+    def slow_embed_and_store(vs, docs, ids, progress=None):
+        time.sleep(0.05)  # long enough for overlapping uploads to interleave
+        vs.add(ids, docs)
+        return len(docs)
+
+    monkeypatch.setattr(core, "ensure_vectorstore", lambda note_id=None, generation=None: vectors)
+    monkeypatch.setattr(core, "list_partitions", lambda: [vectors])
+    monkeypatch.setattr(core, "embed_and_store", slow_embed_and_store)
+    monkeypatch.setattr(core, "get_lexical_index", lambda: lexical)
+    monkeypatch.setattr(core, "SUMMARY_ON_INGEST", False)
+    core.save_manifest({"files": {}, "versions": {}})
+    return vectors, lexical
+
+
+def manifest_chunk_ids():
+    return {cid for entry in core.load_manifest()["files"].values() for cid in entry["chunk_ids"]}
+
+
+def test_concurrent_reuploads_leave_no_orphaned_chunks(store):
+    vectors, lexical = store
+    core.index_files([("notes.txt", b"first version")])
+
+    threads = [
+        threading.Thread(target=core.index_files, args=([("notes.txt", text)],))
+        for text in (b"second version", b"third version")
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(manifest_chunk_ids()) == 1
+    assert set(vectors.docs) == manifest_chunk_ids()
+    assert set(lexical.docs) == manifest_chunk_ids()
+
+
+def test_reupload_replaces_stale_chunks(store):
+    vectors, _ = store
+    core.index_files([("notes.txt", b"first version")])
+    res = core.index_files([("notes.txt", b"second version")])
+
+    assert res["added"] == 1 and res["deleted"] == 1
+    assert list(vectors.docs.values()) == ["second version"]
+    assert core.index_files([("notes.txt", b"second version")])["skipped"] == ["notes.txt"]
+
+
+class FakePartition:
+    """A Chroma partition: chunk ID -> (text, metadata)."""
+
+    def __init__(self, name):
+        self.name = name
+        self.docs = {}
+        self._collection = self
+
+    def count(self):
+        return len(self.docs)
+
+    def get(self, include=None, limit=None, offset=0):
+        page = list(self.docs.items())[offset:offset + limit]
+        return {
+            "ids": [cid for cid, _ in page],
+            "documents": [text for _, (text, _) in page],
+            "metadatas": [meta for _, (_, meta) in page],
+        }
+
+    def add(self, ids, docs):
+        self.docs.update((cid, (d.page_content, dict(d.metadata))) for cid, d in zip(ids, docs))
+
+    def delete(self, ids):
+        for cid in ids:
+            self.docs.pop(cid, None)
+
+
+class FakeClient:
+    def __init__(self):
+        self.partitions = {}
+
+    def partition(self, name):
+        return self.partitions.setdefault(name, FakePartition(name))
+
+    def list_collections(self):
+        return list(self.partitions.values())
+
+    def get_collection(self, name):
+        return self.partitions[name]
+
+
+@pytest.fixture
+def partitions(data_dir, monkeypatch):
+    client, lexical = FakeClient(), FakeStore()
+    monkeypatch.setattr(core, "get_chroma_client", lambda: client)
+    monkeypatch.setattr(
+        core, "ensure_vectorstore", lambda note_id=None, generation=None: client.partition(core.partition_name(note_id))
+    )
+    monkeypatch.setattr(core, "list_partitions", lambda: client.list_collections())
+    monkeypatch.setattr(core, "embed_and_store", lambda vs, docs, ids, progress=None: vs.add(ids, docs))
+    monkeypatch.setattr(core, "get_lexical_index", lambda: lexical)
+    monkeypatch.setattr(core, "SUMMARY_ON_INGEST", False)
+    return client, lexical
+
+
+def test_missing_manifest_keeps_other_notes(partitions):
+    client, lexical = partitions
+    core.index_files([("bio.txt", b"photosynthesis makes sugar")], note_id="bio")
+    bio = dict(client.partition(core.partition_name("bio")).docs)
+    os.remove(core.MANIFEST_PATH)
+
+    core.index_files([("hist.txt", b"the treaty of versailles")], note_id="hist")
+
+    assert client.partition(core.partition_name("bio")).docs == bio
+    assert set(bio) <= set(lexical.docs)
+    assert set(bio) <= manifest_chunk_ids()
+
+
+def test_missing_manifest_reupload_replaces_adopted_chunks(partitions):
+    client, _ = partitions
+    core.index_files([("bio.txt", b"photosynthesis makes sugar")], note_id="bio")
+    os.remove(core.MANIFEST_PATH)
+
+    res = core.index_files([("bio.txt", b"respiration burns sugar")], note_id="bio")
+
+    assert res["deleted"] == 1
+    assert [text for text, _ in client.partition(core.partition_name("bio")).docs.values()] == ["respiration burns sugar"]
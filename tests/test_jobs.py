@@ -0,0 +1,57 @@
+import json
+import os
+
+import pytest
+
+import core
+
+start_job_workers = core.start_job_workers
+
+
+@pytest.fixture
+def uploads(data_dir, monkeypatch):
+    monkeypatch.setattr(core, "JOB_UPLOAD_DIR", str(data_dir / "uploads"))
+    monkeypatch.setattr(core, "start_job_workers", lambda: None)  # keep jobs queued
+    return data_dir / "uploads"
+
+
+def job_params(job_id):
+    return core.get_job(job_id)["params"]
+
+
+def test_cancelling_a_queued_upload_deletes_its_files(uploads):
+    job_id = core.submit_index_job([("notes.txt", b"hello")], note_id="bio")
+    folder = job_params(job_id)["folder"]
+    assert os.listdir(folder)
+
+    assert core.cancel_job(job_id)
+
+    assert core.get_job(job_id)["status"] == "cancelled"
+    assert not os.path.exists(folder)
+
+
+def test_index_job_removes_its_folder_when_a_file_is_missing(uploads):
+    job_id = core.submit_index_job([("a.txt", b"one"), ("b.txt", b"two")])
+    params = job_params(job_id)
+    os.remove(params["files"][1][1])
+
+    with pytest.raises(FileNotFoundError):
+        core._index_job(params, core.JobContext(job_id))
+    assert not os.path.exists(params["folder"])
+
+
+def test_startup_sweep_removes_uploads_of_finished_jobs(uploads, monkeypatch):
+    folder = uploads / "upload_left_behind"
+    folder.mkdir(parents=True)
+    (folder / "0_notes.txt").write_bytes(b"hello")
+    with core.get_state_db() as conn:
+        conn.execute(
+            "INSERT INTO jobs (id, kind, params, status, created_ts, finished_ts) VALUES (?, 'index', ?, 'cancelled', 0, 0)",
+            ("job_old", json.dumps({"files": [["notes.txt", str(folder / "0_notes.txt")]], "folder": str(folder)})),
+        )
+    monkeypatch.setattr(core, "JOB_WORKERS", 0)
+    monkeypatch.setattr(core, "_job_threads", [])
+
+    start_job_workers()
+
+    assert not folder.exists()
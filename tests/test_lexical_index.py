@@ -0,0 +1,63 @@
+import pytest
+
+import core
+
+
+class FakeCollection:
+    def __init__(self, name, rows):
+        self.name = name
+        self.rows = rows  # [(chunk ID, text, metadata)]
+
+    def get(self, include=None, limit=None, offset=0):
+        page = self.rows[offset:offset + limit]
+        return {
+            "ids": [cid for cid, _, _ in page],
+            "documents": [text for _, text, _ in page],
+            "metadatas": [meta for _, _, meta in page],
+        }
+
+
+class FakeClient:
+    def __init__(self, collections):
+        self.collections = {c.name: c for c in collections}
+
+    def list_collections(self):
+        return list(self.collections.values())
+
+    def get_collection(self, name):
+        return self.collections[name]
+
+
+@pytest.fixture
+def lexical_path(data_dir, monkeypatch):
+    client = FakeClient([
+        FakeCollection(core.partition_name("bio"), [
+            (f"bio-{i}", f"photosynthesis chunk {i}", {"note_id": "bio", "source": "bio.pdf"}) for i in range(5)
+        ]),
+        FakeCollection(core.partition_name("hist"), [
+            ("hist-0", "the treaty of versailles", {"note_id": "hist", "source": "hist.pdf"}),
+        ]),
+    ])
+    monkeypatch.setattr(core, "get_chroma_client", lambda: client)
+    monkeypatch.setattr(core, "CHROMA_WRITE_BATCH", 2)  # force several pages
+    monkeypatch.setattr(core, "lexical_index", None)
+    return data_dir / "lexical.sqlite3"
+
+
+def test_empty_index_is_backfilled_from_partitions(lexical_path, monkeypatch):
+    opened = core.LexicalIndex
+    monkeypatch.setattr(core, "LexicalIndex", lambda: opened(str(lexical_path)))
+    index = core.get_lexical_index()
+
+    hits = index.search("photosynthesis", k=10)
+    assert sorted(d.id for d, _ in hits) == [f"bio-{i}" for i in range(5)]
+    assert [d.id for d, _ in index.search("versailles", note_id="hist")] == ["hist-0"]
+    assert index.search("versailles", note_id="bio") == []
+
+
+def test_non_empty_index_is_not_backfilled(lexical_path, monkeypatch):
+    index = core.LexicalIndex(str(lexical_path))
+    index.add(["own-0"], [core.Document(page_content="mitochondria", metadata={"note_id": "bio"})])
+    monkeypatch.setattr(core, "LexicalIndex", lambda: index)
+
+    assert core.get_lexical_index().search("photosynthesis") == []
@@ -0,0 +1,59 @@
+import pytest
+
+import core
+
+
+class FakeClient:
+    def __init__(self, names):
+        self.names = list(names)
+        self.listed = 0
+
+    def list_collections(self):
+        self.listed += 1
+        return list(self.names)
+
+
+@pytest.fixture
+def client(data_dir, monkeypatch):
+    client = FakeClient([core.partition_name("bio"), core.partition_name("hist")])
+    monkeypatch.setattr(core, "get_chroma_client", lambda: client)
+    return client
+
+
+def test_partitions_are_listed_once_per_corpus_version(client):
+    for _ in range(3):
+        assert core.current_generation() == 0
+        assert core.partition_names() == [core.partition_name("bio"), core.partition_name("hist")]
+    assert client.listed == 1
+
+    client.names.append(core.partition_name("chem"))
+    core._bump_corpus_version("chem")  # what an ingest in any process does
+
+    assert core.partition_name("chem") in core.partition_names()
+    assert client.listed == 2
+
+
+def test_published_rebuild_switches_generation(client, monkeypatch):
+    monkeypatch.setattr(core.resources, "retire", lambda key, close=None: client.names.remove(key[2]))
+    generation = core.begin_rebuild()
+    client.names += [core.partition_name("bio", generation), core.partition_name("hist", generation)]
+    assert core.current_generation() == 0
+
+    core.finish_rebuild(generation)
+
+    assert core.current_generation() == generation
+    assert core.partition_names("bio") == [core.partition_name("bio", generation)]
+
+
+def test_retired_partition_is_retried_only_once(client, monkeypatch):
+    searched = []
+
+    def retired(name, vector, k):
+        searched.append(name)
+        raise LookupError(f"Retired resource: {name}")
+
+    monkeypatch.setattr(core, "_search_partition", retired)
+
+    with pytest.raises(LookupError):
+        core._search_by_vector([1.0], 4, "bio")
+    assert len(searched) == 2
@@ -0,0 +1,110 @@
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import core
+
+
+def question(text):
+    return {"question": text, "choices": ["alpha one", "beta two", "gamma three", "delta four"], "answer_index": 0}
+
+
+class FakeLLM:
+    """Streams a quiz set one question per chunk; records how far it got."""
+
+    def __init__(self, texts):
+        self.texts = texts
+        self.streamed = 0
+
+    def stream(self, prompt):
+        yield SimpleNamespace(content='{"quiz": [')
+        for i, text in enumerate(self.texts):
+            self.streamed += 1
+            yield SimpleNamespace(content=("," if i else "") + json.dumps(question(text)))
+        yield SimpleNamespace(content="]}")
+
+
+@pytest.fixture
+def contexts(monkeypatch):
+    """Only two usable context slices, whatever the number of batches."""
+    monkeypatch.setattr(core, "_quiz_slices", lambda topic, note_id, batches: ["ctx one", "ctx two"])
+    monkeypatch.setattr(core, "QUIZ_BATCH_SPARE", 0)
+
+
+def test_generate_items_stops_streaming_when_cancelled(monkeypatch):
+    llm = FakeLLM([f"Which process number {i} happens first?" for i in range(5)])
+    monkeypatch.setattr(core, "get_structured_llm", lambda model: llm)
+    seen = []
+
+    out = core.generate_items(
+        "quiz", core._quiz_prompt, "ctx", 5, core.QuizQuestion, core.QuizSet, core._clean_quiz_question,
+        on_item=seen.append, cancelled=lambda: len(seen) >= 2,
+    )
+
+    assert len(out["quiz"]) == 2
+    assert llm.streamed == 3
+
+
+def test_every_batch_runs_when_slices_are_fewer(contexts, monkeypatch):
+    asked, lock = [], threading.Lock()
+
+    def fake_generate_items(kind, prompt_fn, ctx, n, *args):
+        on_item = args[3]
+        with lock:
+            start = len(asked)
+            asked.append(ctx)
+        items = [question(f"Distinct question number {start * 10 + i} about cells?") for i in range(n)]
+        for q in items:
+            on_item(q)
+        return {"quiz": items}
+
+    monkeypatch.setattr(core, "generate_items", fake_generate_items)
+    out = core.generate_quiz("", n=15)
+
+    assert len(asked) == 3
+    assert len(out["quiz"]) == 15 and "warning" not in out
+
+
+def test_duplicate_batches_are_topped_up_and_shortfall_reported(contexts, monkeypatch):
+    calls = []
+
+    def fake_generate_items(kind, prompt_fn, ctx, n, *args):
+        on_item = args[3]
+        calls.append(args[5] if len(args) > 5 else None)
+        items = [question(f"Same repeated question number {i} about cells?") for i in range(n)]
+        for q in items:
+            on_item(q)
+        return {"quiz": items}
+
+    monkeypatch.setattr(core, "generate_items", fake_generate_items)
+    out = core.generate_quiz("", n=10)
+
+    # Both batches return the same 5 questions; top-ups are told what to avoid
+    assert len(calls) == 2 + core.QUIZ_TOPUP_ROUNDS
+    assert len(calls[-1]) == 5
+    assert (out["requested"], out["returned"]) == (10, 5)
+    assert "warning" in out
+
+
+def test_cancelled_quiz_does_not_wait_for_running_batches(contexts, monkeypatch):
+    running, release, cancel = threading.Event(), threading.Event(), threading.Event()
+
+    def fake_generate_items(kind, prompt_fn, ctx, n, *args):
+        if ctx == "ctx one":
+            running.wait(5)
+            cancel.set()
+            return {"quiz": []}
+        running.set()
+        release.wait(5)  # a batch still streaming
+        return {"quiz": []}
+
+    monkeypatch.setattr(core, "generate_items", fake_generate_items)
+    started = time.perf_counter()
+    core.generate_quiz("", n=10, cancelled=cancel.is_set)
+    elapsed = time.perf_counter() - started
+    release.set()
+
+    assert elapsed < 2
@@ -0,0 +1,77 @@
+import pytest
+
+import core
+
+
+@pytest.fixture(autouse=True)
+def rules_only(data_dir, monkeypatch):
+    """Log to the temp dir and fail loudly if a case leaves the rule path."""
+    monkeypatch.setattr(core, "ROUTING_LOG_PATH", str(data_dir / "routing_log.jsonl"))
+    monkeypatch.setattr(core, "ROUTER_USE_EMBEDDINGS", False)
+    monkeypatch.setattr(core, "_llm_tool_route", lambda q: pytest.fail(f"LLM router called for {q!r}"))
+
+
+@pytest.mark.parametrize(
+    "question",
+    [
+        "What happened between 1914-1918?",
+        "Read pages 10-20",
+        "Explain chapter 3-4",
+        "Summarize page 2/3",
+        "What does section 1.2-1.3 cover?",
+        "What changed from 1939 – 45 in Europe?",
+    ],
+)
+def test_ranges_and_references_are_not_arithmetic(question):
+    decision = core.route_tool(question)
+    assert decision["tool"] is None
+    assert decision["source"] == "rules"
+
+
+@pytest.mark.parametrize(
+    "question, expression",
+    [
+        ("What is 12 * 4?", "12 * 4"),
+        ("What is 20 - 5?", "20 - 5"),
+        ("Calculate 10-20", "10-20"),
+        ("What is 3/4 + 1?", "3/4 + 1"),
+    ],
+)
+def test_arithmetic_uses_the_calculator(question, expression):
+    decision = core.route_tool(question)
+    assert decision["tool"] == "calculator"
+    assert decision["expression"] == expression
+    assert decision["source"] == "rules"
+
+
+def test_plain_questions_need_no_tool():
+    assert core.route_tool("Explain how photosynthesis works")["tool"] is None
+
+
+@pytest.mark.parametrize("question", ["Who won in the 2020 - 2021 season?", "Results for 1998 - 99"])
+def test_spaced_year_ranges_leave_the_rules(question, monkeypatch):
+    asked = []
+    monkeypatch.setattr(core, "_llm_tool_route", lambda q: asked.append(q))
+    decision = core.route_tool(question)
+    assert decision["tool"] is None
+    assert decision["source"] == "llm"
+    assert asked == [question]
+
+
+def test_year_arithmetic_with_a_math_word_uses_the_calculator():
+    decision = core.route_tool("Calculate 2021 - 1989")
+    assert decision["tool"] == "calculator"
+    assert decision["expression"] == "2021 - 1989"
+
+
+@pytest.mark.parametrize(
+    "question, expression, result",
+    [
+        ("What is 1e5 * 2", "1e5 * 2", "Result: 200000.0"),
+        ("What is 2.5E-3 + 1?", "2.5E-3 + 1", "Result: 1.0025"),
+    ],
+)
+def test_scientific_notation_is_one_number(question, expression, result):
+    decision = core.route_tool(question)
+    assert decision["expression"] == expression
+    assert core.calculator_tool(expression) == result
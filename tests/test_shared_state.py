@@ -0,0 +1,56 @@
+import json
+import sqlite3
+import subprocess
+import sys
+
+import core
+
+
+def test_manifest_written_by_another_process_is_reloaded(data_dir):
+    core.save_manifest({"files": {"a::one.txt": {"digest": "1", "ids": ["x"]}}})
+    assert list(core.load_manifest()["files"]) == ["a::one.txt"]
+
+    # Another process replaces the file; this process still holds the old dict
+    with open(core.MANIFEST_PATH, "w", encoding="utf-8") as f:
+        json.dump({"files": {"a::one.txt": {}, "b::two.txt": {}}}, f)
+
+    assert sorted(core.load_manifest()["files"]) == ["a::one.txt", "b::two.txt"]
+
+
+def test_corpus_version_is_shared_between_processes(data_dir):
+    assert core.corpus_version("bio") == 0
+    core._bump_corpus_version("bio")
+    assert (core.corpus_version(), core.corpus_version("bio")) == (1, 1)
+
+    other = sqlite3.connect(core.STATE_DB_PATH)
+    with other:
+        other.execute("UPDATE corpus_versions SET version = version + 1")
+    other.close()
+
+    assert (core.corpus_version(), core.corpus_version("bio")) == (2, 2)
+
+
+def test_versions_from_an_old_manifest_are_kept(data_dir):
+    with open(core.MANIFEST_PATH, "w", encoding="utf-8") as f:
+        json.dump({"files": {}, "versions": {"": 7, "bio": 3}}, f)
+
+    assert "versions" not in core.load_manifest()
+    assert (core.corpus_version(), core.corpus_version("bio")) == (7, 3)
+    core.save_manifest(core.load_manifest())
+    core.state_db.close()
+    core.state_db = None
+    assert core.corpus_version("bio") == 3
+
+
+def test_summary_status_survives_and_reports_dead_builders(data_dir):
+    core._set_summary_status("bio", "building")
+    core._set_summary_status("hist", "error", "ValueError: boom")
+    assert core.summary_status()["bio"]["state"] == "building"
+    assert core.summary_status()["hist"]["error"] == "ValueError: boom"
+
+    dead = subprocess.Popen([sys.executable, "-c", "pass"])
+    dead.wait()
+    with core.get_state_db() as conn:
+        conn.execute("UPDATE summary_status SET worker_pid = ? WHERE scope = 'bio'", (dead.pid,))
+
+    assert core.summary_status()["bio"]["state"] == "error"